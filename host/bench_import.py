@@ -0,0 +1,50 @@
+''' import time of ccpdv2
+
+Imports the module in a fresh interpreter several times and checks that
+no FE-I4 (pybar) module is loaded by the import.
+
+usage:
+   python bench_import.py [n] [limit_in_s]
+   exit code 1 if pybar was imported or the median is above limit_in_s
+'''
+import sys
+import subprocess
+import numpy as np
+
+FEI4_MODULES = ["pybar", "progressbar", "ccpdv2_fei4"]
+
+CODE = '''import time, sys
+t0 = time.time()
+import ccpdv2
+t = time.time() - t0
+print t, ",".join([m for m in %r if m in sys.modules])
+''' % (FEI4_MODULES, )
+
+
+def bench(n=5):
+    ### import times in s and the FE-I4 modules found after the import
+    times = []
+    loaded = set()
+    for i in range(n):
+        out = subprocess.check_output([sys.executable, "-c", CODE])
+        d = out.strip().splitlines()[-1].split(" ")
+        times.append(float(d[0]))
+        if len(d) > 1 and len(d[1]) != 0:
+            loaded.update(d[1].split(","))
+    return np.array(times), sorted(loaded)
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    limit = float(sys.argv[2]) if len(sys.argv) > 2 else None
+    times, loaded = bench(n)
+    print "import ccpdv2: median %.3fs min %.3fs max %.3fs (n=%d)" % (
+        np.median(times), np.min(times), np.max(times), n)
+    ret = 0
+    if len(loaded) != 0:
+        print "FE-I4 modules imported: %s" % ", ".join(loaded)
+        ret = 1
+    if limit is not None and np.median(times) > limit:
+        print "slower than %.3fs" % limit
+        ret = 1
+    sys.exit(ret)
@@ -1,159 +1,716 @@
 import time, sys, datetime, os, string
+import threading, Queue, atexit, cPickle, functools, copy, contextlib
+from collections import OrderedDict, namedtuple
 import numpy as np
 np.set_printoptions(linewidth="nan", threshold="nan")
 import yaml
-from basil import dut
-import logging
-logging.getLogger().setLevel(logging.DEBUG)
-
-#### modules for FEI4
-from pybar.run_manager import RunManager
-from pybar.scans.scan_init import InitScan
-from pybar.scans.scan_ext_trigger import ExtTriggerScan
-from pybar.scans.scan_fei4_self_trigger import FEI4SelfTriggerScan
-from pybar.scans.tune_threshold_baseline import ThresholdBaselineTuning
-import progressbar
-
-
-class HvcmosScan(ExtTriggerScan):
-    '''External trigger scan with FE-I4
-    For use with external scintillator (user RX0), TLU (use RJ45), USBpix self-trigger (loop back TX2 into RX0.)
-    '''
-    _default_run_conf = {
-        "trig_count": 0,
-        # FE-I4 trigger count, number of consecutive BCs, from 0 to 15
-        "trigger_mode": 0,
-        # trigger mode, more details in basil.HL.tlu, from 0 to 3
-        "trigger_latency": 232,
-        # FE-I4 trigger latency, in BCs, external scintillator / TLU / HitOR: 232, USBpix self-trigger: 220
-        "trigger_delay": 14,  # trigger delay, in BCs
-        "trigger_count": 0,  # consecutive trigger, 0 means 16
-        "trigger_rate_limit": 500,
-        # artificially limiting the trigger rate, in BCs (25ns)
-        "trigger_pos_edge": True,
-        # trigger on the positibe edge of the RX0 trigger signal
-        "trigger_time_stamp": False,
-        # if true trigger number is a time stamp with 40 Mhz clock
-        "trigger_tdc": False,
-        # only create tdc word if it can be assigned to a trigger
-        "col_span": [1, 80],  #[1,12],
-        "row_span": [
-            1, 336
-        ],  #[184, 208], sn2 [197, 197] [197, 230], #sn3 [219, 219],
-        "overwrite_enable_mask": False,
-        "use_enable_mask_for_imon": False,
-        "no_data_timeout": 0,  #10,
-        "scan_timeout": None,  #10,  # in seconds
-        "max_triggers": None,
-        "enable_tdc": False,
-        'reset_rx_on_error': False,
-        # long scans have a high propability for ESD related data transmission errors; recover and continue here
-        "hvcmos_inj": True
-    }
-
-    def scan(self):
-        # preload command
-        lvl1_command = self.register.get_commands(
-            "zeros",
-            length=self.trigger_delay)[0] + self.register.get_commands(
-                "LV1")[0] + self.register.get_commands(
-                    "zeros",
-                    length=self.trigger_rate_limit)[0]
-        self.register_utils.set_command(lvl1_command)
-
-        with self.readout(**self.scan_parameters._asdict()):
-            got_data = False
-            ### inject to HVCMOS
-            if self.hvcmos_inj == True:
-                logging.info("inj %s" % self.hvcmos_inj)
-                if self.dut['rx']['CCPD_TDC'] == 1:
-                    self.dut['sram'].reset()
-                self.dut['CCPD_TDCGATE_PULSE'].start()
-            while not self.stop_run.wait(1.0):
-                if not got_data:
-                    if self.fifo_readout.data_words_per_second() > 0:
-                        got_data = True
-                        logging.info('Taking data...')
-                        self.progressbar = progressbar.ProgressBar(
-                            widgets=['', progressbar.Percentage(), ' ',
-                                     progressbar.Bar(marker='*',
-                                                     left='|',
-                                                     right='|'), ' ',
-                                     progressbar.AdaptiveETA()],
-                            maxval=self.max_triggers,
-                            poll=10,
-                            term_width=80).start()
-                else:
-                    triggers = self.dut['tlu']['TRIGGER_COUNTER']
-                    try:
-                        self.progressbar.update(triggers)
-                    except ValueError:
-                        pass
-                    if self.max_triggers is not None and triggers >= self.max_triggers:
-                        self.progressbar.finish()
-                        self.stop(msg='Trigger limit was reached: %i' %
-                                  self.max_triggers)
-
-        logging.info('Total amount of triggers collected: %d',
-                     self.dut['tlu']['TRIGGER_COUNTER'])
-
-
-class HvcmosSelfScan(FEI4SelfTriggerScan):
-    _default_run_conf = {
-        "trig_count": 0,
-        # FE-I4 trigger count, number of consecutive BCs, from 0 to 15
-        "trigger_latency": 239,
-        # FE-I4 trigger latency, in BCs, external scintillator / TLU / HitOR: 232, USBpix self-trigger: 220, from 0 to 255
-        "col_span": [
-            1, 80
-        ],  # defining active column interval, 2-tuple, from 1 to 80
-        "row_span": [1, 336
-                     ],  # defining active row interval, 2-tuple, from 1 to 336
-        "overwrite_enable_mask": False,
-        # if True, use col_span and row_span to define an active region regardless of the Enable pixel register. If False, use col_span and row_span to define active region by also taking Enable pixel register into account.
-        "use_enable_mask_for_imon": False,
-        # if True, apply inverted Enable pixel mask to Imon pixel mask
-        "no_data_timeout": 10,
-        # no data timeout after which the scan will be aborted, in seconds
-        "scan_timeout": 60,
-        # timeout for scan after which the scan will be stopped, in seconds
-        "hvcmos_inj": True
-    }
-
-    def scan(self):
-        with self.readout():
-            got_data = False
-            start = time.time()
-            ### inject to HVCMOS
-            if self.hvcmos_inj == True:
-                logging.info("inj %s" % self.hvcmos_inj)
-                if self.dut['rx']['CCPD_TDC'] == 1:
-                    self.dut['sram'].reset()
-                self.dut['CCPD_TDCGATE_PULSE'].start()
-            while not self.stop_run.wait(1.0):
-                if not got_data:
-                    if self.fifo_readout.data_words_per_second() > 0:
-                        got_data = True
-                        logging.info('Taking data...')
-                        self.progressbar = progressbar.ProgressBar(
-                            widgets=['', progressbar.Percentage(), ' ',
-                                     progressbar.Bar(marker='*',
-                                                     left='|',
-                                                     right='|'), ' ',
-                                     progressbar.Timer()],
-                            maxval=self.scan_timeout,
-                            poll=10,
-                            term_width=80).start()
-                else:
-                    try:
-                        self.progressbar.update(time.time() - start)
-                    except ValueError:
-                        pass
+#### sram word format (see ccpdv2.v), shared with ccpdv2_fei4.py
+from ccpdv2_decode import (WORD_UNKNOWN, WORD_TLU, WORD_TDC, WORD_CCPD_TDC,
+                           WORD_FE_DH, WORD_FE_DR, WORD_FE, WORD_DTYPE,
+                           ccpdv2_decoder)
+
+#### basil and pybar (FEI4) are imported when they are used, see init() and ccpdv2_fei4.py.
+#### the pybar scans HvcmosScan, HvcmosSelfScan and HvcmosSessionScan are no longer
+#### in this module: use ccpdv2_fei4.HvcmosScan etc.
+
+#### CCPD_CONFIG bit map (see ccpdv2.yaml), index of the arrays = bit position in the register
+CONFIG_SIZE = 432
+_CONFIG_ROW = {"En0": 15, "En1": 14, "En2": 13, "En3": 12, "En4": 11, "En5": 10,
+               "InL": 9, "EnL": 5, "InR": 4, "EnR": 0}
+_CONFIG_COLUMN = {"ao": 11, "dc": 10, "Ld2": 9, "Ld1": 8, "Ld0": 7, "Str": 6,
+                  "R2": 5, "L2": 4, "R1": 3, "L1": 2, "R0": 1, "L0": 0}
+
+
+def _row_bit(i, name):
+    ### ROW[i]: offset 191, size 16, repeat 12
+    return 191 - 16 * i - 15 + _CONFIG_ROW[name]
+
+
+def _col_bit(i, name):
+    ### COLUMN[i]: offset 431, size 12, repeat 20
+    return 431 - 12 * i - 11 + _CONFIG_COLUMN[name]
+
+
+def _config_tables():
+    t = {}
+    t["rowen"] = np.zeros(24, int)  # EnL/EnR of each row (0=monitor)
+    t["colsel"] = np.zeros([24, 60], int)  # L/R of each pixel
+    t["preamp"] = np.zeros([24, 60], int)  # En0-5 of each pixel
+    t["en"] = np.zeros([3, 24], int)  # En0-5 of each row for en=[int,int,int]
+    t["tdac"] = np.zeros([24, 4], int)  # InL/InR of each row, MSB first
+    t["ld"] = np.zeros(60, int)  # Ld0-2 of each column
+    t["ao"] = np.zeros(60, int)  # ao of each column
+    for row in range(24):
+        if row % 4 == 1 or row % 4 == 2:
+            enlr, indac, en_base = "EnL", "InL", 0
+        else:
+            enlr, indac, en_base = "EnR", "InR", 3
+        lr = "L" if row % 2 == 0 else "R"
+        t["rowen"][row] = _row_bit(11 - row / 2, enlr)
+        for g in range(3):
+            t["en"][g, row] = _row_bit(11 - row / 2, "En%d" % (en_base + g))
+        ### bit_order [0,1,2,3]: LSB of tdac at the MSB of the field
+        t["tdac"][row] = [_row_bit(11 - row / 2, indac) - b for b in [3, 2, 1, 0]]
+        for col in range(60):
+            t["colsel"][row, col] = _col_bit(19 - col / 3, "%s%d" % (lr, col % 3))
+            t["preamp"][row, col] = _row_bit(11 - row / 2, "En%d" % (en_base + col % 3))
+    for col in range(60):
+        t["ld"][col] = _col_bit(19 - col / 3, "Ld%d" % (col % 3))
+        t["ao"][col] = _col_bit(19 - col / 3, "ao")
+    t["ao_group"] = np.array([_col_bit(19 - i, "ao") for i in range(20)])
+    t["all_rowen"] = np.array([_row_bit(i, n) for i in range(12) for n in ["EnL", "EnR"]])
+    t["all_colsel"] = np.array([_col_bit(i, "%s%d" % (n, g)) for i in range(20)
+                                for n in ["L", "R"] for g in range(3)])
+    t["all_preamp"] = np.array([_row_bit(i, "En%d" % g) for i in range(12) for g in range(6)])
+    return t
+
+
+CONFIG_TABLES = _config_tables()
+
+
+def pixels2mask(pixels):
+    ### [[row,col],...] or 24x60 bool array -> 24x60 bool array
+    if isinstance(pixels, np.ndarray) and pixels.dtype == bool:
+        return pixels
+    mask = np.zeros([24, 60], bool)
+    if len(pixels) != 0:
+        p = np.asarray(pixels, int).reshape(-1, 2)
+        mask[p[:, 0], p[:, 1]] = True
+    return mask
+
+
+def mask2pixels(mask):
+    ### 24x60 bool array -> [[row,col],...], ordered as pixels="all"
+    return [[int(row), int(col)] for col, row in np.argwhere(mask.T)]
+
+
+def _load_yaml(yamlfile):
+    ### the C loader of pyyaml if it was built with libyaml, the python one takes ~0.15s
+    with open(yamlfile) as f:
+        return yaml.load(f, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+
+
+def _format_bits(v, n):
+    ### same as format(v,"024b") but as an array of 0/1
+    return np.fromstring(format(v, "0%db" % n), np.uint8) - ord("0")
+
+
+def _noise_rate_fit(rates, n, rate_max):
+    ### log(rate) vs th close to the noise edge is nearly linear. fit of the two points
+    ### closest to the edge with 0 < rate < rate_max (further below, the readout saturates)
+    ### returns (slope, offset) for n=None, otherwise the expected rate at n
+    p = sorted([(m, np.log(r)) for m, r in rates.iteritems() if 0 < r < rate_max])[-2:]
+    if len(p) < 2:
+        return None
+    a = (p[1][1] - p[0][1]) / (p[1][0] - p[0][0])
+    if a >= 0:
+        return None
+    b = p[1][1] - a * p[1][0]
+    if n is None:
+        return a, b
+    return np.exp(a * n + b)
+
+
+#### HV-CMOS part of the FE-I4 HistOcc [row, col], Ccpdv2Fei4.fei4_regions can be changed
+FEI4_REGIONS = {
+    "HistOcc": [[184, 208], [0, 12]],
+    "HistOcc#2": [[184, 208], [0, 12]],
+    "HistOcc#3": [[206, 230], [0, 12]],
+}
+
+
+def fei4_region(dataname, regions=FEI4_REGIONS):
+    ### -> (row slice, col slice)
+    if dataname not in regions:
+        raise ValueError("unknown FE-I4 region %s" % dataname)
+    rows, cols = regions[dataname]
+    return slice(rows[0], rows[1]), slice(cols[0], cols[1])
+
+
+def _fei4_tables():
+    ### FE-I4 region [col 0-11, row 0-23] <-> HV-CMOS [row 0-23, col 12-47], one map per VNCOut
+    fe2hv = np.zeros([3, 12, 24, 2], int)
+    hv2fe = np.zeros([24, 60, 2], int) - 1
+    p0, p1 = np.meshgrid(np.arange(12), np.arange(24), indexing="ij")
+    for v in range(3):
+        ### row+1 for even col+row of VNCOut1/3 and odd col+row of VNCOut2
+        row = (11 - p0) * 2 + (((p0 + p1) % 2 == 1) == (v == 1))
+        col = (15 - p1 / 2) * 3 + v
+        fe2hv[v, :, :, 0] = row
+        fe2hv[v, :, :, 1] = col
+        hv2fe[row, col, 0] = p0
+        hv2fe[row, col, 1] = p1
+    return fe2hv, hv2fe
+
+
+FEI4_TO_HVCMOS, HVCMOS_TO_FEI4 = _fei4_tables()
+
+
+def fei4map2hvcmos(data, vncout):
+    ret = np.zeros([24, 60], np.asarray(data).dtype)
+    m = FEI4_TO_HVCMOS[vncout]
+    ret[m[..., 0], m[..., 1]] = data
+    return ret
+
+
+class ccpdv2_runindex():
+    ### run number -> *_interpreted.h5 of a pybar data directory, listed again only when it changed
+    def __init__(self, datadir):
+        self.datadir = datadir
+        self.runs = {}
+        self._seen = set()
+        self._dir_mtime = None
+        self._cfg_stat = None
+        self._last = None
+
+    def update(self, force=False):
+        mtime = os.stat(self.datadir).st_mtime
+        if mtime == self._dir_mtime and force == False:
+            return
+        self._dir_mtime = mtime
+        names = set(os.listdir(self.datadir))
+        for f in names - self._seen:
+            ftmp = f.split("_")
+            if "interpreted.h5" == ftmp[-1]:
+                self.runs[ftmp[0]] = os.path.join(self.datadir, f)
+        self._seen = names
+
+    def last_run(self):
+        ### run number of the last line of run.cfg, reads only the end of the file
+        fname = os.path.join(self.datadir, "run.cfg")
+        st = os.stat(fname)
+        if (st.st_mtime, st.st_size) != self._cfg_stat:
+            with open(fname, "rb") as f:
+                f.seek(max(st.st_size - 4096, 0))
+                lines = f.read().splitlines()
+            self._last = lines[-1].split()[0]
+            self._cfg_stat = (st.st_mtime, st.st_size)
+        return self._last
+
+    def get(self, run):
+        if run not in self.runs:
+            self.update()
+        if run not in self.runs:
+            ### mtime of the directory may not have changed within its resolution
+            self.update(force=True)
+        return self.runs.get(run)
+
+
+GLOBAL_DACS = ["BLRes", "ThRes", "VN", "VN2", "VNFB", "VNFoll", "VNLoad", "VNDAC",
+               "ThPRes", "ThP", "VNOut", "VNComp", "VNCompLd", "VNCOut1",
+               "VNCOut2", "VNCOut3", "VNBuffer", "VPFoll", "VNBias", "EnPullUp",
+               "EnPosFB"]
+MONITORS = ["CCPD_Vdd", "CCPD_Vssa", "CCPD_VGate", "CCPD_Vcasc", "CCPD_BL",
+            "CCPD_Th", "PCB_Th"]
+POWER_RAILS = MONITORS[:4]
+ALLCONFIG_KEYS = GLOBAL_DACS + [
+    "TDCGATE_delay", "TDCGATE_width", "TDCGATE_repeat", "TDCGATE_en",
+    "INJ_delay", "INJ_width", "INJ_repeat", "INJ_en", "TDC_en", "TDC_en_extern",
+    "TDACS", "pixels", "CCPD_CONFIG", "RX_data"
+] + ["%s_%s" % (m.replace("CCPD_", ""), vi) for m in MONITORS for vi in "vi"]
+SNAPSHOT_LOG_KEYS = ["t", "t_monitor"] + GLOBAL_DACS + [
+    "%s_%s" % (m.replace("CCPD_", ""), vi) for m in MONITORS for vi in "vi"]
+### register contents from the host shadow, *_v,*_i = analog monitors read at t_monitor
+ccpdv2_snapshot = namedtuple("ccpdv2_snapshot",
+                             ALLCONFIG_KEYS + ["inj_high", "inj_low", "t", "t_monitor"])
+
+### set() groups in the order _set() writes them to the hardware
+SET_FLAGS = ["pw", "inj", "hv", "gl", "t", "cnf", "pl", "th", "pcbth", "bl",
+             "mode", "fg"]
+### set() keyword -> (attribute, group), group None = software only; tdac* is parsed apart
+PARAMS = OrderedDict(
+    [(k, (k, "gl")) for k in GLOBAL_DACS] +
+    [(k, (k, None)) for k in ["exp", "smallhit", "tdc_only", "dataformat",
+                              "write_verify", "write_retry", "pipeline",
+                              "noise_search", "noise_resolution"]] +
+    [("pixels", ("pixels", "cnf")), ("pix", ("pixels", "cnf")),
+     ("enLR", ("enLR", "cnf")), ("ao", ("ao", "cnf")), ("en", ("en", "cnf"))] +
+    [(k, (k, "pl")) for k in ["inj_en", "delay", "period", "repeat"]] +
+    [("pcbth", ("pcbth", "pcbth")), ("bl", ("bl", "bl")), ("BL", ("bl", "bl")),
+     ("th", ("th", "th")), ("inj_high", ("inj_high", "inj")),
+     ("inj_low", ("inj_low", "inj")), ("hv", ("hv", "hv")),
+     ("vdd", ("vdd", "pw")), ("vss", ("vss", "pw")), ("vcasc", ("vcasc", "pw")),
+     ("vgate", ("vgate", "pw")), ("mode", ("mode", "mode"))])
+
+STATE_VERSION = 1
+
+
+class Ccpdv2Error(Exception):
+    pass
+
+
+class Ccpdv2VerifyError(Ccpdv2Error):
+    ### readback of a shift register differs from the written data
+    pass
+
+
+class Ccpdv2Timeout(Ccpdv2Error):
+    ### basil module did not become ready in time
+    pass
+
+
+class ccpdv2_waiter():
+    ### waits for is_done() of spi/pulse_gen modules and keeps latency histograms
+    def __init__(self, clk=1.0E6):
+        self.clk = clk  # SPI_CLK of the firmware
+        self.poll_min = 0.0001
+        self.poll_max = 0.01
+        self.timeout_min = 1.0
+        self.bins = np.logspace(-5, 1, 61)  # 10us-10s, 10 bins/decade
+        self.reset_hist()
+
+    def reset_hist(self):
+        self.hist = {}
+        self.stat = {}
+
+    def wait(self, name, module, cycles, timeout=None):
+        ### sleep until the predicted end, then poll with exponential backoff
+        t0 = time.time()
+        expect = float(cycles) / self.clk
+        if timeout is None:
+            timeout = max(10 * expect, self.timeout_min)
+        if expect > self.poll_min:
+            time.sleep(expect)
+        dt = self.poll_min
+        n = 1
+        while not module.is_done():
+            t = time.time() - t0
+            if t > timeout:
+                raise Ccpdv2Timeout("%s not done after %.3fs (expected %.6fs, %d polls)" %
+                                    (name, t, expect, n))
+            time.sleep(min(dt, timeout - t))
+            dt = min(dt * 2, self.poll_max)
+            n = n + 1
+        self.record(name, time.time() - t0, expect, n)
+
+    def record(self, name, latency, expect, polls):
+        if name not in self.hist:
+            self.hist[name] = np.zeros(len(self.bins) + 1, int)
+            self.stat[name] = {"n": 0, "sum": 0.0, "max": 0.0, "expect": 0.0, "polls": 0}
+        self.hist[name][np.searchsorted(self.bins, latency)] += 1
+        s = self.stat[name]
+        s["n"] = s["n"] + 1
+        s["sum"] = s["sum"] + latency
+        s["max"] = max(s["max"], latency)
+        s["expect"] = s["expect"] + expect
+        s["polls"] = s["polls"] + polls
+
+    def get_hist(self, name):
+        ### counts[i] = number of waits with bins[i-1] <= latency < bins[i]
+        return self.hist[name], self.bins
+
+    def show(self):
+        for name in sorted(self.stat.iterkeys()):
+            s = self.stat[name]
+            counts = self.hist[name]
+            cum = np.cumsum(counts)
+            edges = np.append(self.bins, np.inf)
+            p50 = edges[np.searchsorted(cum, 0.5 * s["n"])]
+            p99 = edges[np.searchsorted(cum, 0.99 * s["n"])]
+            print "%s n=%d mean=%.6fs expected=%.6fs p50<%.6fs p99<%.6fs max=%.6fs polls/wait=%.1f" % (
+                name, s["n"], s["sum"] / s["n"], s["expect"] / s["n"], p50, p99,
+                s["max"], float(s["polls"]) / s["n"])
+
+
+### tol: |v-target| [V], drift: |v-previous reading| [V], i_drift: same for current [mA]
+### n: consecutive good readings, interval: poll period [s], timeout [s]
+### settled = n readings within tol of the first one, successive readings within drift.
+### the target is only a coarse window (offset), the GPAC readback has its own offset
+SETTLE_PROFILES = {
+    "CCPD_Vdd": {"tol": 0.02, "drift": 0.003, "i_drift": 1.0, "offset": 0.1, "n": 3, "interval": 0.01, "timeout": 2.0},
+    "CCPD_Vssa": {"tol": 0.02, "drift": 0.003, "i_drift": None, "offset": 0.1, "n": 3, "interval": 0.01, "timeout": 2.0},
+    "CCPD_VGate": {"tol": 0.02, "drift": 0.003, "i_drift": None, "offset": 0.1, "n": 3, "interval": 0.01, "timeout": 2.0},
+    "default": {"tol": 0.005, "drift": 0.002, "i_drift": None, "offset": 0.05, "n": 2, "interval": 0.002, "timeout": 0.5},
+}
+### outputs which put_th/put_bl/... may leave unsettled when settle_dac=0
+SETTLE_DACS = ["CCPD_BL", "CCPD_Th", "PCB_Th", "CCPD_Injection_high", "CCPD_Injection_low"]
+
+
+class ccpdv2_settle():
+    ### polls the GPAC ADC until an output is stable close to its target, keeps settle times
+    def __init__(self, profiles=SETTLE_PROFILES):
+        self.profiles = dict(profiles)
+        self.reset_hist()
+
+    def reset_hist(self):
+        self.times = {}  # name: list of settle times
+        self.timeouts = {}
+
+    def profile(self, name):
+        return self.profiles.get(name, self.profiles["default"])
+
+    def wait(self, name, module, target, t0=None):
+        ### t0 = time of the write, returns settle time, None after a timeout
+        p = self.profile(name)
+        t_start = time.time()
+        if t0 is None:
+            t0 = t_start
+        v_ref, v0, i0 = None, None, None
+        n = 0
+        while True:
+            v = module.get_voltage(unit="V")
+            ok = (v_ref is not None and abs(v - v_ref) <= p["tol"] and
+                  abs(v - v0) <= p["drift"] and abs(v - target) <= p["offset"])
+            if p["i_drift"] is not None:
+                i = module.get_current(unit="mA")
+                ok = ok and abs(i - i0) <= p["i_drift"]
+                i0 = i
+            v0 = v
+            if ok:
+                n = n + 1
+            else:
+                v_ref, n = v, 0
+            t = time.time() - t0
+            if n >= p["n"]:
+                break
+            if time.time() - t_start > p["timeout"]:
+                print "ccpdv2_settle.wait() %s not settled after %.3fs: %fV target %fV" % (
+                    name, t, v, target)
+                self.timeouts[name] = self.timeouts.get(name, 0) + 1
+                return None
+            time.sleep(p["interval"])
+        self.times.setdefault(name, []).append(t)
+        return t
+
+    def show(self):
+        for name in sorted(set(self.times.keys() + self.timeouts.keys())):
+            t = np.array(self.times.get(name, [np.nan]))
+            print "%s n=%d mean=%.4fs max=%.4fs timeouts=%d" % (
+                name, len(self.times.get(name, [])), np.mean(t), np.max(t),
+                self.timeouts.get(name, 0))
+
+
+PRIORITY_HIGH = 0  # control and readout
+PRIORITY_LOW = 1  # monitoring
+
+
+class ccpdv2_lock():
+    ### reentrant lock of the dut. a waiting PRIORITY_HIGH thread goes before
+    ### all PRIORITY_LOW threads, the priority is per thread (set_priority)
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._owner = None
+        self._count = 0
+        self._t_acquired = 0.0
+        self._waiting = [0, 0]
+        self._local = threading.local()
+        self.reset_stat()
+
+    def reset_stat(self):
+        ### per thread name: n acquire, n_wait, wait [s], max_wait [s], hold [s]
+        self.stat = {}
+
+    def set_priority(self, priority):
+        self._local.priority = priority
+
+    def get_priority(self):
+        return getattr(self._local, "priority", PRIORITY_HIGH)
+
+    def _stat(self, name):
+        if name not in self.stat:
+            self.stat[name] = {"n": 0, "n_wait": 0, "wait": 0.0, "max_wait": 0.0,
+                               "hold": 0.0, "priority": self.get_priority()}
+        return self.stat[name]
+
+    def acquire(self):
+        me = threading.current_thread()
+        with self._cond:
+            if self._owner is me:
+                self._count = self._count + 1
+                return
+            p = self.get_priority()
+            s = self._stat(me.name)
+            s["n"] = s["n"] + 1
+            if self._owner is not None or (p != PRIORITY_HIGH and self._waiting[PRIORITY_HIGH] != 0):
+                t0 = time.time()
+                self._waiting[p] = self._waiting[p] + 1
+                while self._owner is not None or (
+                        p != PRIORITY_HIGH and self._waiting[PRIORITY_HIGH] != 0):
+                    self._cond.wait()
+                self._waiting[p] = self._waiting[p] - 1
+                t = time.time() - t0
+                s["n_wait"] = s["n_wait"] + 1
+                s["wait"] = s["wait"] + t
+                s["max_wait"] = max(s["max_wait"], t)
+            self._owner = me
+            self._count = 1
+            self._t_acquired = time.time()
+
+    def release(self):
+        with self._cond:
+            if self._owner is not threading.current_thread():
+                raise RuntimeError("ccpdv2_lock released by a thread which does not own it")
+            self._count = self._count - 1
+            if self._count == 0:
+                s = self.stat[self._owner.name]
+                s["hold"] = s["hold"] + time.time() - self._t_acquired
+                self._owner = None
+                self._cond.notify_all()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def show(self):
+        for name in sorted(self.stat.iterkeys()):
+            s = self.stat[name]
+            print "%s priority=%d n=%d waits=%d wait=%.4fs max=%.4fs hold=%.4fs" % (
+                name, s["priority"], s["n"], s["n_wait"], s["wait"], s["max_wait"],
+                s["hold"])
+
+
+class ccpdv2_locked_module(object):
+    ### basil module of ccpdv2_locked_dut, each call holds the lock
+    def __init__(self, module, lock):
+        object.__setattr__(self, "_module", module)
+        object.__setattr__(self, "_lock", lock)
+        object.__setattr__(self, "_methods", {})
+
+    def __getattr__(self, name):
+        f = self._methods.get(name)
+        if f is not None:
+            return f
+        attr = getattr(self._module, name)
+        if not callable(attr):
+            return attr
+        lock = self._lock
+
+        def locked(*args, **kwargs):
+            with lock:
+                return attr(*args, **kwargs)
+
+        self._methods[name] = locked
+        return locked
+
+    def __setattr__(self, name, value):
+        with self._lock:
+            setattr(self._module, name, value)
+
+    def __getitem__(self, key):
+        with self._lock:
+            return self._module[key]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._module[key] = value
+
+    def __str__(self):
+        with self._lock:
+            return str(self._module)
+
+
+class ccpdv2_locked_dut(ccpdv2_locked_module):
+    ### self.dut of Ccpdv2Fei4, dut[name] gives the locked module, the dut itself is in .dut
+    ### use "with c.lock:" around calls which must not be interleaved with other threads
+    def __init__(self, dut, lock=None):
+        if lock is None:
+            lock = ccpdv2_lock()
+        ccpdv2_locked_module.__init__(self, dut, lock)
+        object.__setattr__(self, "_modules", {})
+
+    @property
+    def dut(self):
+        return self._module
+
+    @property
+    def lock(self):
+        return self._lock
+
+    def __getitem__(self, name):
+        m = self._modules.get(name)
+        if m is None:
+            m = ccpdv2_locked_module(self._module[name], self._lock)
+            self._modules[name] = m
+        return m
+
+
+def _locked(f):
+    ### method of Ccpdv2Fei4 which runs as one transaction on self.dut
+    @functools.wraps(f)
+    def locked(self, *args, **kwargs):
+        with self.lock:
+            return f(self, *args, **kwargs)
+
+    return locked
+
+
+class ccpdv2_pipeline():
+    ### runs analysis/logging of scan points on one worker thread, in order
+    def __init__(self, depth=16):
+        self.q = Queue.Queue(maxsize=depth)
+        self.exc = None
+        self.t = threading.Thread(target=self._run)
+        self.t.daemon = True
+        self.t.start()
+
+    def _run(self):
+        while True:
+            func, args = self.q.get()
+            if func is None:
+                self.q.task_done()
+                break
+            try:
+                if self.exc is None:
+                    func(*args)
+            except:
+                self.exc = sys.exc_info()
+            self.q.task_done()
+
+    def put(self, func, *args):
+        ### blocks when the worker is depth points behind
+        self._raise()
+        self.q.put((func, args))
+
+    def join(self):
+        self.q.join()
+        self._raise()
+
+    def close(self):
+        self.q.put((None, None))
+        self.t.join()
+        self._raise()
+
+    def _raise(self):
+        if self.exc is not None:
+            exc = self.exc
+            self.exc = None
+            raise exc[0], exc[1], exc[2]
+
+
+class ccpdv2_readout():
+    ### drains sram into a preallocated buffer while the TDC is enabled
+    def __init__(self, sram, size=2**22, fifo_words=2**19):
+        self.sram = sram
+        self.buf = np.empty(size, np.uint32)
+        self.fifo_words = fifo_words  # a read of this size means the FIFO was full
+        self.interval = 0.005
+        self.n = 0
+        self.overflow = 0  # reads which found the sram FIFO full
+        self.dropped = 0  # words which did not fit into buf
+        self.n_read = 0
+        self._stop = threading.Event()
+        self.t = None
+
+    def start(self):
+        self.n = 0
+        self._stop.clear()
+        self.t = threading.Thread(target=self._run, name="readout")
+        self.t.daemon = True
+        self.t.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            if self.drain() == 0:
+                self._stop.wait(self.interval)
+
+    def drain(self):
+        data = self.sram.get_data()
+        self.n_read = self.n_read + 1
+        if len(data) >= self.fifo_words:
+            self.overflow = self.overflow + 1
+        n = min(len(data), len(self.buf) - self.n)
+        self.buf[self.n:self.n + n] = data[:n]
+        self.n = self.n + n
+        self.dropped = self.dropped + len(data) - n
+        return len(data)
+
+    def stop(self):
+        self._stop.set()
+        if self.t is not None:
+            self.t.join()
+            self.t = None
+
+    def get_data(self):
+        ### view of the words of this exposure, valid until the next start()
+        return self.buf[:self.n]
+
+    def reset_counters(self):
+        self.overflow = 0
+        self.dropped = 0
+        self.n_read = 0
+
+
+class ccpdv2_rawstore():
+    ### append-only uint32 file of data per scan point, <name>.dat + <name>.idx
+    IDX_DTYPE = np.dtype([("cmd", np.uint32), ("point", np.uint32),
+                          ("offset", np.uint64), ("size", np.uint32),
+                          ("x", np.float64)])
+
+    def __init__(self, name="scan_raw"):
+        self.datfile = "%s.dat" % name
+        self.idxfile = "%s.idx" % name
+        self._dat = open(self.datfile, "ab")
+        self._idx = open(self.idxfile, "ab")
+        self._offset = os.path.getsize(self.datfile) / 4
+        self.cmd = -1
+        idx = self.index()
+        if len(idx) != 0:
+            self.cmd = int(idx["cmd"][-1])
+        self._point = None
+
+    def new_command(self):
+        ### the id is taken with the first point, commands without data use none
+        self._point = None
+
+    def append(self, data, x=0.0):
+        if self._point is None:
+            self.cmd = self.cmd + 1
+            self._point = 0
+        data = np.asarray(data, np.uint32)
+        rec = np.array([(self.cmd, self._point, self._offset, len(data), x)],
+                       self.IDX_DTYPE)
+        data.tofile(self._dat)
+        self._dat.flush()
+        rec.tofile(self._idx)
+        self._idx.flush()
+        self._offset = self._offset + len(data)
+        self._point = self._point + 1
+        return self.cmd, self._point - 1
+
+    def index(self):
+        if os.path.getsize(self.idxfile) == 0:
+            return np.zeros(0, self.IDX_DTYPE)
+        return np.fromfile(self.idxfile, self.IDX_DTYPE)
+
+    def get(self, cmd, point=None):
+        ### data of one point, or a list of all points of cmd (memmap views)
+        idx = self.index()
+        idx = idx[idx["cmd"] == cmd]
+        if os.path.getsize(self.datfile) == 0:
+            m = np.zeros(0, np.uint32)
+        else:
+            m = np.memmap(self.datfile, np.uint32, mode="r")
+        if point is None:
+            return [m[int(i["offset"]):int(i["offset"]) + int(i["size"])] for i in idx]
+        i = idx[idx["point"] == point]
+        if len(i) == 0:
+            raise ValueError("no raw data for cmd %d point %d" % (cmd, point))
+        return m[int(i["offset"][0]):int(i["offset"][0]) + int(i["size"][0])]
+
+    def close(self):
+        self._dat.close()
+        self._idx.close()
 
 
 class ccpdv2_logging():
     def __init__(self):
         self.stdout = True
+        self.rawfile = "scan_raw"  # None=output_data2 writes str(data) into scan.txt
+        self.raw = None
+        self.flush_interval = 1.0  # s, background flush of the buffered lines
+        self.flush_size = 2**20  # bytes, flush at once above this
+        self._buf = []
+        self._size = 0
+        self._f = None
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._t = threading.Thread(target=self._run)
+        self._t.daemon = True
+        self._t.start()
+        atexit.register(self.close)
 
     def set_stdout(self, stdout):
         self.stdout = stdout
@@ -161,38 +718,76 @@ class ccpdv2_logging():
     def append(self, output):
         if self.stdout:
             print output
-        output = string.join(output.split("\n"), ",")
-        with open('scan.txt', 'a') as f:
-            f.write("%s\n" % output)
+        line = "%s\n" % ",".join(output.split("\n"))
+        with self._lock:
+            self._buf.append(line)
+            self._size = self._size + len(line)
+            if self._size > self.flush_size:
+                self.flush()
+
+    def flush(self):
+        with self._lock:
+            if len(self._buf) == 0:
+                return
+            if self._f is None:
+                self._f = open('scan.txt', 'a')
+            self._f.write("".join(self._buf))
+            self._f.flush()
+            self._buf = []
+            self._size = 0
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print "ccpdv2_logging.flush() %s" % str(e)
+
+    def close(self):
+        ### also called at exit, lines are never left in the buffer
+        self._stop.set()
+        if self._t.is_alive() and threading.current_thread() is not self._t:
+            self._t.join()
+        with self._lock:
+            self.flush()
+            if self._f is not None:
+                self._f.close()
+                self._f = None
 
     def archive(self):
-        with open('scan_archive.txt', 'a') as fo:
-            try:
-                with open("scan.txt") as f:
-                    for line in f:
-                        fo.write(line)
-                os.remove("scan.txt")
-            except:
-                pass
+        with self._lock:
+            self.flush()
+            if self._f is not None:
+                self._f.close()
+                self._f = None
+            with open('scan_archive.txt', 'a') as fo:
+                try:
+                    with open("scan.txt") as f:
+                        for line in f:
+                            fo.write(line)
+                    os.remove("scan.txt")
+                except:
+                    pass
 
             ######### ccpdv2 specific functions
     def output_command(self, cmd):
+        self.flush()
+        if self.raw is not None:
+            self.raw.new_command()
         self.append("#cmd %s %s" % (time.strftime("%y/%m/%d-%H:%M:%S"), cmd))
 
     def output_tdacs(self, tdacs, long=True):
 
         notsame = np.argwhere(tdacs != tdacs[5, 49])
+        output = ["#tdacall %d" % tdacs[5, 49]]
         if len(notsame) < 15:
-            output = "#tdacall %d" % tdacs[5, 49]
-            for n, i in enumerate(notsame):
-                output = "%s,tdac%d-%d %d" % (output, i[0], i[1],
-                                              tdacs[i[0], i[1]])
+            for i in notsame:
+                output.append(",tdac%d-%d %d" % (i[0], i[1], tdacs[i[0], i[1]]))
         else:
-            output = "#tdacall %d" % tdacs[5, 49]
             tmp = str(np.asarray(tdacs, int)).split("\n")
             for t in tmp:
-                output = "%s\n#%s" % (output, t)
-        self.append(output)
+                output.append("\n#%s" % t)
+        self.append("".join(output))
 
     def output_gl(self, BLRes, ThRes, VN, VN2, VNFB, VNFoll, VNLoad, VNDAC,
                   ThPRes, ThP, VNOut, VNComp, VNCompLd, VNCOut1, VNCOut2,
@@ -220,38 +815,61 @@ class ccpdv2_logging():
                     (repeat, period, delay, str(en)))
 
     def output_allconfig(self, allconfig):
-        output = "#allconfig "
+        output = ["#allconfig "]
         for k in sorted(allconfig.iterkeys()):
             v = allconfig[k]
             if k == "TDACS":
-                output = "%s\nTDACS %d" % (output, v[5, 49])
+                output.append("\nTDACS %d" % v[5, 49])
                 for i in np.argwhere(v != v[5, 49]):
-                    output = "%s,tdac%d-%d %d" % (output, i[0], i[1],
-                                                  v[i[0], i[1]])
+                    output.append(",tdac%d-%d %d" % (i[0], i[1], v[i[0], i[1]]))
             else:
-                output = "%s\n%s %s" % (output, k, str(v))
-        self.append(output)
+                output.append("\n%s %s" % (k, str(v)))
+        self.append("".join(output))
+
+    def output_snapshot(self, snap):
+        ### one line per scan point, scalar fields only
+        output = ["#snapshot"]
+        for k in SNAPSHOT_LOG_KEYS:
+            output.append(" %s %s," % (k, str(getattr(snap, k))))
+        self.append("".join(output)[:-1])
+
+    def output_set(self, params):
+        ### one line with the final value of each parameter of a set() or batch()
+        output = []
+        for k, v in params.iteritems():
+            if isinstance(v, np.ndarray):
+                v = "array%s" % str(v.shape)
+            elif isinstance(v, (list, tuple)) and len(v) > 4:
+                v = "list(%d)" % len(v)
+            output.append("%s %s" % (k, str(v)))
+        self.append("#set %s" % ", ".join(output))
 
     def output_configbits(self, bits):
-        output = "#config"
-        for o in bits:
-            output = "%s\n%s" % (output, o)
-        self.append(output)
+        self.append("\n".join(["#config"] + [str(o) for o in bits]))
 
     def output_globalbits(self, bits):
-        output = "#global"
-        for o in bits:
-            output = "%s\n%s" % (output, o)
-        self.append(output)
+        self.append("\n".join(["#global"] + [str(o) for o in bits]))
 
     def output_data(self, x, tdc, tdc_std, cnt, all_cnt):
         output = "%f %f %f %d %d" % (x, tdc, tdc_std, cnt, all_cnt)
         self.append(output)
 
     def output_data2(self, x, tdc, tdc_std, cnt, data):
-        output = "%f %f %f %d %s" % (x, tdc, tdc_std, cnt, str(data))
+        if self.rawfile is None:
+            output = "%f %f %f %d %s" % (x, tdc, tdc_std, cnt, str(data))
+        else:
+            if self.raw is None:
+                self.raw = ccpdv2_rawstore(self.rawfile)
+            raw_cmd, raw_point = self.raw.append(data, x)
+            output = "%f %f %f %d raw%d-%d" % (x, tdc, tdc_std, cnt, raw_cmd,
+                                               raw_point)
         self.append(output)
 
+    def get_raw(self, cmd, point=None):
+        if self.raw is None:
+            self.raw = ccpdv2_rawstore(self.rawfile)
+        return self.raw.get(cmd, point)
+
     def output_power(self, dat):
         output = "#Vdd %fV(%fmA), Vss %fV(%fmA), VGate %fV(%fmA), Vcasc %fV(%fmA)" % (
             dat["CCPD_Vdd_v"], dat["CCPD_Vdd_i"], dat["CCPD_Vssa_v"],
@@ -287,12 +905,46 @@ class ccpdv2_logging():
 class Ccpdv2Fei4():
     def init_with_fei4(
         self,
-        conf=r"D:\workspace\pybar\branches\development\pybar\configuration.yaml"
-    ):
-        self.rmg = RunManager(conf)
-        self.rmg.run_run(InitScan)
+        conf=r"D:\workspace\pybar\branches\development\pybar\configuration.yaml",
+        warm=False, yamlfile=None):
+        ### warm=True: InitScan is still needed by pybar, only the CCPD side is warm
+        ### yamlfile=None: the basil yaml given as dut in the pybar configuration
+        import logging
+        logging.getLogger().setLevel(logging.DEBUG)
+        import ccpdv2_fei4
+        self.rmg = ccpdv2_fei4.RunManager(conf)
+        if yamlfile is None:
+            yamlfile = self._fei4_yaml(conf)
+        self._bit_sig = self._bit_file(yamlfile)
+        state = None
+        if warm:
+            ### checked before InitScan, which would program the FPGA with a dut of its own
+            dut = self.rmg.conf["dut"]
+            self.dut = None if isinstance(dut, basestring) else dut
+            if self.dut is not None or yamlfile is not None:
+                state = self._warm_state(yamlfile)
+            if state is not None:
+                self.rmg.conf["dut"] = self.dut
+        self.rmg.run_run(ccpdv2_fei4.InitScan)
         self.dut = self.rmg.conf["dut"]
-        self.init()
+        self._init(yamlfile, state)
+
+    def _fei4_yaml(self, conf):
+        ### path of the basil yaml in the pybar configuration, None if it is not a file name
+        dut = self.rmg.conf.get("dut")
+        if not isinstance(dut, basestring):
+            return None
+        if not os.path.isabs(dut) and isinstance(conf, basestring):
+            dut = os.path.join(os.path.dirname(os.path.abspath(conf)), dut)
+        return dut
+
+    def init_with_emu(self, yamlfile="ccpdv2.yaml", latency=None, seed=0,
+                      warm=False):
+        ### software emulator of the board, no hardware needed
+        import ccpdv2_emu
+        self.dut = ccpdv2_emu.EmuDut(yamlfile, latency=latency, seed=seed)
+        self.dut.init()
+        self.init(yamlfile, warm=warm)
 
     def __init__(self):
         ### init logging
@@ -300,10 +952,45 @@ class Ccpdv2Fei4():
         self.dut = None
 
         self.smallhit = 100
+        self.tdc_only = 0  # 1=analyze() counts only TDC words (tdc_rx2, CCPD_TDC), 0=all words
         self.dataformat = 0  # bit0=save h5 file, bit1=save tdc as text, bit4=save to existing file
         self.s = None
         self.hv = 5.0
         self.exp = 0.0
+        ### 1=compare CCPD_GLOBAL/CCPD_CONFIG with the shift register output and retry.
+        ### off by default: both share CCPD_SHIFT_IN/CCPD_SHIFT_OUT in ccpdv2.v, the readback
+        ### is only meaningful if the chip gives back the register which was shifted
+        self.write_verify = False
+        self.write_retry = 3
+        self.waiter = ccpdv2_waiter()
+        self.lock = ccpdv2_lock()  # of all self.dut accesses, see ccpdv2_locked_dut
+        self.settle = ccpdv2_settle()
+        self.settle_dac = 1  # 1=put_th/put_bl wait until the output settled
+        self._settling = {}  # name: time of the write not yet waited for
+        self.readout = None
+        self.decoder = ccpdv2_decoder()
+        self.readout_size = 2**22  # words kept per exposure of measure(exp>0.0001)
+        self.noise_search = "bisect"  # find_noise(): bisect, sigmoid or legacy
+        self.noise_resolution = 0.001
+        self.fei4_session = None
+        self.fei4_regions = dict(FEI4_REGIONS)  # name: [[row_start,row_stop],[col_start,col_stop]]
+        self.fei4_cache_size = 64
+        self._fei4_cache = OrderedDict()
+        self._runindex = {}
+        self.pipeline = 0  # 1=overlap next point with analysis/logging in scan_th,spectrum,find_th
+        self._p = None
+        self._hw = {}  # shadow of what was last written to the hardware
+        self.statefile = "ccpdv2_state.pkl"  # shadow for init(warm=True), None=not saved
+        self._state_saved = False
+        self._state_dirty = False  # put_tdac/put_config changed the chip, saved at the end of the command
+        self._bit_sig = None
+        self._monitor = {}  # name: (time, voltage, current) of the last GPAC readings
+        self.snapshot_log = 0  # 1=log a snapshot with each scan point
+        self.on_data = None  # function(data) called with the raw words of each measure()
+        self._batch = None  # (flgs, params) collected by set() inside batch()
+        self.monitor = None  # ccpdv2_monitor, see start_monitor()
+        self.t_measure = (0.0, 0.0)  # start and end of the last measure()
+        self.snapshot_age = None  # max age (s) of monitors in the logged snapshot, None=no reads
 
         ### initial params
         self.BLRes = 1
@@ -352,23 +1039,65 @@ class Ccpdv2Fei4():
 
     def init(
         self,
-        yamlfile=r"D:\workspace\pybar\branches\development\pybar\ccpdv2.yaml"):
+        yamlfile=r"D:\workspace\pybar\branches\development\pybar\ccpdv2.yaml",
+        warm=False):
+        ### warm=True: if the board still has the state saved in statefile, only
+        ### differences are written (no module reset, no TDAC reload, no power cycle)
+        self._bit_sig = self._bit_file(yamlfile)
+        state = None
+        if warm:
+            state = self._warm_state(yamlfile)
+        self._init(yamlfile, state)
+
+    def _warm_state(self, yamlfile):
+        ### saved state if the board still has it, None=cold start. nothing is written,
+        ### a dut opened here does not download the bit file
+        state = self._load_state()
+        if state is None:
+            return None
         if self.dut == None:
+            from basil import dut
+            self.dut = dut.Dut(self._warm_conf(yamlfile))
+            self.dut.init()
+        if not self._check_state(state):
+            return None
+        return state
+
+    def _init(self, yamlfile, state):
+        ### state=None: reset and write everything, otherwise the state checked by _warm_state()
+        if self.dut == None:
+            from basil import dut
             self.dut = dut.Dut(yamlfile)
             self.dut.init()
+        if not isinstance(self.dut, ccpdv2_locked_dut):
+            self.dut = ccpdv2_locked_dut(self.dut, self.lock)
+            self.readout = None
 
-        # reset basil modules
-        self.dut['CCPD_GLOBAL'].reset()
-        self.dut['CCPD_GLOBAL'].set_size(120)
-        self.dut['CCPD_GLOBAL'].set_repeat(1)
-        self.dut['CCPD_CONFIG'].reset()
-        self.dut['CCPD_CONFIG'].set_repeat(1)
-        self.dut['CCPD_CONFIG'].set_size(432)
-        self.dut['CCPD_TDC'].reset()
         # config in memory
         self._tdacs = np.ones([24, 60]) * -1
         self._pixels = []
+        self._pixel_mask = np.zeros([24, 60], bool)
         self.debug = 0
+        self._monitor = {}
+        self._settling = {}
+        if state is not None:
+            self._restore_state(state)
+            print "Ccpdv2.init() warm start from %s" % self.statefile
+        else:
+            # reset basil modules
+            self.dut['CCPD_GLOBAL'].reset()
+            self.dut['CCPD_GLOBAL'].set_size(120)
+            self.dut['CCPD_GLOBAL'].set_repeat(1)
+            self.dut['CCPD_CONFIG'].reset()
+            self.dut['CCPD_CONFIG'].set_repeat(1)
+            self.dut['CCPD_CONFIG'].set_size(432)
+            self.dut['CCPD_TDC'].reset()
+            # length of one start() in SPI_CLK cycles, 0=repeat forever
+            self._cycles = {"CCPD_GLOBAL": 120, "CCPD_CONFIG": 432, "CCPD_TDCGATE_PULSE": 0}
+            # modules were reset, write everything once
+            self._hw = {}
+            # statefile of an earlier session is removed with the first write
+            self._state_saved = self.statefile is not None
 
         self._set(flgs={
             "hv": 0,
@@ -385,15 +1114,166 @@ class Ccpdv2Fei4():
             "mode": 1
         })
 
+    def _bit_file(self, yamlfile):
+        ### (path, size, mtime) of the bit file in the basil yaml, None if there is no yaml
+        if yamlfile is None or not os.path.exists(yamlfile):
+            return None
+        conf = _load_yaml(yamlfile)
+        for tl in conf["transfer_layer"]:
+            if "bit_file" in tl:
+                path = os.path.join(os.path.dirname(os.path.abspath(yamlfile)),
+                                    tl["bit_file"])
+                if os.path.exists(path):
+                    return (os.path.abspath(path), os.path.getsize(path),
+                            os.path.getmtime(path))
+                return (os.path.abspath(path), None, None)
+        return None
+
+    def _warm_conf(self, yamlfile):
+        ### basil conf which does not download the bit file if the FPGA is already loaded
+        conf = _load_yaml(yamlfile)
+        for tl in conf["transfer_layer"]:
+            if tl["type"] == "SiUsb":
+                tl.setdefault("init", {})["avoid_download"] = True
+                if "bit_file" in tl:
+                    tl["bit_file"] = os.path.join(
+                        os.path.dirname(os.path.abspath(yamlfile)), tl["bit_file"])
+        return conf
+
+    def _save_state(self):
+        if self.statefile is None or self.dut is None:
+            return
+        state = {
+            "version": STATE_VERSION,
+            "t": time.time(),
+            "hw": self._hw,
+            "cycles": self._cycles,
+            "tdacs": self._tdacs,
+            "pixels": self._pixels,
+            "config_bits": self._get_config_bits(),
+            "bit_file": self._bit_sig,
+        }
+        tmp = "%s.tmp" % self.statefile
+        with open(tmp, "wb") as f:
+            cPickle.dump(state, f, 2)
+        if os.path.exists(self.statefile):
+            os.remove(self.statefile)
+        os.rename(tmp, self.statefile)
+        self._state_saved = True
+        self._state_dirty = False
+
+    def _flush_state(self):
+        if self._state_dirty:
+            self._save_state()
+
+    def _invalidate_state(self):
+        ### hardware is about to change, a crash from now on must not leave a valid statefile
+        if self._state_saved:
+            self._state_saved = False
+            if os.path.exists(self.statefile):
+                os.remove(self.statefile)
+
+    def _load_state(self):
+        if self.statefile is None or not os.path.exists(self.statefile):
+            return None
+        try:
+            with open(self.statefile, "rb") as f:
+                state = cPickle.load(f)
+        except Exception as e:
+            print "Ccpdv2.init() cannot read %s %s" % (self.statefile, str(e))
+            return None
+        if state.get("version") != STATE_VERSION:
+            return None
+        if state.get("bit_file") != self._bit_sig:
+            print "Ccpdv2.init() bit file changed, cold start"
+            return None
+        return state
+
+    def _fingerprint(self):
+        ### registers which are lost when the FPGA is programmed or the board is reset
+        ret = {}
+        for name in ["CCPD_INJ_PULSE", "CCPD_TDCGATE_PULSE"]:
+            m = self.dut[name]
+            ret[name] = (m.get_delay(), m.get_width(), m.get_repeat(), m.get_en())
+        for name in ["CCPD_GLOBAL", "CCPD_CONFIG"]:
+            ret[name] = self.dut[name].get_size()
+        ret["RX_data"] = str(self.dut["rx"].get_data())
+        return ret
+
+    def _check_state(self, state):
+        ### True if the fingerprint of the board matches the saved shadow
+        hw = state["hw"]
+        expect = {"CCPD_GLOBAL": state["cycles"]["CCPD_GLOBAL"],
+                  "CCPD_CONFIG": state["cycles"]["CCPD_CONFIG"],
+                  "RX_data": hw.get("RX_data")}
+        for name in ["CCPD_INJ_PULSE", "CCPD_TDCGATE_PULSE"]:
+            expect[name] = hw.get(name)
+        now = self._fingerprint()
+        for k, v in expect.iteritems():
+            if v is None or now[k] != v:
+                print "Ccpdv2.init() %s differs from %s, cold start" % (k, self.statefile)
+                return False
+        if hw.get("CCPD_Vdd_en") == True:
+            ### board was not powered off
+            v = self.dut["CCPD_Vdd"].get_voltage(unit="V")
+            if v < 0.5 * hw["CCPD_Vdd"]:
+                print "Ccpdv2.init() Vdd is %fV, cold start" % v
+                return False
+        return True
+
+    def _restore_state(self, state):
+        hw = state["hw"]
+        ### GPAC outputs keep their values, only unchanged ones are skipped by _put_voltage().
+        ### the HV supply is a separate instrument and is written again
+        self._hw = dict([(k, v) for k, v in hw.iteritems() if k != "HV"])
+        self._cycles = dict(state["cycles"])
+        self._tdacs = np.copy(state["tdacs"])
+        self._pixel_mask = pixels2mask(state["pixels"])
+        self._pixels = mask2pixels(self._pixel_mask)
+        self._put_config_bits(state["config_bits"])
+        self._state_saved = True
+
     def set(self, **kwargs):
-        self.l.output_command("set")
         flgs = self._parse(kwargs)
+        if self._batch is not None:
+            for k, v in flgs.iteritems():
+                self._batch[0][k] = self._batch[0][k] | v
+            self._batch[1].update(kwargs)
+            return
+        self._commit(flgs, kwargs)
+
+    @contextlib.contextmanager
+    def batch(self):
+        ### with c.batch(): c.set(th=0.9); c.set(VNDAC=10) -> one _set() and one log record at the end
+        if self._batch is not None:
+            ### nested batch is part of the outer one
+            yield
+            return
+        saved = dict([(a, copy.deepcopy(getattr(self, a)))
+                      for a in set([p[0] for p in PARAMS.itervalues()] + ["tdacs"])])
+        self._batch = (dict([(f, 0) for f in SET_FLAGS]), OrderedDict())
+        try:
+            yield
+        except:
+            ### nothing was written, roll back the parameters
+            for a, v in saved.iteritems():
+                setattr(self, a, v)
+            self._batch = None
+            raise
+        flgs, params = self._batch
+        self._batch = None
+        if len(params) != 0:
+            self._commit(flgs, params)
+
+    def _commit(self, flgs, params):
+        self.l.output_command("set")
+        self.l.output_set(params)
         self._set(flgs)
 
     def _set(self, flgs):
         if flgs["pw"] != 0:
-            self.put_power_on(self.vdd, self.vss, self.vgate, self.vcasc)
-            ret = self.get_power()
+            rails = self.put_power_on(self.vdd, self.vss, self.vgate, self.vcasc)
+            ret = self.get_power(rails)
             self.l.output_power(ret)
         if flgs["inj"] != 0:
             self.put_inj(high=self.inj_high, low=self.inj_low)
@@ -476,72 +1356,222 @@ class Ccpdv2Fei4():
         if flgs["mode"] != 0:
             self.put_mode(mode=self.mode)
             self.l.output_mode(mode=self.mode)
+        self._save_state()
 
     def analyze(self, data):
-        data_only = np.bitwise_and(data, 0xfff)
-        no_noise = data_only[data_only > self.smallhit]
+        tdc = self.decoder.tdc(data, self.tdc_only)
+        no_noise = tdc[tdc > self.smallhit]
         return np.average(no_noise), np.std(no_noise), len(no_noise), len(
-            data_only), no_noise
+            tdc), no_noise
+
+    def _analyze_and_log(self, x, data, snap=None):
+        tdc, tdc_std, cnt, cnt_all, data = self.analyze(data)
+        if snap is not None:
+            self.l.output_snapshot(snap)
+        ### save data
+        if (0x2 & self.dataformat) != 0:
+            self.l.output_data2(x, tdc, tdc_std, cnt, data)
+        else:
+            self.l.output_data(x, tdc, tdc_std, cnt, cnt_all)
+
+    def _pipe(self):
+        if self._p is None:
+            self._p = ccpdv2_pipeline()
+        return self._p
+
+    def _pipe_close(self):
+        ### wait for the worker, re-raise its error in this thread
+        if self._p is not None:
+            p = self._p
+            self._p = None
+            p.close()
 
     def scan_th(self, start=1.1, stop=0.8, step=-0.01):
         self.l.output_command("scan_th %f %f %f" % (start, stop, step))
-        for self.th in np.arange(start, stop, step):
-            self.put_th(self.th)
-            th = self.get_th()
-            data = self.measure(self.exp)
-            ### analyze a bit
-            tdc, tdc_std, cnt, cnt_all, data = self.analyze(data)
-            ### save data
-            if (0x2 & self.dataformat) != 0:
-                self.l.output_data2(th, tdc, tdc_std, cnt, data)
-            else:
-                self.l.output_data(th, tdc, tdc_std, cnt, cnt_all)
+        th_list = np.arange(start, stop, step)
+        if self.pipeline == 0:
+            for self.th in th_list:
+                self.put_th(self.th)
+                th = self.get_th()
+                data = self.measure(self.exp, view=True)
+                self._analyze_and_log(th, data, self._point_snapshot())
+            return
+        ### next th settles while the worker analyzes the last point
+        p = self._pipe()
+        try:
+            if len(th_list) != 0:
+                self.put_th(th_list[0])
+            for i in range(len(th_list)):
+                self.th = th_list[i]
+                if self.settle_dac:
+                    self.wait_settled(["CCPD_Th"])
+                th = self.get_th()
+                data = self.measure(self.exp)
+                ### state of this point, before the next th is written
+                snap = self._point_snapshot()
+                if i + 1 < len(th_list):
+                    self.put_th(th_list[i + 1], settle=False)
+                p.put(self._analyze_and_log, th, data, snap)
+        finally:
+            self._pipe_close()
 
     def set_tdac_again(self):
         self.l.output_command("set_tdac_again")
         self.put_tdac(self.tdacs, True)
+        self._flush_state()
 
     def spectrum(self, n=1):
         self.l.output_command("spectrum %d" % n)
-        for i in range(n):
-            data = self.measure(self.exp)
-            ## analyze a bit
-            tdc, tdc_std, cnt, cnt_all, data = self.analyze(data)
-            ### save data
-            if (0x2 & self.dataformat) != 0:
-                self.l.output_data2(i, tdc, tdc_std, cnt, data)
-            else:
-                self.l.output_data(i, tdc, tdc_std, cnt, cnt_all)
+        if self.pipeline == 0:
+            for i in range(n):
+                data = self.measure(self.exp, view=True)
+                self._analyze_and_log(i, data, self._point_snapshot())
+            return
+        p = self._pipe()
+        try:
+            for i in range(n):
+                data = self.measure(self.exp)
+                p.put(self._analyze_and_log, i, data, self._point_snapshot())
+        finally:
+            self._pipe_close()
 
     def find_th(self, start=1.3, stop=0.6, step=-0.05):
         self.l.output_command("find_th %f" % step)
-        i = 0
-        th_list = np.arange(start, stop, step)
-        while len(th_list) != i:
-            self.th = th_list[i]
-            self.put_th(self.th)
-            th = self.get_th()
-            data = self.measure(self.exp)
-            tdc, tdc_std, cnt, cnt_all, data = self.analyze(data)
+        try:
+            i = 0
+            th_list = np.arange(start, stop, step)
+            while len(th_list) != i:
+                self.th = th_list[i]
+                self.put_th(self.th)
+                th = self.get_th()
+                data = self.measure(self.exp, view=True)
+                tdc, tdc_std, cnt, cnt_all, data = self.analyze(data)
+                snap = self._point_snapshot()
+                ### next step depends on cnt, only logging can go to the worker
+                if self.pipeline == 0:
+                    if snap is not None:
+                        self.l.output_snapshot(snap)
+                    self.l.output_data(th, tdc, tdc_std, cnt, cnt_all)
+                else:
+                    if snap is not None:
+                        self._pipe().put(self.l.output_snapshot, snap)
+                    self._pipe().put(self.l.output_data, th, tdc, tdc_std, cnt, cnt_all)
+                if abs(step) > abs(-0.05 * 0.99) and cnt > 5:
+                    print "debug change step to 0.005"
+                    step = -0.005
+                    th_list = np.arange(th - 9 * step, stop, step)
+                    i = 0
+                elif abs(step) > abs(-0.005 * 0.99) and cnt > self.repeat * 0.5:
+                    print "debug change step to 0.001"
+                    step = -0.001
+                    th_list = np.arange(th - 6 * step, stop, step)
+                    i = 0
+                elif abs(step) > abs(-0.001 * 0.99) and cnt > self.repeat * 0.6:
+                    break
+                else:
+                    i = i + 1
+        finally:
+            self._pipe_close()
+
+    def find_noise(self, start=1.1, stop=0.6, step=-0.05, exp=0.01, method=None):
+        ### highest th with more than 5 hits in 10*exp, method=bisect,sigmoid,legacy or a function
+        self.l.output_command("find_noise %f" % step)
+        if method is None:
+            method = self.noise_search
+        self._noise_stat = [0, 0.0]
+        if method == "legacy":
+            th = self._find_noise_legacy(start, stop, step, exp)
+        else:
+            th = self._find_noise_edge(start, stop, step, exp, method)
+        self.l.append("#noise_search %s, n_meas %d, exp_total %f" %
+                      (getattr(method, "__name__", method), self._noise_stat[0],
+                       self._noise_stat[1]))
+        return th
+
+    def _noise_probe(self, th, exp):
+        self.th = th
+        self.put_th(th=self.th)
+        data = self.measure(exp, view=True)
+        tdc, tdc_std, cnt, cnt_all, data = self.analyze(data)
+        snap = self._point_snapshot()
+        if snap is not None:
+            self.l.output_snapshot(snap)
+        if (self.dataformat & 0x2) != 0:
+            self.l.output_data2(th, tdc, tdc_std, cnt, data)
+        else:
             self.l.output_data(th, tdc, tdc_std, cnt, cnt_all)
-            if abs(step) > abs(-0.05 * 0.99) and cnt > 5:
-                print "debug change step to 0.005"
-                step = -0.005
-                th_list = np.arange(th - 9 * step, stop, step)
-                i = 0
-            elif abs(step) > abs(-0.005 * 0.99) and cnt > self.repeat * 0.5:
-                print "debug change step to 0.001"
-                step = -0.001
-                th_list = np.arange(th - 6 * step, stop, step)
-                i = 0
-            elif abs(step) > abs(-0.001 * 0.99) and cnt > self.repeat * 0.6:
-                break
+        self._noise_stat[0] = self._noise_stat[0] + 1
+        self._noise_stat[1] = self._noise_stat[1] + exp
+        return cnt_all
+
+    def _find_noise_edge(self, start, stop, step, exp, method, cnt_th=5):
+        ### search on a grid of noise_resolution, hit(n) is monotonic: lower th, more noise
+        self.exp = exp
+        res = self.noise_resolution
+        rates = {}
+        self._noise_rate_max = 100 * cnt_th / (exp * 10)
+
+        def hit(n):
+            if n not in rates:
+                ### a hit with exp is a hit with 10*exp. try exp first only if a hit is expected
+                r = _noise_rate_fit(rates, n, self._noise_rate_max)
+                if r is None or r * exp > 2 * cnt_th:
+                    cnt = self._noise_probe(n * res, exp)
+                    if cnt > cnt_th:
+                        rates[n] = float(cnt) / exp
+                        return True
+                rates[n] = float(self._noise_probe(n * res, exp * 10)) / (exp * 10)
+            return rates[n] * exp * 10 > cnt_th
+
+        hi = int(round(start / res))
+        lo = int(round(stop / res))
+        back = int(round(abs(step) * 10 / res))
+        top = int(1.999 / res)
+        while hit(hi):
+            if hi >= top:
+                print "Ccpdv2.find_noise() noisy at th=%f" % (hi * res)
+                return hi * res
+            lo = hi
+            hi = min(hi + back, top)
+        if not hit(lo):
+            print "Ccpdv2.find_noise() no noise between th=%f and %f" % (lo * res, hi * res)
+            return None
+        if callable(method):
+            n = method(hit, rates, lo, hi)
+        else:
+            n = getattr(self, "_edge_%s" % method)(hit, rates, lo, hi)
+        th = n * res
+        self.l.append("#noise th %f" % th)
+        return th
+
+    def _edge_bisect(self, hit, rates, lo, hi):
+        while hi - lo > 1:
+            mid = (hi + lo) / 2
+            if hit(mid):
+                lo = mid
             else:
-                i = i + 1
+                hi = mid
+        return lo
+
+    def _edge_sigmoid(self, hit, rates, lo, hi, cnt_th=5):
+        ### bisect until the tail of the s-curve is measured, then go to the point
+        ### where the fit crosses cnt_th, kept inside the middle 3/4 of the interval
+        target = cnt_th / (self.exp * 10)
+        while hi - lo > 1:
+            mid = (hi + lo) / 2
+            p = _noise_rate_fit(rates, None, self._noise_rate_max)
+            if p is not None:
+                a, b = p
+                d = max((hi - lo) / 8, 1)
+                mid = min(max(int(round((np.log(target) - b) / a)), lo + d), hi - d)
+            if hit(mid):
+                lo = mid
+            else:
+                hi = mid
+        return lo
 
-    def find_noise(self, start=1.1, stop=0.6, step=-0.05, exp=0.01):
-        self.l.output_command("find_noise %f" % step)
-        ### init
+    def _find_noise_legacy(self, start, stop, step, exp):
+        ### first/again/2midium/3exp/4small state machine
         th_list = np.arange(start, stop, step)
         self.exp = exp
         i = 0
@@ -549,16 +1579,8 @@ class Ccpdv2Fei4():
         while len(th_list) != i:
             if self.debug == 1:
                 print i, th_list[0:10]
-            self.th = th_list[i]
-            self.put_th(th=self.th)
-            #th=self.get_th()
-            th = self.th
-            data = self.measure(self.exp)
-            tdc, tdc_std, cnt, cnt_all, data = self.analyze(data)
-            if (self.dataformat & 0x2) != 0:
-                self.l.output_data2(th, tdc, tdc_std, cnt, data)
-            else:
-                self.l.output_data(th, tdc, tdc_std, cnt, cnt_all)
+            th = th_list[i]
+            cnt_all = self._noise_probe(th, self.exp)
             ### find next step
             if cnt_all != 0 and (state == "first" or state ==
                                  "again") and i == 0:
@@ -629,7 +1651,7 @@ class Ccpdv2Fei4():
                             enLR=self.enLR)
             self.l.output_en(self.pixels, [])
             ## measure
-            data = self.measure(self.exp)
+            data = self.measure(self.exp, view=True)
             tdc, tdc_std, cnt, cnt_all, data = self.analyze(data)
             ### save data
             if (0x2 & self.dataformat) != 0:
@@ -647,13 +1669,82 @@ class Ccpdv2Fei4():
                 break
             elif t == 15:
                 self.l.append("#found tdac out of range")
+        self._flush_state()
+
+    def tune_tdac(self, cnt_th=5, exp=0.1):
+        ### per pixel binary search of the largest tdac without noise (more than cnt_th hits)
+        ### for all pixels at once. a pixel which is noisy already at 0 gets 0
+        self.l.output_command("tune_tdac %d %f" % (cnt_th, exp))
+        self.exp = exp
+        ### the pixels of set(pix=...), not the group last written by _tune_measure()
+        mask = pixels2mask(self.pixels)
+        if not np.any(mask):
+            mask[:, :] = True
+        self._tune_stat = [0, 0.0]
+        t = np.where(mask, 0, self.tdacs)
+        ### columns with the same rows form one product set rows x cols,
+        ### which _config_monitor selects without monitoring other pixels
+        groups = {}
+        for col in range(60):
+            rows = tuple(np.nonzero(mask[:, col])[0])
+            if len(rows) != 0:
+                groups.setdefault(rows, []).append(col)
+        try:
+            for bit in [8, 4, 2, 1]:
+                cand = np.where(mask, t + bit, t)
+                self.put_tdac(cand)
+                noisy = np.zeros([24, 60], bool)
+                n0 = self._tune_stat[0]
+                for rows, cols in sorted(groups.iteritems()):
+                    self._tune_group(np.array(rows), np.array(cols), cnt_th, noisy)
+                t = np.where(mask & ~noisy, cand, t)
+                self.l.append("#tune_tdac bit %d, n_meas %d, noisy %d" %
+                              (bit, self._tune_stat[0] - n0, np.sum(noisy & mask)))
+            self.tdacs = t
+        finally:
+            ### after an error the old tdacs and pixels are written back
+            self.put_tdac(self.tdacs)
+            self.put_config(self.pixels, en=self.en, ao=self.ao, enLR=self.enLR)
+            self._flush_state()
+        self.l.output_tdacs(self.tdacs)
+        self.l.output_en(self.pixels, [])
+        self.l.append("#tune_tdac n_meas %d, exp_total %f" % tuple(self._tune_stat))
+        return self.tdacs
+
+    def _tune_measure(self, rows, cols, cnt_th):
+        group = np.zeros([24, 60], bool)
+        group[np.ix_(rows, cols)] = True
+        self.put_config(group, en=self.en, ao=self.ao, enLR=-1)
+        data = self.measure(self.exp, view=True)
+        tdc, tdc_std, cnt, cnt_all, data = self.analyze(data)
+        self._tune_stat[0] = self._tune_stat[0] + 1
+        self._tune_stat[1] = self._tune_stat[1] + self.exp
+        return cnt_all > cnt_th
+
+    def _tune_group(self, rows, cols, cnt_th, noisy, known_noisy=False):
+        ### binary splitting: a quiet group clears all its pixels at once.
+        ### cnt_all of a group is the sum of its pixels, so a quiet half says
+        ### nothing about the other half, only a measured group is known_noisy
+        if not known_noisy and not self._tune_measure(rows, cols, cnt_th):
+            return
+        if len(rows) * len(cols) == 1:
+            noisy[rows[0], cols[0]] = True
+            return
+        if len(cols) > 1:
+            a, b = (rows, cols[:len(cols) / 2]), (rows, cols[len(cols) / 2:])
+        else:
+            a, b = (rows[:len(rows) / 2], cols), (rows[len(rows) / 2:], cols)
+        if self._tune_measure(a[0], a[1], cnt_th):
+            self._tune_group(a[0], a[1], cnt_th, noisy, known_noisy=True)
+        self._tune_group(b[0], b[1], cnt_th, noisy)
 
     def clear(self):
         self.l.archive()
 
-    def show(self):
+    def show(self, max_age=0):
         self.l.output_command("show")
-        allconfig = self.get_allconfig()
+        allconfig = self.snapshot(max_age=max_age)._asdict()
+        del allconfig["t"], allconfig["t_monitor"]
         allconfig["inj_high"] = self.inj_high
         allconfig["inj_low"] = self.inj_low
         self.l.output_allconfig(allconfig)
@@ -666,215 +1757,82 @@ class Ccpdv2Fei4():
         self.l.output_globalbits(bits)
 
     def _parse(self, kwargs):
-        flgs = {
-            "hv": 0,
-            "gl": 0,
-            "t": 0,
-            "cnf": 0,
-            "fg": 0,
-            "pl": 0,
-            "inj": 0,
-            "th": 0,
-            "bl": 0,
-            "pcbth": 0,
-            "pw": 0,
-            "fg": 0,
-            "mode": 0
-        }
+        flgs = dict([(f, 0) for f in SET_FLAGS])
         for k, v in kwargs.iteritems():
-            ### global
-            if k == "EnPosFB":
-                self.EnPosFB = v
-                flgs["gl"] = 1
-            elif k == "EnPullUp":
-                self.EnPullUp = v
-                flgs["gl"] = 1
-            elif k == "VNBias":
-                self.VNBias = v
-                flgs["gl"] = 1
-            elif k == "VPFoll":
-                self.VPFoll = v
-                flgs["gl"] = 1
-            elif k == "VNBuffer":
-                self.VNBuffer = v
-                flgs["gl"] = 1
-            elif k == "VNDAC":
-                self.VNDAC = v
-                flgs["gl"] = 1
-            elif k == "VNCOut1":
-                self.VNCOut1 = v
-                flgs["gl"] = 1
-            elif k == "VNCOut2":
-                self.VNCOut2 = v
-                flgs["gl"] = 1
-            elif k == "VNCOut3":
-                self.VNCOut3 = v
-                flgs["gl"] = 1
-            elif k == "VNComp":
-                self.VNComp = v
-                flgs["gl"] = 1
-            elif k == "VNCompLd":
-                self.VNCompLd = v
-                flgs["gl"] = 1
-            elif k == "VNOut":
-                self.VNOut = v
-                flgs["gl"] = 1
-            elif k == "ThP":
-                self.ThP = v
-                flgs["gl"] = 1
-            elif k == "ThPRes":
-                self.ThPRes = v
-                flgs["gl"] = 1
-            elif k == "VNLoad":
-                self.VNLoad = v
-                flgs["gl"] = 1
-            elif k == "VNFoll":
-                self.VNFoll = v
-                flgs["gl"] = 1
-            elif k == "VNFB":
-                self.VNFB = v
-                flgs["gl"] = 1
-            elif k == "VN2":
-                self.VN2 = v
-                flgs["gl"] = 1
-            elif k == "VN":
-                self.VN = v
-                flgs["gl"] = 1
-            elif k == "BLRes":
-                self.BLRes = v
-                flgs["gl"] = 1
-            elif k == "ThRes":
-                self.ThRes = v
-                flgs["gl"] = 1
-            ### other parameters
-            elif k == "exp":
-                self.exp = v
-            elif k == "smallhit":
-                self.smallhit = v
-            elif k == "dataformat":
-                self.dataformat = v
-            #### config
-            elif k == "pixels" or k == "pix":
-                if isinstance(v, type("")):
-                    if v == "all":
-                        self.pixels = []
-                        for i in range(60):
-                            for j in range(24):
-                                self.pixels.append([j, i])
-                    elif v == "std":
-                        self.pixels = []
-                        for i in range(12, 48):
-                            for j in range(24):
-                                self.pixels.append([j, i])
-                    elif v == "none":
-                        self.pixels = []
-                elif isinstance(v[0], int):
-                    self.pixels = [v]
-                else:
-                    self.pixels = v
-                flgs["cnf"] = 1
-            elif k == "enLR":
-                self.enLR = v
-                flgs["cnf"] = 1
-            elif k == "ao":
-                self.ao = v
-                flgs["cnf"] = 1
-            elif k == "en":
-                self.en = v
-                flgs["cnf"] = 1
-            #### pulser
-            elif k == "inj_en":
-                self.inj_en = v
-                flgs["pl"] = 1
-            elif k == "delay":
-                self.delay = v
-                flgs["pl"] = 1
-            elif k == "period":
-                self.period = v
-                flgs["pl"] = 1
-            elif k == "repeat":
-                self.repeat = v
-                flgs["pl"] = 1
-            #### tdacs
+            if k in PARAMS:
+                attr, flg = PARAMS[k]
+                if attr == "pixels":
+                    v = self._parse_pixels(v)
+                setattr(self, attr, v)
+                if flg is not None:
+                    flgs[flg] = 1
             elif "tdac" in k:
+                self._parse_tdac(k, v, kwargs)
                 flgs["t"] = 1
                 flgs["cnf"] = 1
-                if isinstance(v, type("")):
-                    tmp = np.loadtxt(v)
-                    for t in tmp:
-                        self.tdacs[t[0], t[1]] = t[2]
-                elif isinstance(v, type(self.tdacs)):
-                    self.tdacs = v
-                elif k[4:] == "all":
-                    self.tdacs = self.tdacs * 0 + v
-                    if kwargs.has_key("tdacmonpix"):
-                        if kwargs.has_key("pixels"):
-                            col = kwargs["pixels"][0][1]
-                            row = kwargs["pixels"][0][0]
-                        else:
-                            col = self.pixels[0][1]
-                            row = self.pixels[0][0]
-                        self.tdacs[row, col] = kwargs["tdacmonpix"]
-                elif k[4:] == "monpix":
-                    if not kwargs.has_key("tdacall"):
-                        if kwargs.has_key("pixels"):
-                            col = kwargs["pixels"][0][1]
-                            row = kwargs["pixels"][0][0]
-                        else:
-                            col = self.pixels[0][1]
-                            row = self.pixels[0][0]
-                        self.tdacs[row, col] = v
-                else:
-                    x, y = k[4:].split("_")
-                    self.tdacs[string.atoi(x), string.atoi(y)] = v
-            ### inj th bl
-            elif k == 'pcbth':
-                self.pcbth = v
-                flgs['pcbth'] = 1
-            elif k == 'bl' or k == 'BL':
-                self.bl = v
-                flgs['bl'] = 1
-            elif k == 'th':
-                self.th = v
-                flgs['th'] = 1
-            elif k == 'inj_high':
-                self.inj_high = v
-                flgs['inj'] = 1
-            elif k == 'inj_low':
-                self.inj_low = v
-                flgs['inj'] = 1
-            elif k == 'hv':
-                self.hv = v
-                flgs['hv'] = 1
-            elif k == 'vdd':
-                self.vdd = v
-                flgs['pw'] = 1
-            elif k == 'vss':
-                self.vss = v
-                flgs['pw'] = 1
-            elif k == 'vcasc':
-                self.vcasc = v
-                flgs['pw'] = 1
-            elif k == 'vgate':
-                self.vgate = v
-                flgs['pw'] = 1
-            elif k == 'mode':
-                self.mode = v
-                flgs['mode'] = 1
             else:
                 print "invalid param"
                 raise ValueError("invalid param %s" % k)
         return flgs
 
+    def _parse_pixels(self, v):
+        if isinstance(v, type("")):
+            mask = np.zeros([24, 60], bool)
+            if v == "all":
+                mask[:, :] = True
+            elif v == "std":
+                mask[:, 12:48] = True
+            return mask2pixels(mask)
+        elif isinstance(v, np.ndarray) and v.dtype == bool:
+            return mask2pixels(v)
+        elif isinstance(v[0], int):
+            return [v]
+        return v
+
+    def _parse_tdac(self, k, v, kwargs):
+        if isinstance(v, type("")):
+            tmp = np.loadtxt(v)
+            for t in tmp:
+                self.tdacs[t[0], t[1]] = t[2]
+        elif isinstance(v, type(self.tdacs)):
+            self.tdacs = v
+        elif k[4:] == "all":
+            self.tdacs = self.tdacs * 0 + v
+            if kwargs.has_key("tdacmonpix"):
+                if kwargs.has_key("pixels"):
+                    col = kwargs["pixels"][0][1]
+                    row = kwargs["pixels"][0][0]
+                else:
+                    col = self.pixels[0][1]
+                    row = self.pixels[0][0]
+                self.tdacs[row, col] = kwargs["tdacmonpix"]
+        elif k[4:] == "monpix":
+            if not kwargs.has_key("tdacall"):
+                if kwargs.has_key("pixels"):
+                    col = kwargs["pixels"][0][1]
+                    row = kwargs["pixels"][0][0]
+                else:
+                    col = self.pixels[0][1]
+                    row = self.pixels[0][0]
+                self.tdacs[row, col] = v
+        else:
+            x, y = k[4:].split("_")
+            self.tdacs[string.atoi(x), string.atoi(y)] = v
+
     def set_debug(self, debug):
         self.debug = debug
 
     def put_power_on(self, vdd, vss, vgate, vcasc):
+        ### only rails which differ from the shadow are touched, returns their names
         retry = 5
-        self.dut["CCPD_Vdd"].set_current_limit(200, unit="mA")
+        rails = []
+        if self._hw.get("CCPD_Vdd_limit") != 200:
+            self.dut["CCPD_Vdd"].set_current_limit(200, unit="mA")
+            self._hw["CCPD_Vdd_limit"] = 200
         vset = vdd
-        self.dut["CCPD_Vdd"].set_voltage(value=vset, unit="V")
-        self.dut['CCPD_Vdd'].set_enable(True)
+        if self._put_voltage("CCPD_Vdd", vset):
+            rails.append("CCPD_Vdd")
+        vdd_on = self._put_enable("CCPD_Vdd", True)
         # for i in range(5):
         # v=self.dut["CCPD_Vdd"].get_voltage(unit="V")
         # oc=self.dut["CCPD_Vdd"].get_over_current()
@@ -897,11 +1855,13 @@ class Ccpdv2Fei4():
         # if i==retry-1:
         # pass
         # #raise ValueError("ERR CCPD_Vdd voltage %fV"%v)
-        time.sleep(1)
+        if vdd_on:
+            rails.append("CCPD_Vdd")
+            self.wait_settled(["CCPD_Vdd"])
 
         vset = vss
-        self.dut["CCPD_Vssa"].set_voltage(value=vset, unit="V")
-        self.dut['CCPD_Vssa'].set_enable(True)
+        if self._put_voltage("CCPD_Vssa", vset) | self._put_enable("CCPD_Vssa", True):
+            rails.append("CCPD_Vssa")
         # for i in range(5):
         # v=self.dut["CCPD_Vssa"].get_voltage(unit="V")
         # oc=self.dut["CCPD_Vssa"].get_over_current()
@@ -925,8 +1885,8 @@ class Ccpdv2Fei4():
         # #raise ValueError("ERR CCPD_Vssa voltage %fV"%v)
 
         vset = vgate
-        self.dut["CCPD_VGate"].set_voltage(value=vset, unit="V")
-        self.dut['CCPD_VGate'].set_enable(True)
+        if self._put_voltage("CCPD_VGate", vset) | self._put_enable("CCPD_VGate", True):
+            rails.append("CCPD_VGate")
         # for i in range(5):
         # v=self.dut["CCPD_VGate"].get_voltage(unit="V")
         # oc=self.dut["CCPD_VGate"].get_over_current()
@@ -949,40 +1909,93 @@ class Ccpdv2Fei4():
         # pass
         # #raise ValueError("ERR CCPD_VGate voltage %fV"%v)
 
-        self.dut["CCPD_Vcasc"].set_voltage(value=vcasc, unit="V")
+        if self._put_voltage("CCPD_Vcasc", vcasc):
+            rails.append("CCPD_Vcasc")
+        self.wait_settled(rails)
         if self.debug == 1:
             print "Vcasc", self.dut["CCPD_Vcasc"].get_voltage(unit="V"), "V (",
             print self.dut["CCPD_Vcasc"].get_current(unit="mA"), "mA)"
+        return sorted(set(rails))
 
     def put_power_off(self):
-        self.dut["CCPD_Vcasc"].set_voltage(value=0, unit="V")
-        self.dut["CCPD_BL"].set_voltage(value=0, unit="V")
-        self.dut["CCPD_Th"].set_voltage(value=0, unit="V")
-        self.dut["PCB_Th"].set_voltage(value=0, unit="V")
-        self.dut['CCPD_Vssa'].set_enable(False)
-        self.dut['CCPD_VGate'].set_enable(False)
-        time.sleep(1)
-        self.dut['CCPD_Vdd'].set_enable(False)
-
-    def get_power(self):
+        self._put_voltage("CCPD_Vcasc", 0)
+        self._put_voltage("CCPD_BL", 0)
+        self._put_voltage("CCPD_Th", 0)
+        self._put_voltage("PCB_Th", 0)
+        self._put_enable("CCPD_Vssa", False)
+        self._put_enable("CCPD_VGate", False)
+        self.wait_settled(["CCPD_Vssa", "CCPD_VGate"])
+        self._put_enable("CCPD_Vdd", False)
+        self.wait_settled()
+        self._save_state()
+
+    def get_power(self, rails=None):
+        ### rails=None reads all rails, otherwise only the given ones are read again
+        if rails is None:
+            rails = POWER_RAILS
+        self.get_monitor(rails, max_age=0)
+        self.get_monitor(POWER_RAILS)
         ret = {}
-        ret["CCPD_Vdd_v"] = self.dut["CCPD_Vdd"].get_voltage(unit="V")
-        ret["CCPD_Vdd_i"] = self.dut["CCPD_Vdd"].get_current(unit="mA")
-        ret["CCPD_Vssa_v"] = self.dut["CCPD_Vssa"].get_voltage(unit="V")
-        ret["CCPD_Vssa_i"] = self.dut["CCPD_Vssa"].get_current(unit="mA")
-        ret["CCPD_VGate_v"] = self.dut["CCPD_VGate"].get_voltage(unit="V")
-        ret["CCPD_VGate_i"] = self.dut["CCPD_VGate"].get_current(unit="mA")
-        ret["CCPD_Vcasc_v"] = self.dut["CCPD_Vcasc"].get_voltage(unit="V")
-        ret["CCPD_Vcasc_i"] = self.dut["CCPD_Vcasc"].get_current(unit="mA")
+        for rail in POWER_RAILS:
+            ret[rail + "_v"] = self._monitor[rail][1]
+            ret[rail + "_i"] = self._monitor[rail][2]
         return ret
 
+    def get_monitor(self, names=None, max_age=None):
+        ### voltage,current of GPAC channels, re-read if older than max_age (None=never)
+        if names is None:
+            names = MONITORS
+        now = time.time()
+        for name in names:
+            m = self._monitor.get(name)
+            if m is None or (max_age is not None and now - m[0] >= max_age):
+                self._monitor[name] = (time.time(),
+                                       self.dut[name].get_voltage(unit="V"),
+                                       self.dut[name].get_current(unit="mA"))
+        return dict([(name, self._monitor[name]) for name in names])
+
+    def _put_voltage(self, name, value):
+        ### write only if different from the shadow, True if written
+        if self._hw.get(name) == value:
+            return False
+        self.dut[name].set_voltage(value=value, unit="V")
+        self._hw[name] = value
+        self._settling[name] = time.time()
+        return True
+
+    def _put_enable(self, name, en):
+        if self._hw.get(name + "_en") == en:
+            return False
+        self._invalidate_state()
+        self.dut[name].set_enable(en)
+        self._hw[name + "_en"] = en
+        self._settling[name] = time.time()
+        return True
+
+    def wait_settled(self, names=None):
+        ### wait for outputs written since the last wait, names=None: all of them
+        if names is None:
+            names = self._settling.keys()
+        for name in names:
+            t0 = self._settling.pop(name, None)
+            if t0 is None:
+                continue
+            if self._hw.get(name + "_en", True):
+                target = self._hw.get(name, 0)
+            else:
+                target = 0
+            self.settle.wait(name, self.dut[name], target, t0)
+
     def put_hv(self, hv):
         hv = -hv
         if hv < 0:
             print "Ccpdv2Gpac.put_hv() HV must be negative"
             return
+        if self._hw.get("HV") == hv:
+            return
         self.dut["HV"].debug = 1
         self.dut["HV"].set_voltage(value=hv, unit="V")
+        self._hw["HV"] = hv
 
     def get_hv(self):
         hv = self.dut["HV"].get_voltage(unit="V")
@@ -994,69 +2007,126 @@ class Ccpdv2Fei4():
             print self.dut[register_name]
         self.dut[register_name].write()
         self.dut[register_name].start()
-        if self.dut[register_name].get_repeat() == 0:
+        self._wait_reg(register_name)
+
+    def _wait_reg(self, register_name):
+        if self._cycles[register_name] == 0:
             return
-        for i in range(1000000):
-            if self.dut[register_name].is_done():
-                break
-            if i > 100:
-                time.sleep(0.001)  # avoid "CPU 100%"
-        if i == 1000000 - 1:
-            print "Ccpdv2._write_reg()Timeout"
+        self.waiter.wait(register_name, self.dut[register_name],
+                         self._cycles[register_name])
+
+    def _reg_dirty(self, register_name):
+        ### True if the register content differs from what was last shifted in
+        data = np.asarray(self.dut[register_name].tobytes(), np.uint8).tostring()
+        return self._hw.get(register_name) != data
+
+    @_locked
+    def _write_verified(self, register_name):
+        ### SDO of a shift gives back the content left by the previous shift.
+        ### with auto_start (CCPD_CONFIG) write() shifts and _write_reg() shifts the same
+        ### data again, so the readback is what the first shift loaded. without auto_start
+        ### (CCPD_GLOBAL) the readback is the old content and one more shift is needed.
+        ### the last shift repeats data which was read back correctly. retry only on mismatch.
+        ### see write_verify about the SHIFT_OUT line shared by both registers
+        data = np.asarray(self.dut[register_name].tobytes(), np.uint8)
+        auto_start = self.dut[register_name]._conf.get("auto_start", False)
+        self._invalidate_state()
+        if self.write_verify == False:
+            self._write_reg(register_name)
+            self._hw[register_name] = data.tostring()
+            return 0
+        for i in range(self.write_retry + 1):
+            self._write_reg(register_name)
+            if not auto_start:
+                self.dut[register_name].start()
+                self._wait_reg(register_name)
+            ret = np.asarray(self.dut[register_name].get_data(size=len(data)), np.uint8)
+            if np.all(ret == data):
+                self._hw[register_name] = data.tostring()
+                return i
+            print "Ccpdv2._write_verified() %s readback mismatch (%d/%d)" % (
+                register_name, i + 1, self.write_retry + 1)
+        raise Ccpdv2VerifyError("%s readback mismatch after %d retries" %
+                                (register_name, self.write_retry))
 
     def get_data(self):
-        for i in range(10000):
-            #print i,self.dut['CCPD_TDCGATE_PULSE'].is_done()
-            if self.dut['CCPD_TDCGATE_PULSE'].is_done():
-                break
-            if i > 100:
-                time.sleep(0.001)  # avoid "CPU 100%"
-        if i == 10000 - 1:
-            print "Ccpdv2.get_data()Timeout"
+        self.waiter.wait('CCPD_TDCGATE_PULSE', self.dut['CCPD_TDCGATE_PULSE'],
+                         self._cycles['CCPD_TDCGATE_PULSE'])
         return self.dut['sram'].get_data()
 
+    def get_latency(self, register_name=None):
+        ### completion latency histograms, counts,bins=c.get_latency("CCPD_CONFIG")
+        if register_name is None:
+            self.waiter.show()
+        else:
+            return self.waiter.get_hist(register_name)
+
     def get_data_now(self):
         return self.dut['sram'].get_data()
 
+    def plan_tdac(self, tdacs, force_reload=False):
+        ### columns with the same TDAC column vector are loaded by one shift
+        if force_reload == True:
+            cols = np.arange(0, 60, 1)
+        else:
+            cols = np.unique(np.where(self._tdacs != tdacs)[1])
+        groups = {}
+        for col in cols:
+            vec = tuple(np.asarray(tdacs[:, col], int))
+            if vec not in groups:
+                groups[vec] = []
+            groups[vec].append(col)
+        ### start with the column vector which is already in InL/InR
+        bits = self._get_config_bits()
+        now = tuple(np.dot(bits[CONFIG_TABLES["tdac"]], [8, 4, 2, 1]))
+        plan = sorted(groups.items(), key=lambda g: (g[0] != now, g[1][0]))
+        n_write = 2 * len(plan)
+        if len(plan) != 0 and plan[0][0] == now:
+            n_write = n_write - 1
+        return plan, n_write
+
+    @_locked
     def put_tdac(self, tdacs, force_reload=False, vdd=True):
+        plan, n_write = self.plan_tdac(tdacs, force_reload)
+        if len(plan) == 0:
+            self._tdacs = np.copy(tdacs)
+            return
         if self.debug == 1:
+            print "put_tdac: %d columns in %d groups, %d writes of CCPD_CONFIG" % (
+                sum([len(g[1]) for g in plan]), len(plan), n_write)
             v = self.dut["CCPD_Vdd"].get_voltage(unit="V")
             i = self.dut["CCPD_Vdd"].get_current(unit="mA")
             print "put_tdac: initial Vdd %fV(%fmA)...." % (v, i)
             t = time.time()
         if vdd == True:
-            self.dut["CCPD_Vdd"].set_voltage(value=1.999, unit="V")
+            self._put_voltage("CCPD_Vdd", 1.999)
         if self.debug == 1 or self.debug == 0:
             v = self.dut["CCPD_Vdd"].get_voltage(unit="V")
             i = self.dut["CCPD_Vdd"].get_current(unit="mA")
             print "+++++++++++put_tdac: Vdd during TDAC update %fV(%fmA)...." % (
                 v, i),
-        if force_reload == True:
-            cols = np.arange(0, 60, 1)
-        else:
-            cols = np.unique(np.where(self._tdacs != tdacs)[1])
-        for col in cols:
-            wr = "Ld%d" % (col % 3)
-            for row in range(24):
-                if row % 4 == 1 or row % 4 == 2:
-                    indac = "InL"
-                elif row % 4 == 0 or row % 4 == 3:
-                    indac = "InR"
-                if self.debug > 1:
-                    print row, col, tdacs
-                self.dut['CCPD_CONFIG']['ROW'][11 - row / 2][indac] = int(
-                    tdacs[row, col])
-            for i in range(5):
-                self.dut['CCPD_CONFIG']['COLUMN'][19 - col / 3][wr] = 0
-                self._write_reg('CCPD_CONFIG')
-                self.dut['CCPD_CONFIG']['COLUMN'][19 - col / 3][wr] = 1
-                self._write_reg('CCPD_CONFIG')
-                self.dut['CCPD_CONFIG']['COLUMN'][19 - col / 3][wr] = 0
+        tbl = CONFIG_TABLES
+        bits = self._get_config_bits()
+        bits[tbl["ld"]] = 0
+        for n, (vec, cols) in enumerate(plan):
+            if self.debug > 1:
+                print "cols", cols, "tdac", vec
+            skip = (n == 0 and np.all(
+                np.dot(bits[tbl["tdac"]], [8, 4, 2, 1]) == vec))
+            bits[tbl["tdac"]] = (np.array(vec)[:, np.newaxis] >> [3, 2, 1, 0]) & 1
+            if not skip:
+                self._put_config_bits(bits)
+                self._write_verified('CCPD_CONFIG')
+            bits[tbl["ld"][cols]] = 1
+            self._put_config_bits(bits)
+            self._write_verified('CCPD_CONFIG')
+            bits[tbl["ld"][cols]] = 0
+        self._put_config_bits(bits)
         if self.debug == 1:
             v = self.dut["CCPD_Vdd"].get_voltage(unit="V")
             i = self.dut["CCPD_Vdd"].get_current(unit="mA")
             print "put_tdac: Vdd %fV(%fmA) time: %fs" % (v, i, time.time() - t)
-        self.dut["CCPD_Vdd"].set_voltage(value=1.8, unit="V")
+        self._put_voltage("CCPD_Vdd", 1.8)
         if self.debug == 1 or self.debug == 0:
             v = self.dut["CCPD_Vdd"].get_voltage(unit="V")
             i = self.dut["CCPD_Vdd"].get_current(unit="mA")
@@ -1065,144 +2135,81 @@ class Ccpdv2Fei4():
         self._tdacs = np.copy(
             tdacs
         )  ##TODO keep tdacs in memory. this should be done by get_data()
+        self._state_dirty = True
+
+    def _get_config_bits(self):
+        ### present content of CCPD_CONFIG, index=bit position
+        dat = str(self.dut['CCPD_CONFIG']).split("'")[3][4:]
+        return (np.fromstring(dat, np.uint8) - ord("0"))[::-1]
 
-    def _config_monitor(self, pixels, enLR):
+    def _put_config_bits(self, bits):
+        self.dut['CCPD_CONFIG'].set(
+            (np.asarray(bits[::-1], np.uint8) + ord("0")).tostring())
+
+    def _config_monitor(self, bits, mask, enLR):
+        t = CONFIG_TABLES
         #disable all pixels
-        for i in range(0, 12):
-            self.dut['CCPD_CONFIG']['ROW'][i]['EnL'] = 1
-            self.dut['CCPD_CONFIG']['ROW'][i]['EnR'] = 1
-        for i in range(0, 20):
-            self.dut['CCPD_CONFIG']['COLUMN'][i]["L0"] = 0
-            self.dut['CCPD_CONFIG']['COLUMN'][i]["R0"] = 0
-            self.dut['CCPD_CONFIG']['COLUMN'][i]["L1"] = 0
-            self.dut['CCPD_CONFIG']['COLUMN'][i]["R1"] = 0
-            self.dut['CCPD_CONFIG']['COLUMN'][i]["L2"] = 0
-            self.dut['CCPD_CONFIG']['COLUMN'][i]["R2"] = 0
-        for p in pixels:
-            row = p[0]
-            col = p[1]
-            if row % 4 == 0 or row % 4 == 3:
-                enLR_idx = "EnR"
-            elif row % 4 == 1 or row % 4 == 2:
-                enLR_idx = "EnL"
-            if row % 4 == 0 or row % 4 == 2:
-                lr_idx = "L"
-            elif row % 4 == 1 or row % 4 == 3:
-                lr_idx = "R"
-            lr_idx = "%s%d" % (lr_idx, col % 3)
-            self.dut['CCPD_CONFIG']['ROW'][11 - (row / 2)][enLR_idx] = 0
-            self.dut['CCPD_CONFIG']['COLUMN'][19 - (col / 3)][lr_idx] = 1
-            if self.debug == 1:
-                print "ROW", 11 - (row / 2), "enLR", enLR_idx, "COL", 19 - (
-                    col / 3), "lr", lr_idx
+        bits[t["all_rowen"]] = 1
+        bits[t["all_colsel"]] = 0
+        rows, cols = np.nonzero(mask)
+        bits[t["rowen"][rows]] = 0
+        bits[t["colsel"][rows, cols]] = 1
+        if self.debug == 1:
+            for row, col in zip(rows, cols):
+                print "ROW", 11 - (row / 2), "enLR", t["rowen"][row], "COL", 19 - (
+                    col / 3), "lr", t["colsel"][row, col]
         if enLR != -1:
-            enLR = format(enLR, "024b")
-            for row, e in enumerate(enLR):
-                v = string.atoi(e)
-                if row % 4 == 1 or row % 4 == 2:
-                    enLR_idx = "EnL"
-                elif row % 4 == 0 or row % 4 == 3:
-                    enLR_idx = "EnR"
-                self.dut['CCPD_CONFIG']['ROW'][11 -
-                                               (row / 2)][enLR_idx] = int(v)
-
-    def _config_preamp(self, en):
+            bits[t["rowen"]] = _format_bits(enLR, 24)
+
+    def _config_preamp(self, bits, en):
+        t = CONFIG_TABLES
         if isinstance(en, int):
-            for i in range(12):
-                if en == 1:
-                    self.dut['CCPD_CONFIG']['ROW'][i]['En0'] = 1
-                    self.dut['CCPD_CONFIG']['ROW'][i]['En1'] = 1
-                    self.dut['CCPD_CONFIG']['ROW'][i]['En2'] = 1
-                    self.dut['CCPD_CONFIG']['ROW'][i]['En3'] = 1
-                    self.dut['CCPD_CONFIG']['ROW'][i]['En4'] = 1
-                    self.dut['CCPD_CONFIG']['ROW'][i]['En5'] = 1
-                else:
-                    self.dut['CCPD_CONFIG']['ROW'][i]['En0'] = 0
-                    self.dut['CCPD_CONFIG']['ROW'][i]['En1'] = 0
-                    self.dut['CCPD_CONFIG']['ROW'][i]['En2'] = 0
-                    self.dut['CCPD_CONFIG']['ROW'][i]['En3'] = 0
-                    self.dut['CCPD_CONFIG']['ROW'][i]['En4'] = 0
-                    self.dut['CCPD_CONFIG']['ROW'][i]['En5'] = 0
-            for p in self._pixels:
-                row = p[0]
-                col = p[1]
-                if (row % 4 == 1 and col % 3 == 0) or (row % 4 == 2 and col % 3
-                                                       == 0):
-                    en = "En0"
-                elif (row % 4 == 1 and col % 3 == 1) or (row % 4 == 2 and col %
-                                                         3 == 1):
-                    en = "En1"
-                elif (row % 4 == 1 and col % 3 == 2) or (row % 4 == 2 and col %
-                                                         3 == 2):
-                    en = "En2"
-                elif (row % 4 == 0 and col % 3 == 0) or (row % 4 == 3 and col %
-                                                         3 == 0):
-                    en = "En3"
-                elif (row % 4 == 0 and col % 3 == 1) or (row % 4 == 3 and col %
-                                                         3 == 1):
-                    en = "En4"
-                elif (row % 4 == 0 and col % 3 == 2) or (row % 4 == 3 and col %
-                                                         3 == 2):
-                    en = "En5"
-                self.dut['CCPD_CONFIG']['ROW'][11 - (row / 2)][en] = 1
+            if en == 1:
+                bits[t["all_preamp"]] = 1
+            else:
+                bits[t["all_preamp"]] = 0
+            bits[t["preamp"][self._pixel_mask]] = 1
         elif isinstance(en, type([])):
-            en_i = format(en[0], "024b")
-            for row, e in enumerate(en_i):
-                v = string.atoi(e)
-                if row % 4 == 1 or row % 4 == 2:
-                    bit = "En0"
-                elif row % 4 == 0 or row % 4 == 3:
-                    bit = "En3"
-                self.dut['CCPD_CONFIG']['ROW'][11 - (row / 2)][bit] = int(v)
-            en_i = format(en[1], "024b")
-            for row, e in enumerate(en_i):
-                v = string.atoi(e)
-                if row % 4 == 1 or row % 4 == 2:
-                    bit = "En1"
-                elif row % 4 == 0 or row % 4 == 3:
-                    bit = "En4"
-                self.dut['CCPD_CONFIG']['ROW'][11 - (row / 2)][bit] = int(v)
-            en_i = format(en[2], "024b")
-            for row, e in enumerate(en_i):
-                v = string.atoi(e)
-                if row % 4 == 1 or row % 4 == 2:
-                    bit = "En2"
-                elif row % 4 == 0 or row % 4 == 3:
-                    bit = "En5"
-                self.dut['CCPD_CONFIG']['ROW'][11 - (row / 2)][bit] = int(v)
-
-    def _config_ao(self, ao):
-        for i in range(20):
-            self.dut['CCPD_CONFIG']['COLUMN'][i]["ao"] = 0
+            for g in range(3):
+                bits[t["en"][g]] = _format_bits(en[g], 24)
+
+    def _config_ao(self, bits, ao):
+        t = CONFIG_TABLES
+        bits[t["ao_group"]] = 0
         if ao == 0:
             pass
         elif ao == -1:
-            for p in self._pixels:
-                col = p[1]
-                self.dut['CCPD_CONFIG']['COLUMN'][19 - (col / 3)]["ao"] = 1
+            bits[t["ao"][np.any(self._pixel_mask, axis=0)]] = 1
         else:
-            ao = format(ao, "020b")
-            for i, e in enumerate(ao):
-                v = string.atoi(e)
-                self.dut['CCPD_CONFIG']['COLUMN'][19 - i]["ao"] = int(
-                    v)  ### here col=i*3
+            bits[t["ao_group"]] = _format_bits(ao, 20)  ### here col=i*3
 
+    @_locked
     def put_config(self, pixels, en, ao, enLR):
-        self._pixels = pixels
-        self._config_monitor(pixels, enLR)
-        self._config_preamp(en)
-        self._config_ao(ao)
-        self._write_reg("CCPD_CONFIG")
-
+        self._pixel_mask = pixels2mask(pixels)
+        self._pixels = mask2pixels(self._pixel_mask)
+        bits = self._get_config_bits()
+        self._config_monitor(bits, self._pixel_mask, enLR)
+        self._config_preamp(bits, en)
+        self._config_ao(bits, ao)
+        self._put_config_bits(bits)
+        if self._reg_dirty("CCPD_CONFIG"):
+            self._write_verified("CCPD_CONFIG")
+            self._state_dirty = True
+
+    @_locked
     def start_pulser(self):
         if self.dut['rx']['CCPD_TDC'] == 1:
             self.dut['sram'].reset()
         self.dut['CCPD_TDCGATE_PULSE'].start()
 
-    def put_th(self, th):
+    def put_th(self, th, settle=None):
         if th > 1.999 or th < -0.1:
             raise ValueError("invalid voltage for TH %f" % th)
-        self.dut["CCPD_Th"].set_voltage(value=th, unit="V")
+        self._put_voltage("CCPD_Th", th)
+        if settle is None:
+            settle = self.settle_dac
+        if settle:
+            self.wait_settled(["CCPD_Th"])
 
     def get_th(self, with_current=False):
         th = self.dut["CCPD_Th"].get_voltage(unit="V")
@@ -1213,7 +2220,7 @@ class Ccpdv2Fei4():
             return th
 
     def put_pcbth(self, pcbth):
-        self.dut["PCB_Th"].set_voltage(value=pcbth, unit="V")
+        self._put_voltage("PCB_Th", pcbth)
 
     def get_pcbth(self, with_current=False):
         pcbth = self.dut["PCB_Th"].get_voltage(unit="V")
@@ -1223,10 +2230,14 @@ class Ccpdv2Fei4():
         else:
             return pcbth
 
-    def put_bl(self, bl):
+    def put_bl(self, bl, settle=None):
         if bl > 1.9 or bl < -0.1:
             raise ValueError("invalid voltage for BL")
-        self.dut["CCPD_BL"].set_voltage(value=bl, unit="V")
+        self._put_voltage("CCPD_BL", bl)
+        if settle is None:
+            settle = self.settle_dac
+        if settle:
+            self.wait_settled(["CCPD_BL"])
 
     def get_bl(self, with_current=False):
         bl = self.dut["CCPD_BL"].get_voltage(unit="V")
@@ -1237,8 +2248,8 @@ class Ccpdv2Fei4():
             return bl
 
     def put_inj(self, high, low):
-        self.dut['CCPD_Injection_high'].set_voltage(value=high, unit="V")
-        self.dut['CCPD_Injection_low'].set_voltage(value=low, unit="V")
+        self._put_voltage('CCPD_Injection_high', high)
+        self._put_voltage('CCPD_Injection_low', low)
 
     def get_inj(self, with_current=False):
         high = self.dut['CCPD_Injection_high'].get_voltage(unit="V")
@@ -1250,7 +2261,11 @@ class Ccpdv2Fei4():
         else:
             return high, low
 
+    @_locked
     def put_pulser(self, delay, period, repeat, en):
+        if self._hw.get("pulser") == (delay, period, repeat, en):
+            return
+        self._invalidate_state()
         if repeat == 0:
             self.dut['CCPD_INJ_PULSE'].reset()
             self.dut['CCPD_INJ_PULSE'].set_delay(10)
@@ -1262,10 +2277,14 @@ class Ccpdv2Fei4():
             self.dut['CCPD_TDCGATE_PULSE'].set_width(100)
             self.dut['CCPD_TDCGATE_PULSE'].set_repeat(1)
             self.dut['CCPD_TDCGATE_PULSE'].set_en(True)
+            self._cycles['CCPD_TDCGATE_PULSE'] = 10 + 100
             if self.dut['rx']['CCPD_TDC'] == 1:
                 self.dut['sram'].reset()
             self.dut['CCPD_TDC'].reset()
             self.dut['CCPD_TDC'].set_en_extern(0)
+            self._hw["CCPD_INJ_PULSE"] = (10, period / 2, 1, en)
+            self._hw["CCPD_TDCGATE_PULSE"] = (10, 100, 1, True)
+            self._hw["CCPD_TDC"] = (False, False)
         else:
             self.dut['CCPD_INJ_PULSE'].reset()
             self.dut['CCPD_INJ_PULSE'].set_delay(period / 2)
@@ -1278,12 +2297,23 @@ class Ccpdv2Fei4():
                                                      (repeat + 1))
             self.dut['CCPD_TDCGATE_PULSE'].set_repeat(1)
             self.dut['CCPD_TDCGATE_PULSE'].set_en(True)
+            self._cycles['CCPD_TDCGATE_PULSE'] = delay + (period + 1) * (repeat + 1)
             self.dut['CCPD_TDC'].reset()
             self.dut['CCPD_TDC'].set_en_extern(True)
             if self.dut['rx']['CCPD_TDC'] == 1:
                 self.dut['sram'].reset()
-
+            self._hw["CCPD_INJ_PULSE"] = (period / 2, period - period / 2 + 1,
+                                          repeat, en)
+            self._hw["CCPD_TDCGATE_PULSE"] = (delay, (period + 1) * (repeat + 1),
+                                              1, True)
+            self._hw["CCPD_TDC"] = (False, True)
+        self._hw["pulser"] = (delay, period, repeat, en)
+
+    @_locked
     def put_mode(self, mode):
+        if self._hw.get("mode") == mode:
+            return
+        self._invalidate_state()
         self.dut['sram'].reset()
         self.dut['rx'].reset()
         if mode == "ccpd":
@@ -1318,7 +2348,10 @@ class Ccpdv2Fei4():
             raise ValueError("invalid mode %s, ccpd,hitmon,inj,lemo(rj45)" %
                              mode)
         self.dut['rx'].write()
+        self._hw["mode"] = mode
+        self._hw["RX_data"] = str(self.dut["rx"].get_data())
 
+    @_locked
     def put_global(self, BLRes, ThRes, VN, VN2, VNFB, VNFoll, VNLoad, VNDAC,
                    ThPRes, ThP, VNOut, VNComp, VNCompLd, VNCOut1, VNCOut2,
                    VNCOut3, VNBuffer, VPFoll, VNBias, EnPullUp, EnPosFB):
@@ -1342,7 +2375,16 @@ class Ccpdv2Fei4():
         self.dut['CCPD_GLOBAL']['VN'] = VN
         self.dut['CCPD_GLOBAL']['ThRes'] = ThRes
         self.dut['CCPD_GLOBAL']['BLRes'] = BLRes
-        self._write_reg("CCPD_GLOBAL")
+        if self._reg_dirty("CCPD_GLOBAL"):
+            self._write_verified("CCPD_GLOBAL")
+        self._hw["global"] = dict(BLRes=BLRes, ThRes=ThRes, VN=VN, VN2=VN2,
+                                  VNFB=VNFB, VNFoll=VNFoll, VNLoad=VNLoad,
+                                  VNDAC=VNDAC, ThPRes=ThPRes, ThP=ThP,
+                                  VNOut=VNOut, VNComp=VNComp, VNCompLd=VNCompLd,
+                                  VNCOut1=VNCOut1, VNCOut2=VNCOut2,
+                                  VNCOut3=VNCOut3, VNBuffer=VNBuffer,
+                                  VPFoll=VPFoll, VNBias=VNBias,
+                                  EnPullUp=EnPullUp, EnPosFB=EnPosFB)
 
     def get_config(self):
         dat = str(self.dut['CCPD_CONFIG']).split("'")[3][4:]
@@ -1370,80 +2412,109 @@ class Ccpdv2Fei4():
         return int(v, 2)
 
     def get_allconfig(self):
-        ## TODO: this data should be from get_data()
-        return {
-            'BLRes': self._int_global('BLRes'),
-            'ThRes': self._int_global('ThRes'),
-            'VN': self._int_global('VN'),
-            'VN2': self._int_global('VN2'),
-            'VNFB': self._int_global('VNFB'),
-            'VNFoll': self._int_global('VNFoll'),
-            'VNLoad': self._int_global('VNLoad'),
-            'VNDAC': self._int_global('VNDAC'),
-            'ThPRes': self._int_global('ThPRes'),
-            'ThP': self._int_global('ThP'),
-            'VNOut': self._int_global('VNOut'),
-            'VNComp': self._int_global('VNComp'),
-            'VNCompLd': self._int_global('VNCompLd'),
-            'VNCOut1': self._int_global('VNCOut1'),
-            'VNCOut2': self._int_global('VNCOut2'),
-            'VNCOut3': self._int_global('VNCOut3'),
-            'VNBuffer': self._int_global('VNBuffer'),
-            'VPFoll': self._int_global('VPFoll'),
-            'VNBias': self._int_global('VNBias'),
-            'EnPullUp': int(str(self.dut['CCPD_GLOBAL']['EnPullUp']), 2),
-            'EnPosFB': int(str(self.dut['CCPD_GLOBAL']['EnPosFB']), 2),
-            'TDCGATE_delay': self.dut['CCPD_TDCGATE_PULSE'].get_delay(),
-            'TDCGATE_width': self.dut['CCPD_TDCGATE_PULSE'].get_width(),
-            'TDCGATE_repeat': self.dut['CCPD_TDCGATE_PULSE'].get_repeat(),
-            'TDCGATE_en': self.dut['CCPD_TDCGATE_PULSE'].get_en(),
-            'INJ_delay': self.dut['CCPD_INJ_PULSE'].get_delay(),
-            'INJ_width': self.dut['CCPD_INJ_PULSE'].get_width(),
-            'INJ_repeat': self.dut['CCPD_INJ_PULSE'].get_repeat(),
-            'INJ_en': self.dut['CCPD_INJ_PULSE'].get_en(),
-            'TDC_en': self.dut['CCPD_TDC'].get_en(),
-            'TDC_en_extern': self.dut['CCPD_TDC'].get_en_extern(),
-            'TDACS': self.tdacs,
-            'pixels': self.pixels,
-            'CCPD_CONFIG': str(self.dut['CCPD_CONFIG']).split("'")[3][4:],
-            'Vdd_v': self.dut["CCPD_Vdd"].get_voltage(unit="V"),
-            'Vdd_i': self.dut["CCPD_Vdd"].get_current(unit="mA"),
-            'Vssa_v': self.dut["CCPD_Vssa"].get_voltage(unit="V"),
-            'Vssa_i': self.dut["CCPD_Vssa"].get_current(unit="mA"),
-            'VGate_v': self.dut["CCPD_VGate"].get_voltage(unit="V"),
-            'VGate_i': self.dut["CCPD_VGate"].get_current(unit="mA"),
-            'Vcasc_v': self.dut["CCPD_Vcasc"].get_voltage(unit="V"),
-            'Vcasc_i': self.dut["CCPD_Vcasc"].get_current(unit="mA"),
-            'BL_v': self.dut["CCPD_BL"].get_voltage(unit="V"),
-            'BL_i': self.dut["CCPD_BL"].get_current(unit="mA"),
-            'Th_v': self.dut["CCPD_Th"].get_voltage(unit="V"),
-            'Th_i': self.dut["CCPD_Th"].get_current(unit="mA"),
-            'PCB_Th_v': self.dut["PCB_Th"].get_voltage(unit="V"),
-            'PCB_Th_i': self.dut["PCB_Th"].get_current(unit="mA"),
-            #'RX_output_en':self.dut["rx"].get_output_en()[0],
-            'RX_data': str(self.dut["rx"].get_data())
-        }
+        ret = self.snapshot(max_age=0)._asdict()
+        for k in ["inj_high", "inj_low", "t", "t_monitor"]:
+            del ret[k]
+        return ret
 
-    def measure(self, exp):
+    def snapshot(self, max_age=0, monitors=MONITORS):
+        ### registers from the shadow, GPAC monitors older than max_age (s) are read again
+        ### max_age=None: no hardware access at all, last readings or nan
+        ret = dict.fromkeys(ccpdv2_snapshot._fields, np.nan)
+        ret.update(self._hw.get("global", {}))
+        for name in ["TDCGATE", "INJ"]:
+            v = self._hw.get("CCPD_%s_PULSE" % name)
+            if v is not None:
+                for k, vv in zip(["delay", "width", "repeat", "en"], v):
+                    ret["%s_%s" % (name, k)] = vv
+        ret["TDC_en"], ret["TDC_en_extern"] = self._hw.get("CCPD_TDC", (np.nan, np.nan))
+        ret["TDACS"] = self.tdacs
+        ret["pixels"] = self.pixels
+        ret["CCPD_CONFIG"] = str(self.dut['CCPD_CONFIG']).split("'")[3][4:]
+        ret["RX_data"] = self._hw.get("RX_data", "")
+        ret["inj_high"] = self._hw.get("CCPD_Injection_high", np.nan)
+        ret["inj_low"] = self._hw.get("CCPD_Injection_low", np.nan)
+        if max_age is not None:
+            self.get_monitor(monitors, max_age=max_age)
+        t = []
+        for name in MONITORS:
+            m = self._monitor.get(name)
+            if m is None:
+                continue
+            k = name.replace("CCPD_", "")
+            ret[k + "_v"], ret[k + "_i"] = m[1], m[2]
+            t.append(m[0])
+        if len(t) != 0:
+            ret["t_monitor"] = min(t)
+        ret["t"] = time.time()
+        return ccpdv2_snapshot(**ret)
+
+    def _point_snapshot(self):
+        ### snapshot for the log of each scan point, None if snapshot_log==0
+        if self.snapshot_log == 0:
+            return None
+        return self.snapshot(max_age=self.snapshot_age)
+
+    def measure(self, exp, view=False):
+        ### raw words of an exposure. view=True: no copy, the array is a view of the
+        ### readout buffer which the next measure() overwrites (for loops that analyze at once)
+        ### pending writes: power rails always settle, DACs only with settle_dac=1
+        if not self.settle_dac:
+            for name in SETTLE_DACS:
+                self._settling.pop(name, None)
+        if len(self._settling) != 0:
+            self.wait_settled()
+        t_start = time.time()
         if exp > 0.0001:
+            if self.readout is None or len(self.readout.buf) != self.readout_size:
+                self.readout = ccpdv2_readout(self.dut['sram'], size=self.readout_size)
+            overflow, dropped = self.readout.overflow, self.readout.dropped
             self.dut['CCPD_TDC'].set_en(True)
+            self._hw["CCPD_TDC"] = (True, self._hw["CCPD_TDC"][1])
         self.start_pulser()
         if exp > 0.0001:
+            ### sram is drained during the exposure, not only at the end
+            self.readout.start()
             time.sleep(exp)
+            self.readout.stop()
             self.dut['CCPD_TDC'].set_en(False)
-            data = self.get_data_now()
+            self._hw["CCPD_TDC"] = (False, self._hw["CCPD_TDC"][1])
+            self.readout.drain()
+            if self.readout.overflow != overflow or self.readout.dropped != dropped:
+                print "Ccpdv2.measure() sram overflow %d, dropped %d words" % (
+                    self.readout.overflow - overflow, self.readout.dropped - dropped)
+            data = self.readout.get_data()
+            if not view:
+                data = np.copy(data)
         else:
             data = self.get_data()
+        self.t_measure = (t_start, time.time())
+        if self.on_data is not None:
+            self.on_data(data)
         return data
 
+    def start_monitor(self, rates=None, filename="monitor.dat", size=2**16):
+        ### background sampling of GPAC monitors and HV, rates = {name: period in s}
+        import ccpdv2_monitor
+        self.stop_monitor()
+        self.monitor = ccpdv2_monitor.ccpdv2_monitor(self, rates=rates, size=size,
+                                                     filename=filename)
+        self.monitor.start()
+        return self.monitor
+
+    def stop_monitor(self):
+        if self.monitor is not None:
+            self.monitor.stop()
+
     def run_fei4scan(self, scan="Ext"):
+        import ccpdv2_fei4
         if scan == "ext":
-            self.rmg.run_run(HvcmosScan)
+            self.rmg.run_run(ccpdv2_fei4.HvcmosScan)
         elif scan == "tune":
 
-            self.rmg.run_run(ThresholdBaselineTuning)
+            self.rmg.run_run(ccpdv2_fei4.ThresholdBaselineTuning)
         elif scan == "self":
-            self.rmg.run_run(HvcmosSelfScan)
+            self.rmg.run_run(ccpdv2_fei4.HvcmosSelfScan)
         else:
             print "scan have to be ext, self, or tune"
             return
@@ -1454,10 +2525,21 @@ class Ccpdv2Fei4():
             print np.asarray(load_fei4data("%s_interpreted.h5" % filename,
                                            dataname="HistOcc"), int)
 
-    def tune_with_fei4(self, th=0.9, VNDAC=10, VNCout=4):
+    def tune_with_fei4(self, th=0.9, VNDAC=10, VNCout=4, session=True):
+        ### session=True: FE-I4 readout keeps running, occupancy in memory
+        if session == True:
+            self.start_fei4_session()
+        try:
+            self._tune_with_fei4(th, VNDAC, VNCout, session)
+        finally:
+            if session == True:
+                self.stop_fei4_session()
+
+    def _tune_with_fei4(self, th, VNDAC, VNCout, session):
         print "WARNING WARNING WARNING WARNING WARNING WARNING WARNING"
         print "WRNING   This tuning algorithm is not robust    WARNING"
         print "WARNING WARNING WARNING WARNING WARNING WARNING WARNING"
+        import ccpdv2_fei4
         for v in [0, 1, 2]:
             if v == 0:
                 v1 = VNCout
@@ -1505,23 +2587,23 @@ class Ccpdv2Fei4():
                          tdac=tdacs,
                          VNCOut2=v2,
                          VNCOut3=v3)
-                self.rmg.run_run(HvcmosSelfScan, run_conf={"scan_timeout": 1})
-                f = self.get_fei4file()
-                ### calc for next t
-                try:
-                    data = self.load_fei4data(f)
-                except:
-                    data = np.zeros([12, 24])
+                if session == True:
+                    data = self.get_fei4_occupancy(1.0)
+                else:
+                    self.rmg.run_run(ccpdv2_fei4.HvcmosSelfScan,
+                                     run_conf={"scan_timeout": 1})
+                    f = self.get_fei4file()
+                    ### calc for next t
+                    try:
+                        data = self.load_fei4data(f)
+                    except:
+                        data = np.zeros([12, 24])
                 print np.asarray(data, int)
                 pix_fei4 = np.argwhere(data > 10)
-                pix = []
-                for p in pix_fei4:
-                    print "result pix=", p, data[p[0], p[1]],
-                    flg = 0
-                    if flg == 0:
-                        p = self.fei42hvcmos(p, v)
-                        print p, "tdac=", int(self._tdacs[p[0], p[1]])
-                        pix.append(p)
+                pix = self.fei42hvcmos(pix_fei4, v).tolist()
+                for pf, p in zip(pix_fei4, pix):
+                    print "result pix=", pf, data[pf[0], pf[1]],
+                    print p, "tdac=", int(self._tdacs[p[0], p[1]])
     #######################
     #### useful functions
     def save_tdac(self):
@@ -1534,52 +2616,71 @@ class Ccpdv2Fei4():
     def get_fei4file(
         self,
         datadir=r"D:\workspace\pybar\branches\development\pybar\module_test"):
-        fno = open(os.path.join(datadir, "run.cfg")).readlines()[-1].split()[0]
-        for f in os.listdir(datadir):
-            ftmp = f.split("_")
-            if "interpreted.h5" == ftmp[-1] and fno == ftmp[0]:
-                return os.path.join(datadir, f)
-        return None
+        if datadir not in self._runindex:
+            self._runindex[datadir] = ccpdv2_runindex(datadir)
+        idx = self._runindex[datadir]
+        return idx.get(idx.last_run())
 
     def fei42hvcmos(self, pix, vncout):
-        debug = 0
-        row_base = (11 - pix[0]) * 2
-        col = (15 - pix[1] / 2) * 3 + vncout
-        if debug == 1:
-            print pix[0] % 2, pix[1] % 2, vncout, row_base
-        if (pix[0] % 2 == 1 and pix[1] % 2 == 0) and (vncout == 1):
-            if debug == 1:
-                print "odd,even"
-            row = row_base + 1
-        elif (pix[0] % 2 == 1 and pix[1] % 2 == 1) and (vncout == 0 or vncout
-                                                        == 2):
-            if debug == 1:
-                print "odd,odd 1"
-            row = row_base + 1
-        elif (pix[0] % 2 == 0 and pix[1] % 2 == 1) and (vncout == 1):
-            row = row_base + 1
-        elif (pix[0] % 2 == 0 and pix[1] % 2 == 0) and (vncout == 0 or vncout
-                                                        == 2):
-            if debug == 1:
-                print "even,even 1"
-            row = row_base + 1
-        else:
-            if debug == 1:
-                print "odd,even 0"
-                print "even,odd 0"
-            row = row_base
-        return [row, col]
+        ### [col,row] of the FE-I4 region (load_fei4data) -> [row,col] of HV-CMOS, or Nx2 arrays
+        p = np.asarray(pix, int)
+        ret = FEI4_TO_HVCMOS[vncout][p[..., 0], p[..., 1]]
+        if p.ndim == 1:
+            return [int(ret[0]), int(ret[1])]
+        return ret
 
     def hvcmos2fei4(self, pix):
-        pass
+        ### [row,col] of HV-CMOS -> [col,row] of the FE-I4 region, or Nx2 arrays.
+        ### VNCOut group is col%3, [-1,-1] outside of cols 12-47
+        p = np.asarray(pix, int)
+        ret = HVCMOS_TO_FEI4[p[..., 0], p[..., 1]]
+        if p.ndim == 1:
+            return [int(ret[0]), int(ret[1])]
+        return ret
+
+    def fei4map2hvcmos(self, data, vncout):
+        ### (12,24) map from load_fei4data() -> (24,60) map of HV-CMOS, 0 elsewhere
+        return fei4map2hvcmos(data, vncout)
 
     def load_fei4data(self, filename, dataname="HistOcc"):
-        import tables
-        f = tables.openFile(filename)
-        if dataname == "HistOcc#3":
-            data = np.transpose(f.root.HistOcc[206:230, 0:12, 0])
+        rows, cols = fei4_region(dataname, self.fei4_regions)
+        st = os.stat(filename)
+        key = (filename, st.st_mtime, rows.start, rows.stop, cols.start, cols.stop)
+        if key in self._fei4_cache:
+            data = self._fei4_cache.pop(key)
+        else:
+            import tables
+            f = tables.openFile(filename)
+            data = np.transpose(f.root.HistOcc[rows, cols, 0])
             #direct_pix=f.root.HistOcc[197,11,0]
-        elif dataname == "HistOcc" or dataname == "HistOcc#2":
-            data = np.transpose(f.root.HistOcc[184:208, 0:12, 0])
-        f.close()
-        return data
+            f.close()
+        ### LRU: most recent at the end
+        self._fei4_cache[key] = data
+        while len(self._fei4_cache) > self.fei4_cache_size:
+            self._fei4_cache.popitem(last=False)
+        return np.copy(data)
+
+    def start_fei4_session(self):
+        if self.fei4_session is not None:
+            return
+        import ccpdv2_fei4
+        self._fei4_join = self.rmg.run_run(ccpdv2_fei4.HvcmosSessionScan,
+                                           use_thread=True)
+        self.fei4_session = self.rmg.current_run
+        if not self.fei4_session.ready.wait(60):
+            self.stop_fei4_session()
+            raise Ccpdv2Timeout("FE-I4 session did not start")
+
+    def stop_fei4_session(self):
+        if self.fei4_session is None:
+            return
+        self.fei4_session.stop(msg="session closed")
+        self._fei4_join()  # wait for the run thread (teardown of the run)
+        self.fei4_session = None
+
+    def get_fei4_occupancy(self, duration=1.0, dataname="HistOcc"):
+        ### same array as load_fei4data(), from the running session
+        self.start_fei4_session()
+        hist = self.fei4_session.acquire(duration)
+        rows, cols = fei4_region(dataname, self.fei4_regions)
+        return np.transpose(hist[rows, cols])
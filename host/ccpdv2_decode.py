@@ -0,0 +1,108 @@
+''' sram word decoder of ccpdv2
+
+Shared by ccpdv2.py and ccpdv2_fei4.py, imports numpy only.
+'''
+import numpy as np
+
+
+#### sram word format (see ccpdv2.v)
+WORD_UNKNOWN = 0
+WORD_TLU = 1  # bit31=1, trigger number
+WORD_TDC = 2  # tdc_s3 DATA_IDENTIFIER 0100, hitor
+WORD_CCPD_TDC = 3  # tdc_s3 DATA_IDENTIFIER 0101
+WORD_FE_DH = 4  # fei4_rx, data header
+WORD_FE_DR = 5  # fei4_rx, data record
+WORD_FE = 6  # fei4_rx, other records (address, value, service)
+WORD_DTYPE = np.dtype([("type", np.uint8), ("channel", np.uint8),
+                       ("tdc", np.uint16), ("counter", np.uint16),
+                       ("trigger", np.uint32), ("col", np.uint8),
+                       ("row", np.uint16), ("tot1", np.uint8),
+                       ("tot2", np.uint8), ("lv1id", np.uint8),
+                       ("bcid", np.uint16)])
+
+
+class ccpdv2_decoder():
+    ### sram words -> WORD_DTYPE records. fields are valid only for their word type
+    def __init__(self, size=2**16):
+        self._alloc(size)
+
+    def _alloc(self, size):
+        self.buf = np.zeros(size, WORD_DTYPE)
+        self._t = np.empty(size, np.uint32)
+        self._m = np.empty(size, bool)
+        self._m2 = np.empty(size, bool)
+        self._m3 = np.empty(size, bool)
+        self._tdc = np.empty(size, np.uint32)
+
+    def tdc(self, data, tdc_only=False):
+        ### bits 11:0 of each word, tdc_only=True: of the tdc_s3 words only.
+        ### works on data as it is (a view of the readout), returns a view of a scratch buffer
+        n = len(data)
+        if n > len(self.buf):
+            self._alloc(max(n, 2 * len(self.buf)))
+        w = np.asarray(data, np.uint32)
+        tdc = self._tdc[:n]
+        np.bitwise_and(w, 0xfff, out=tdc)
+        if not tdc_only:
+            return tdc
+        t, m, m2 = self._t[:n], self._m[:n], self._m2[:n]
+        np.right_shift(w, 28, out=t)
+        np.equal(t, 0x4, out=m)
+        np.equal(t, 0x5, out=m2)
+        np.logical_or(m, m2, out=m)
+        return tdc[m]
+
+    def decode(self, data):
+        ### returns a view of the output buffer, valid until the next decode()
+        n = len(data)
+        if n > len(self.buf):
+            self._alloc(max(n, 2 * len(self.buf)))
+        w = np.asarray(data, np.uint32)
+        out = self.buf[:n]
+        t, m, m2, m3 = self._t[:n], self._m[:n], self._m2[:n], self._m3[:n]
+        typ = out["type"]
+        typ.fill(WORD_UNKNOWN)
+        ### tdc_s3: ID[31:28] counter[27:12] tdc[11:0]
+        np.bitwise_and(w, 0xfff, out=out["tdc"])
+        np.right_shift(w, 12, out=t)
+        np.bitwise_and(t, 0xffff, out=out["counter"])
+        np.right_shift(w, 28, out=t)
+        np.equal(t, 0x4, out=m)
+        np.copyto(typ, WORD_TDC, where=m)
+        np.equal(t, 0x5, out=m)
+        np.copyto(typ, WORD_CCPD_TDC, where=m)
+        np.greater_equal(t, 0x8, out=m)
+        np.copyto(typ, WORD_TLU, where=m)
+        np.equal(t, 0x0, out=m)
+        ### tlu: trigger[30:0]
+        np.bitwise_and(w, 0x7fffffff, out=out["trigger"])
+        ### fei4_rx: channel[27:24] record[23:0]
+        np.right_shift(w, 24, out=t)
+        np.bitwise_and(t, 0xf, out=out["channel"])
+        np.right_shift(w, 16, out=t)
+        np.bitwise_and(t, 0xff, out=t)
+        np.equal(t, 0xEA, out=m2)
+        np.equal(t, 0xEC, out=m3)
+        np.logical_or(m2, m3, out=m2)
+        np.equal(t, 0xEF, out=m3)
+        np.logical_or(m2, m3, out=m2)
+        np.logical_and(m2, m, out=m2)
+        np.copyto(typ, WORD_FE, where=m2)
+        np.equal(t, 0xE9, out=m3)
+        np.logical_and(m3, m, out=m3)
+        np.copyto(typ, WORD_FE_DH, where=m3)
+        np.logical_or(m2, m3, out=m2)
+        np.logical_xor(m, m2, out=m2)
+        np.copyto(typ, WORD_FE_DR, where=m2)
+        ### DR: col[23:17] row[16:8] tot1[7:4] tot2[3:0], DH: lv1id[14:10] bcid[9:0]
+        np.right_shift(w, 17, out=t)
+        np.bitwise_and(t, 0x7f, out=out["col"])
+        np.right_shift(w, 8, out=t)
+        np.bitwise_and(t, 0x1ff, out=out["row"])
+        np.right_shift(w, 4, out=t)
+        np.bitwise_and(t, 0xf, out=out["tot1"])
+        np.bitwise_and(w, 0xf, out=out["tot2"])
+        np.right_shift(w, 10, out=t)
+        np.bitwise_and(t, 0x1f, out=out["lv1id"])
+        np.bitwise_and(w, 0x3ff, out=out["bcid"])
+        return out
@@ -0,0 +1,769 @@
+''' Software emulator of the ccpdv2 setup (MIO + GPAC + HV2FEI4 v2)
+
+Stand-in for basil.dut.Dut built from ccpdv2.yaml. The basil register layer
+(StdRegister, FunctionalRegister) is used as it is, only the hardware drivers
+are replaced by emulated ones. Every driver call is counted as USB
+transactions and delayed by the per-transaction latency, and the chip model
+gives hit counts vs. CCPD_Th/TDAC and TDC values vs. injection.
+
+usage:
+   import ccpdv2
+   c=ccpdv2.Ccpdv2Fei4()
+   c.init_with_emu("ccpdv2.yaml")
+   c.find_noise()
+   print c.dut.get_stats()
+'''
+import time
+import math
+from collections import OrderedDict
+import numpy as np
+import yaml
+from basil.RL.StdRegister import StdRegister
+from basil.RL.FunctionalRegister import FunctionalRegister
+
+SPI_CLK = 1.0E6  # clock of spi and pulse_gen modules (see ccpdv2.v)
+SRAM_WORDS = 2 ** 19  # 2MB SRAM of MIO
+TDC_IDENTIFIER = {"tdc_rx2": 0x4, "CCPD_TDC": 0x5}
+
+#### parameters of the analog model
+EMU_CONF = {
+    "usb_latency": 0.0002,  # s per USB transaction
+    "usb_byte_time": 3.3E-8,  # s per byte (~30MB/s)
+    "noise_sigma": 0.005,  # V, rms noise at the comparator
+    "noise_rate": 1.0E5,  # Hz, max. noise hit rate per pixel
+    "offset_sigma": 0.02,  # V, pixel-to-pixel threshold dispersion
+    "tdac_step": 0.004,  # V/LSB at VNDAC=10
+    "inj_gain": 1.0,  # signal at comparator per V of injection
+    "tdc_gain": 2000.0,  # TDC counts per V over threshold
+    "tdc_sigma": 10.0,  # TDC counts
+    "tdc_noise": 30.0,  # mean TDC value of noise hits
+    "tau_pwr": 0.05,  # s, settling time constant of PWR channels
+    "tau_vsrc": 0.005,  # s, settling time constant of VSRC/INJ channels
+    "adc_sigma": 0.0005,  # V, noise of GPAC ADC readback
+    "adc_offset": 0.0,  # V, fixed offset of GPAC ADC readback
+    "spi_error_rate": 0.0,  # probability of a flipped bit per shift
+}
+
+
+class EmuUsb():
+    '''Counts transactions and models latency of the USB link
+    '''
+
+    def __init__(self, latency=None, byte_time=None):
+        if latency is None:
+            latency = EMU_CONF["usb_latency"]
+        if byte_time is None:
+            byte_time = EMU_CONF["usb_byte_time"]
+        self.latency = latency
+        self.byte_time = byte_time
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.n_transfer = 0
+        self.n_bytes = 0
+        self.usb_time = 0.0
+        self.per_driver = {}
+        self._debt = 0.0
+
+    def transfer(self, name, n_bytes=4, n=1):
+        self.n_transfer = self.n_transfer + n
+        self.n_bytes = self.n_bytes + n_bytes
+        self.per_driver[name] = self.per_driver.get(name, 0) + n
+        t = n * self.latency + n_bytes * self.byte_time
+        self.usb_time = self.usb_time + t
+        ### sleep() is not precise for small values, pay in chunks of 1ms
+        self._debt = self._debt + t
+        if self._debt > 0.001:
+            time.sleep(self._debt)
+            self._debt = 0.0
+
+
+def _q(x):
+    ''' upper tail of the normal distribution '''
+    return 0.5 * np.vectorize(math.erfc, otypes=[float])(np.asarray(x) / math.sqrt(2))
+
+
+def _field_bits(reg_conf):
+    ''' absolute bit positions of all fields of a StdRegister conf
+        returns {"ROW": [{"InL": [bits MSB..LSB], ...}, ...], "VNDAC": [...]}
+    '''
+    ret = {}
+    for f in reg_conf["fields"]:
+        if "repeat" in f:
+            ret[f["name"]] = []
+            for i in range(f["repeat"]):
+                lsb = f["offset"] - i * f["size"] - f["size"] + 1
+                sub = {}
+                for ff in f["fields"]:
+                    sub[ff["name"]] = _value_bits(ff, lsb)
+                ret[f["name"]].append(sub)
+        else:
+            ret[f["name"]] = _value_bits(f, 0)
+    return ret
+
+
+def _value_bits(f, lsb):
+    ''' bit positions of a field in order of the value bits (MSB first),
+        bit_order is taken into account as in StdRegister.__setitem__ '''
+    pos = [lsb + f["offset"] - i for i in range(f["size"])]  # MSB first
+    if "bit_order" in f:
+        bits = [0] * f["size"]
+        for i, b in enumerate(f["bit_order"]):
+            bits[f["size"] - 1 - b] = pos[i]
+        pos = bits
+    return pos
+
+
+class EmuCcpdv2():
+    '''Model of the HV2FEI4 v2 chip and the analog front end
+    '''
+
+    def __init__(self, conf, seed=0):
+        self.conf = dict(EMU_CONF)
+        self.rnd = np.random.RandomState(seed)
+        regs = dict([(r["name"], r) for r in conf["registers"]])
+        self.config_bits = _field_bits(regs["CCPD_CONFIG"])
+        self.global_bits = _field_bits(regs["CCPD_GLOBAL"])
+        self.config_size = regs["CCPD_CONFIG"]["size"]
+        self.global_size = regs["CCPD_GLOBAL"]["size"]
+        self._config_index()
+        self.offset = self.rnd.normal(0, self.conf["offset_sigma"], [24, 60])
+        self.tdacs = np.zeros([24, 60], int)
+        self.mon = np.zeros([24, 60], bool)
+        self.preamp = np.zeros([24, 60], bool)
+        self.dacs = {}
+        self.rx = 0
+        self.gpac = None
+        self.sram = None
+        self.tdc = {}
+        self.inj = None
+        self._t_noise = None
+        self._inj_cnt = 0
+
+    ### shift registers
+    def _tobits(self, data, size):
+        bits = np.unpackbits(np.asarray(data, np.uint8))[:size]
+        return bits[::-1]  # index=bit position
+
+    def _value(self, bits, pos):
+        v = 0
+        for p in pos:
+            v = (v << 1) | int(bits[p])
+        return v
+
+    def load(self, name, data):
+        self.update()
+        if name == "CCPD_CONFIG_SPI":
+            self._load_config(self._tobits(data, self.config_size))
+        elif name == "CCPD_GLOBAL_SPI":
+            bits = self._tobits(data, self.global_size)
+            for k, pos in self.global_bits.iteritems():
+                self.dacs[k] = self._value(bits, pos)
+
+    def _config_index(self):
+        ''' bit positions in CCPD_CONFIG for each pixel '''
+        row_f = self.config_bits["ROW"]
+        col_f = self.config_bits["COLUMN"]
+        self._i_tdac = np.zeros([24, 4], int)
+        self._i_ld = np.zeros(60, int)
+        self._i_rowen = np.zeros(24, int)
+        self._i_colsel = np.zeros([24, 60], int)
+        self._i_preamp = np.zeros([24, 60], int)
+        for row in range(24):
+            r = row_f[11 - row / 2]
+            if row % 4 == 1 or row % 4 == 2:
+                enlr, indac, en_base = "EnL", "InL", 0
+            else:
+                enlr, indac, en_base = "EnR", "InR", 3
+            lr = "L" if row % 2 == 0 else "R"
+            self._i_tdac[row, :] = r[indac]
+            self._i_rowen[row] = r[enlr][0]
+            for col in range(60):
+                c = col_f[19 - col / 3]
+                self._i_ld[col] = c["Ld%d" % (col % 3)][0]
+                self._i_colsel[row, col] = c["%s%d" % (lr, col % 3)][0]
+                self._i_preamp[row, col] = r["En%d" % (en_base + col % 3)][0]
+
+    def _load_config(self, bits):
+        ld = bits[self._i_ld] == 1
+        if np.any(ld):
+            tdac = np.dot(bits[self._i_tdac], [8, 4, 2, 1])
+            self.tdacs[:, ld] = tdac[:, np.newaxis]
+        self.mon = (bits[self._i_rowen] == 0)[:, np.newaxis] & (bits[self._i_colsel] == 1)
+        self.preamp = bits[self._i_preamp] == 1
+
+    ### analog response
+    def _x(self):
+        ''' distance of the threshold from the baseline for each pixel '''
+        th = self.gpac.value("VSRC3")
+        bl = self.gpac.value("VSRC2")
+        step = self.conf["tdac_step"] * self.dacs.get("VNDAC", 10) / 10.0
+        return (th - bl) - self.offset - (self.tdacs - 7.5) * step
+
+    def _powered(self):
+        return self.gpac.value("PWR0") > 1.0 and self.gpac.value("PWR2") > 0.5
+
+    def _active(self):
+        return self.mon & self.preamp
+
+    def noise_rate(self):
+        if self.gpac is None or not self._powered():
+            return 0.0
+        x = self._x()[self._active()]
+        if len(x) == 0:
+            return 0.0
+        return float(np.sum(self.conf["noise_rate"] * _q(x / self.conf["noise_sigma"])))
+
+    def _tdc_words(self, tdc, cnt):
+        ident = TDC_IDENTIFIER["CCPD_TDC"]
+        tdc = np.clip(np.asarray(tdc, np.int64), 1, 0xfff)
+        cnt = np.asarray(cnt, np.int64) & 0xffff
+        return np.asarray((ident << 28) | (cnt << 12) | tdc, np.uint32)
+
+    def _noise_words(self, n):
+        tdc = self.rnd.exponential(self.conf["tdc_noise"], n) + 1
+        cnt = np.zeros(n, np.int64) + self._inj_cnt
+        return self._tdc_words(tdc, cnt)
+
+    def _tdc_on(self, extern=False):
+        t = self.tdc.get("CCPD_TDC")
+        if t is None or (self.rx & 0x08) == 0:
+            return False
+        return t.en or (extern and t.en_extern)
+
+    def update(self, now=None):
+        ''' noise hits while the TDC is enabled '''
+        if now is None:
+            now = time.time()
+        if self._t_noise is not None and self._tdc_on():
+            n = self.rnd.poisson(self.noise_rate() * (now - self._t_noise))
+            if n > 0:
+                self.sram.push(self._noise_words(n))
+        self._t_noise = now
+
+    def gate(self, width):
+        ''' CCPD_TDCGATE_PULSE: starts CCPD_INJ_PULSE and enables the TDC '''
+        self.update()
+        words = []
+        if self.inj is not None and self.inj.en and self._tdc_on(extern=True) and self._powered():
+            n_inj = self.inj.repeat
+            amp = (self.gpac.value("INJ0") - self.gpac.value("INJ1")) * self.conf["inj_gain"]
+            x = self._x()[self._active()]
+            p = _q((x - amp) / self.conf["noise_sigma"])
+            for xi, pi in zip(x, p):
+                n = self.rnd.binomial(n_inj, pi)
+                if n == 0:
+                    continue
+                idx = np.sort(self.rnd.choice(n_inj, n, replace=False))
+                tdc = self.conf["tdc_gain"] * (amp - xi) + self.rnd.normal(0, self.conf["tdc_sigma"], n)
+                cnt = self._inj_cnt + self.inj.delay + idx * (self.inj.delay + self.inj.width)
+                words.append(self._tdc_words(tdc, cnt))
+        if self._tdc_on(extern=True) and not self._tdc_on():
+            n = self.rnd.poisson(self.noise_rate() * width / SPI_CLK)
+            if n > 0:
+                words.append(self._noise_words(n))
+        self._inj_cnt = self._inj_cnt + width
+        if len(words) > 0:
+            self.sram.push(np.sort(np.concatenate(words)))
+
+
+class EmuDriver(object):
+    def __init__(self, usb, chip, conf):
+        self._usb = usb
+        self._chip = chip
+        self._conf = conf
+        self.name = conf["name"]
+
+    def _io(self, n=1, n_bytes=4):
+        self._usb.transfer(self.name, n_bytes=n_bytes, n=n)
+
+    def init(self):
+        self._io()
+
+    def reset(self):
+        self._io()
+
+
+class EmuRegisters(EmuDriver):
+    ''' generic RegisterHardwareLayer (cmd_seq, fei4_rx, tlu, ...) '''
+
+    def __init__(self, usb, chip, conf):
+        super(EmuRegisters, self).__init__(usb, chip, conf)
+        self._reg = {}
+
+    def __getitem__(self, name):
+        self._io()
+        return self._reg.get(name, 0)
+
+    def __setitem__(self, name, value):
+        self._io()
+        self._reg[name] = value
+
+    def reset(self):
+        self._io()
+        self._reg = {}
+
+
+class EmuSpi(EmuDriver):
+    def __init__(self, usb, chip, conf):
+        super(EmuSpi, self).__init__(usb, chip, conf)
+        self._mem_bytes = conf["mem_bytes"]
+        self.reset()
+
+    def reset(self):
+        self._io()
+        self.size = 0
+        self.wait = 0
+        self.repeat = 1
+        self.en = False
+        self._mem = np.zeros(self._mem_bytes, np.uint8)
+        self._sr = np.zeros(self._mem_bytes, np.uint8)
+        self._sdo = np.zeros(self._mem_bytes, np.uint8)
+        self._t_done = 0
+
+    def set_size(self, value):
+        self._io()
+        self.size = value
+
+    def get_size(self):
+        self._io()
+        return self.size
+
+    def set_wait(self, value):
+        self._io()
+        self.wait = value
+
+    def get_wait(self):
+        self._io()
+        return self.wait
+
+    def set_repeat(self, value):
+        self._io()
+        self.repeat = value
+
+    def get_repeat(self):
+        self._io()
+        return self.repeat
+
+    def set_en(self, value):
+        self._io()
+        self.en = value
+
+    def get_en(self):
+        self._io()
+        return self.en
+
+    def get_mem_size(self):
+        self._io()
+        return self._mem_bytes
+
+    def start(self):
+        self._io()
+        if self.repeat == 0:
+            self._t_done = float("inf")
+        else:
+            self._t_done = time.time() + (self.size + self.wait) * self.repeat / SPI_CLK
+        ### SDO gives back what was in the shift register before
+        self._sdo = self._sr
+        self._sr = np.copy(self._mem)
+        if self._chip.rnd.rand() < self._chip.conf["spi_error_rate"]:
+            i = self._chip.rnd.randint(self._mem_bytes)
+            self._sr[i] = self._sr[i] ^ (1 << self._chip.rnd.randint(8))
+        self._chip.load(self.name, self._sr)
+
+    def is_done(self):
+        self._io()
+        return time.time() >= self._t_done
+
+    @property
+    def is_ready(self):
+        return self.is_done()
+
+    def set_data(self, data, addr=0):
+        if self._mem_bytes < len(data):
+            raise ValueError('Size of data (%d bytes) is too big for memory (%d bytes)' % (len(data), self._mem_bytes))
+        self._io(n_bytes=len(data))
+        self._mem[addr:addr + len(data)] = np.asarray(data, np.uint8)
+
+    def get_data(self, size=None, addr=None):
+        if size is None:
+            size = self._mem_bytes
+        self._io(n_bytes=size)
+        return np.asarray(self._sdo[:size], np.uint8)
+
+
+class EmuPulseGen(EmuDriver):
+    def __init__(self, usb, chip, conf):
+        super(EmuPulseGen, self).__init__(usb, chip, conf)
+        self.delay = 0
+        self.width = 0
+        self.repeat = 1
+        self.en = False
+        self._t_done = 0
+        if self.name == "CCPD_INJ_PULSE":
+            chip.inj = self
+
+    def reset(self):
+        self._io()
+        self.delay = 0
+        self.width = 0
+        self.repeat = 1
+        self.en = False
+        self._t_done = 0
+
+    def start(self):
+        self._io()
+        cycles = (self.delay + self.width) * max(self.repeat, 1)
+        self._t_done = time.time() + cycles / SPI_CLK
+        if self.name == "CCPD_TDCGATE_PULSE":
+            self._chip.gate(cycles)
+
+    def is_done(self):
+        self._io()
+        return time.time() >= self._t_done
+
+    @property
+    def is_ready(self):
+        return self.is_done()
+
+    def set_delay(self, value):
+        self._io()
+        self.delay = value
+
+    def get_delay(self):
+        self._io()
+        return self.delay
+
+    def set_width(self, value):
+        self._io()
+        self.width = value
+
+    def get_width(self):
+        self._io()
+        return self.width
+
+    def set_repeat(self, value):
+        self._io()
+        self.repeat = value
+
+    def get_repeat(self):
+        self._io()
+        return self.repeat
+
+    def set_en(self, value):
+        self._io()
+        self.en = value
+
+    def get_en(self):
+        self._io()
+        return self.en
+
+
+class EmuTdc(EmuDriver):
+    def __init__(self, usb, chip, conf):
+        super(EmuTdc, self).__init__(usb, chip, conf)
+        self.en = False
+        self.en_extern = False
+        self.event_counter = 0
+        chip.tdc[self.name] = self
+
+    def reset(self):
+        self._io()
+        self._chip.update()
+        self.en = False
+        self.en_extern = False
+
+    def set_en(self, value):
+        self._io()
+        self._chip.update()
+        self.en = bool(value)
+
+    def get_en(self):
+        self._io()
+        return self.en
+
+    def set_en_extern(self, value):
+        self._io()
+        self.en_extern = bool(value)
+
+    def get_en_extern(self):
+        self._io()
+        return self.en_extern
+
+    def get_event_counter(self):
+        self._io()
+        return self.event_counter
+
+    def get_lost_data_counter(self):
+        self._io()
+        return 0
+
+
+class EmuSramFifo(EmuDriver):
+    def __init__(self, usb, chip, conf):
+        super(EmuSramFifo, self).__init__(usb, chip, conf)
+        self.capacity = SRAM_WORDS
+        self.dropped = 0
+        self._data = []
+        self._n = 0
+        chip.sram = self
+
+    def push(self, words):
+        free = self.capacity - self._n
+        if len(words) > free:
+            self.dropped = self.dropped + len(words) - free
+            words = words[:free]
+        if len(words) > 0:
+            self._data.append(words)
+            self._n = self._n + len(words)
+
+    def reset(self):
+        self._io()
+        self._chip.update()  # words before the reset are lost
+        self._data = []
+        self._n = 0
+
+    def get_fifo_size(self):
+        self._io()
+        self._chip.update()
+        return self._n * 4
+
+    @property
+    def FIFO_SIZE(self):
+        return self.get_fifo_size()
+
+    def get_FIFO_INT_SIZE(self):
+        return self.get_fifo_size() / 4
+
+    def get_read_error_counter(self):
+        self._io()
+        return 0
+
+    def get_data(self):
+        self._chip.update()
+        self._io(n=2)  # FIFO_SIZE twice
+        if self._n == 0:
+            return np.array([], dtype=np.dtype('<u4'))
+        data = np.concatenate(self._data)
+        self._data = []
+        self._n = 0
+        self._io(n_bytes=4 * len(data))
+        return data
+
+
+class EmuGpio(EmuDriver):
+    def __init__(self, usb, chip, conf):
+        super(EmuGpio, self).__init__(usb, chip, conf)
+        self._size = conf.get("size", 8)
+        self._data = np.zeros((self._size - 1) / 8 + 1, np.uint8)
+        self._output_en = np.zeros_like(self._data)
+
+    def reset(self):
+        self._io()
+        self._data[:] = 0
+        self._chip.rx = 0
+
+    def set_data(self, value):
+        self._io()
+        self._data[:] = np.asarray(value, np.uint8)
+        if self.name == "gpio_rx":
+            self._chip.update()
+            self._chip.rx = int(self._data[-1])
+
+    def get_data(self):
+        self._io()
+        return np.copy(self._data)
+
+    def set_output_en(self, value):
+        self._io()
+        self._output_en[:] = np.asarray(value, np.uint8)
+
+    def get_output_en(self):
+        self._io()
+        return np.copy(self._output_en)
+
+
+class EmuGpac(EmuDriver):
+    ''' power (PWR), voltage sources (VSRC), injection (INJ), current sources (ISRC) of GPAC '''
+    LOAD = {"PWR0": 0.02, "PWR1": 0.005, "PWR2": 0.01, "PWR3": 0.001}  # A at 1V
+
+    def __init__(self, usb, chip, conf):
+        super(EmuGpac, self).__init__(usb, chip, conf)
+        self.ch = {}
+        self.current_limit = 1.0
+        chip.gpac = self
+
+    def _get(self, channel):
+        if channel not in self.ch:
+            self.ch[channel] = {"set": 0.0, "v0": 0.0, "t": 0.0, "en": "PWR" not in channel}
+        return self.ch[channel]
+
+    def _tau(self, channel):
+        if "PWR" in channel:
+            return self._chip.conf["tau_pwr"]
+        return self._chip.conf["tau_vsrc"]
+
+    def value(self, channel, now=None):
+        ''' true output voltage '''
+        if now is None:
+            now = time.time()
+        c = self._get(channel)
+        target = c["set"] if c["en"] else 0.0
+        return target + (c["v0"] - target) * math.exp(-(now - c["t"]) / self._tau(channel))
+
+    def _change(self, channel, value=None, en=None):
+        now = time.time()
+        c = self._get(channel)
+        c["v0"] = self.value(channel, now)
+        c["t"] = now
+        if value is not None:
+            c["set"] = value
+        if en is not None:
+            c["en"] = bool(en)
+
+    def _unit(self, value, unit, base):
+        scale = {"V": 1.0, "mV": 1E-3, "A": 1.0, "mA": 1E-3, "uA": 1E-6}
+        if unit not in scale:
+            raise TypeError("Invalid unit type.")
+        return value * scale[unit] / base
+
+    def set_voltage(self, channel, value, unit='V'):
+        self._io(n=4)
+        self._change(channel, value=self._unit(value, unit, 1.0))
+
+    def get_voltage(self, channel, unit='V'):
+        self._io(n=6)
+        v = self.value(channel) + self._chip.conf["adc_offset"] + self._chip.rnd.normal(
+            0, self._chip.conf["adc_sigma"])
+        return v / self._unit(1.0, unit, 1.0)
+
+    def get_current(self, channel, unit='A'):
+        self._io(n=6)
+        i = self.value(channel) * self.LOAD.get(channel, 1E-6)
+        i = i + self._chip.rnd.normal(0, 1E-5)
+        return i / self._unit(1.0, unit, 1.0)
+
+    def set_enable(self, channel, value):
+        if "PWR" not in channel:
+            raise ValueError('set_enable() not supported for channel %s' % channel)
+        self._io(n=3)
+        self._change(channel, en=value)
+
+    def get_over_current(self, channel):
+        self._io(n=3)
+        return False
+
+    def set_current_limit(self, channel, value, unit='A'):
+        self._io(n=4)
+        self.current_limit = self._unit(value, unit, 1.0)
+
+    def set_current(self, channel, value, unit='A'):
+        self._io(n=4)
+        self._change(channel, value=self._unit(value, unit, 1.0))
+
+
+class EmuHv(EmuDriver):
+    ''' HV supply (iseg shq) on the serial port '''
+
+    def __init__(self, usb, chip, conf):
+        super(EmuHv, self).__init__(usb, chip, conf)
+        self.debug = 0
+        self.v = 0.0
+
+    def set_voltage(self, value, unit="V"):
+        self._io(n=2)
+        self.v = value
+
+    def get_voltage(self, unit="V"):
+        self._io(n=2)
+        return self.v
+
+    def get_current(self, unit="A"):
+        self._io(n=2)
+        return self.v * 1E-9
+
+
+EMU_DRIVERS = {
+    "GPAC": EmuGpac,
+    "spi": EmuSpi,
+    "pulse_gen": EmuPulseGen,
+    "tdc_s3": EmuTdc,
+    "sram_fifo": EmuSramFifo,
+    "gpio": EmuGpio,
+    "shq122m": EmuHv,
+}
+
+
+class EmuDut():
+    '''basil.dut.Dut lookalike with emulated drivers
+    '''
+
+    def __init__(self, conf="ccpdv2.yaml", latency=None, seed=0):
+        if isinstance(conf, basestring):
+            with open(conf) as f:
+                conf = yaml.safe_load(f)
+        self.usb = EmuUsb(latency=latency)
+        self.chip = EmuCcpdv2(conf, seed=seed)
+        self._hw = OrderedDict()
+        for drv in conf["hw_drivers"]:
+            cls = EMU_DRIVERS.get(drv["type"], EmuRegisters)
+            self._hw[drv["name"]] = cls(self.usb, self.chip, dict(drv))
+        if "HV" not in self._hw:
+            self._hw["HV"] = EmuHv(self.usb, self.chip, {"name": "HV"})
+        self._registers = OrderedDict()
+        for reg in conf["registers"]:
+            reg = dict(reg)
+            drv = self._hw[reg["hw_driver"]]
+            if reg["type"] == "StdRegister":
+                self._registers[reg["name"]] = StdRegister(drv, reg)
+            else:
+                self._registers[reg["name"]] = FunctionalRegister(drv, reg)
+
+    def init(self):
+        for d in self._hw.itervalues():
+            d.init()
+        for r in self._registers.itervalues():
+            r.init()
+
+    def __getitem__(self, item):
+        if item in self._registers:
+            return self._registers[item]
+        elif item in self._hw:
+            return self._hw[item]
+        raise KeyError('Item not existing: %s' % (item, ))
+
+    def get_stats(self):
+        return {
+            "transfer": self.usb.n_transfer,
+            "bytes": self.usb.n_bytes,
+            "usb_time": self.usb.usb_time,
+            "per_driver": dict(self.usb.per_driver)
+        }
+
+    def reset_stats(self):
+        self.usb.reset_stats()
+
+
+if __name__ == "__main__":
+    import sys
+    import ccpdv2
+    yamlfile = "ccpdv2.yaml"
+    if len(sys.argv) > 1:
+        yamlfile = sys.argv[1]
+    c = ccpdv2.Ccpdv2Fei4()
+    c.l.set_stdout(False)
+    t = time.time()
+    c.init_with_emu(yamlfile)
+    print "init: %fs %s" % (time.time() - t, str(c.dut.get_stats()))
+    for name, func in [
+        ("put_tdac", lambda: c.set(tdacall=7)),
+        ("pixels", lambda: c.set(pix="all")),
+        ### one pixel in ccpd mode as in the README, the default rj45 mode has no CCPD TDC
+        ("ccpd_mode", lambda: c.set(pix=[[5, 20]], mode="ccpd")),
+        ("find_noise", lambda: c.find_noise()),
+    ]:
+        c.dut.reset_stats()
+        t = time.time()
+        func()
+        s = c.dut.get_stats()
+        print "%s: %fs %d transfers %d bytes" % (name, time.time() - t, s["transfer"], s["bytes"])
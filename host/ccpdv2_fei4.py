@@ -0,0 +1,210 @@
+''' pybar scans for the FE-I4 readout of ccpdv2
+
+Imported by Ccpdv2Fei4 only when the FE-I4 is used (init_with_fei4,
+run_fei4scan, tune_with_fei4, start_fei4_session), so that ccpd-only
+sessions do not load pybar.
+'''
+import time
+import threading
+import logging
+import numpy as np
+import progressbar
+
+from pybar.run_manager import RunManager
+from pybar.scans.scan_init import InitScan
+from pybar.scans.scan_ext_trigger import ExtTriggerScan
+from pybar.scans.scan_fei4_self_trigger import FEI4SelfTriggerScan
+from pybar.scans.tune_threshold_baseline import ThresholdBaselineTuning
+
+from ccpdv2_decode import ccpdv2_decoder, WORD_FE_DR
+
+
+class HvcmosScan(ExtTriggerScan):
+    '''External trigger scan with FE-I4
+    For use with external scintillator (user RX0), TLU (use RJ45), USBpix self-trigger (loop back TX2 into RX0.)
+    '''
+    _default_run_conf = {
+        "trig_count": 0,
+        # FE-I4 trigger count, number of consecutive BCs, from 0 to 15
+        "trigger_mode": 0,
+        # trigger mode, more details in basil.HL.tlu, from 0 to 3
+        "trigger_latency": 232,
+        # FE-I4 trigger latency, in BCs, external scintillator / TLU / HitOR: 232, USBpix self-trigger: 220
+        "trigger_delay": 14,  # trigger delay, in BCs
+        "trigger_count": 0,  # consecutive trigger, 0 means 16
+        "trigger_rate_limit": 500,
+        # artificially limiting the trigger rate, in BCs (25ns)
+        "trigger_pos_edge": True,
+        # trigger on the positibe edge of the RX0 trigger signal
+        "trigger_time_stamp": False,
+        # if true trigger number is a time stamp with 40 Mhz clock
+        "trigger_tdc": False,
+        # only create tdc word if it can be assigned to a trigger
+        "col_span": [1, 80],  #[1,12],
+        "row_span": [
+            1, 336
+        ],  #[184, 208], sn2 [197, 197] [197, 230], #sn3 [219, 219],
+        "overwrite_enable_mask": False,
+        "use_enable_mask_for_imon": False,
+        "no_data_timeout": 0,  #10,
+        "scan_timeout": None,  #10,  # in seconds
+        "max_triggers": None,
+        "enable_tdc": False,
+        'reset_rx_on_error': False,
+        # long scans have a high propability for ESD related data transmission errors; recover and continue here
+        "hvcmos_inj": True
+    }
+
+    def scan(self):
+        # preload command
+        lvl1_command = self.register.get_commands(
+            "zeros",
+            length=self.trigger_delay)[0] + self.register.get_commands(
+                "LV1")[0] + self.register.get_commands(
+                    "zeros",
+                    length=self.trigger_rate_limit)[0]
+        self.register_utils.set_command(lvl1_command)
+
+        with self.readout(**self.scan_parameters._asdict()):
+            got_data = False
+            ### inject to HVCMOS
+            if self.hvcmos_inj == True:
+                logging.info("inj %s" % self.hvcmos_inj)
+                if self.dut['rx']['CCPD_TDC'] == 1:
+                    self.dut['sram'].reset()
+                self.dut['CCPD_TDCGATE_PULSE'].start()
+            while not self.stop_run.wait(1.0):
+                if not got_data:
+                    if self.fifo_readout.data_words_per_second() > 0:
+                        got_data = True
+                        logging.info('Taking data...')
+                        self.progressbar = progressbar.ProgressBar(
+                            widgets=['', progressbar.Percentage(), ' ',
+                                     progressbar.Bar(marker='*',
+                                                     left='|',
+                                                     right='|'), ' ',
+                                     progressbar.AdaptiveETA()],
+                            maxval=self.max_triggers,
+                            poll=10,
+                            term_width=80).start()
+                else:
+                    triggers = self.dut['tlu']['TRIGGER_COUNTER']
+                    try:
+                        self.progressbar.update(triggers)
+                    except ValueError:
+                        pass
+                    if self.max_triggers is not None and triggers >= self.max_triggers:
+                        self.progressbar.finish()
+                        self.stop(msg='Trigger limit was reached: %i' %
+                                  self.max_triggers)
+
+        logging.info('Total amount of triggers collected: %d',
+                     self.dut['tlu']['TRIGGER_COUNTER'])
+
+
+class HvcmosSelfScan(FEI4SelfTriggerScan):
+    _default_run_conf = {
+        "trig_count": 0,
+        # FE-I4 trigger count, number of consecutive BCs, from 0 to 15
+        "trigger_latency": 239,
+        # FE-I4 trigger latency, in BCs, external scintillator / TLU / HitOR: 232, USBpix self-trigger: 220, from 0 to 255
+        "col_span": [
+            1, 80
+        ],  # defining active column interval, 2-tuple, from 1 to 80
+        "row_span": [1, 336
+                     ],  # defining active row interval, 2-tuple, from 1 to 336
+        "overwrite_enable_mask": False,
+        # if True, use col_span and row_span to define an active region regardless of the Enable pixel register. If False, use col_span and row_span to define active region by also taking Enable pixel register into account.
+        "use_enable_mask_for_imon": False,
+        # if True, apply inverted Enable pixel mask to Imon pixel mask
+        "no_data_timeout": 10,
+        # no data timeout after which the scan will be aborted, in seconds
+        "scan_timeout": 60,
+        # timeout for scan after which the scan will be stopped, in seconds
+        "hvcmos_inj": True
+    }
+
+    def scan(self):
+        with self.readout():
+            got_data = False
+            start = time.time()
+            ### inject to HVCMOS
+            if self.hvcmos_inj == True:
+                logging.info("inj %s" % self.hvcmos_inj)
+                if self.dut['rx']['CCPD_TDC'] == 1:
+                    self.dut['sram'].reset()
+                self.dut['CCPD_TDCGATE_PULSE'].start()
+            while not self.stop_run.wait(1.0):
+                if not got_data:
+                    if self.fifo_readout.data_words_per_second() > 0:
+                        got_data = True
+                        logging.info('Taking data...')
+                        self.progressbar = progressbar.ProgressBar(
+                            widgets=['', progressbar.Percentage(), ' ',
+                                     progressbar.Bar(marker='*',
+                                                     left='|',
+                                                     right='|'), ' ',
+                                     progressbar.Timer()],
+                            maxval=self.scan_timeout,
+                            poll=10,
+                            term_width=80).start()
+                else:
+                    try:
+                        self.progressbar.update(time.time() - start)
+                    except ValueError:
+                        pass
+
+
+class HvcmosSessionScan(HvcmosSelfScan):
+    '''FE-I4 self-trigger scan which stays running between measurements.
+    The occupancy is histogrammed in memory by acquire(), nothing is written to file
+    '''
+    _default_run_conf = dict(HvcmosSelfScan._default_run_conf)
+    _default_run_conf.update({"no_data_timeout": 0, "scan_timeout": None})
+
+    def __init__(self, *args, **kwargs):
+        super(HvcmosSessionScan, self).__init__(*args, **kwargs)
+        self.hist = np.zeros([336, 80], np.uint32)  # [row-1, col-1] as HistOcc
+        self.decoder = ccpdv2_decoder()
+        self.ready = threading.Event()
+        self._acquire = threading.Event()
+        self._lock = threading.Lock()
+
+    def scan(self):
+        with self.readout():
+            self.ready.set()
+            while not self.stop_run.wait(0.1):
+                pass
+        self.ready.clear()
+
+    def handle_data(self, data):
+        if not self._acquire.is_set():
+            return
+        d = self.decoder.decode(data[0])
+        dr = d[d["type"] == WORD_FE_DR]
+        dr = dr[(dr["col"] >= 1) & (dr["col"] <= 80) & (dr["row"] >= 1) &
+                (dr["row"] <= 336)]
+        ### two hits per data record, tot2=0xF: no hit in row+1
+        with self._lock:
+            np.add.at(self.hist, (dr["row"] - 1, dr["col"] - 1), 1)
+            dr = dr[(dr["tot2"] != 0xF) & (dr["row"] < 336)]
+            np.add.at(self.hist, (dr["row"], dr["col"] - 1), 1)
+
+    def analyze(self):
+        pass
+
+    def acquire(self, duration):
+        ### occupancy [336,80] during duration seconds
+        with self._lock:
+            self.hist[:, :] = 0
+        if self.hvcmos_inj == True:
+            if self.dut['rx']['CCPD_TDC'] == 1:
+                self.dut['sram'].reset()
+            self.dut['CCPD_TDCGATE_PULSE'].start()
+        self._acquire.set()
+        time.sleep(duration)
+        ### data of the last readout_interval are still in the sram fifo
+        time.sleep(2 * self.fifo_readout.readout_interval)
+        self._acquire.clear()
+        with self._lock:
+            return np.copy(self.hist)
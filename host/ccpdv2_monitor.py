@@ -0,0 +1,184 @@
+''' Background sampler of the GPAC monitors and HV
+
+Each channel is read with its own period by a low priority thread (see
+ccpdv2_lock), the readings go into a fixed-size ring buffer and are
+appended to a binary file of MONITOR_DTYPE records. The last reading of
+each GPAC channel also updates the monitor cache of Ccpdv2Fei4, so
+snapshot(max_age=None) is up to date without any USB access.
+
+usage:
+   c.start_monitor(rates={"CCPD_Vdd": 0.1, "HV": 5.0})
+   c.scan_th()
+   d=c.monitor.query(t0, t1, "CCPD_Vdd")
+   print c.monitor.conditions(*c.t_measure)
+   c.stop_monitor()
+
+   python ccpdv2_monitor.py monitor.dat    # summary of a file
+'''
+import os
+import sys
+import time
+import threading
+import numpy as np
+
+import ccpdv2
+
+CHANNELS = ccpdv2.MONITORS + ["HV"]
+MONITOR_DTYPE = np.dtype([("t", np.float64), ("channel", np.uint8),
+                          ("v", np.float32), ("i", np.float32)])
+RATES = {"CCPD_Vdd": 1.0, "CCPD_Vssa": 1.0, "CCPD_VGate": 1.0,
+         "CCPD_Vcasc": 1.0, "CCPD_BL": 1.0, "CCPD_Th": 1.0, "PCB_Th": 1.0,
+         "HV": 5.0}  # s between two readings, None=not sampled
+
+
+def load(filename, t0=None, t1=None, channel=None):
+    ### records of a monitor file, records are in time order
+    if not os.path.exists(filename) or os.path.getsize(filename) < MONITOR_DTYPE.itemsize:
+        return np.zeros(0, MONITOR_DTYPE)
+    n = os.path.getsize(filename) / MONITOR_DTYPE.itemsize
+    d = np.memmap(filename, MONITOR_DTYPE, mode="r", shape=(n, ))
+    i0 = 0 if t0 is None else np.searchsorted(d["t"], t0)
+    i1 = n if t1 is None else np.searchsorted(d["t"], t1)
+    d = np.array(d[i0:i1])
+    if channel is not None:
+        d = d[d["channel"] == CHANNELS.index(channel)]
+    return d
+
+
+class ccpdv2_monitor():
+    def __init__(self, c, rates=None, size=2**16, filename="monitor.dat"):
+        self.c = c
+        self.rates = dict(RATES)
+        if rates is not None:
+            self.rates.update(rates)
+        self.buf = np.zeros(size, MONITOR_DTYPE)
+        self.n = 0  # readings since start, the last one is at buf[(n-1)%size]
+        self.filename = filename
+        self.flush_interval = 1.0
+        self.errors = {}
+        self._f = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._t = None
+
+    def start(self):
+        if self._t is not None:
+            return
+        if self.filename is not None:
+            self._f = open(self.filename, "ab")
+        self._stop.clear()
+        self._t = threading.Thread(target=self._run, name="monitor")
+        self._t.daemon = True
+        self._t.start()
+
+    def stop(self):
+        if self._t is None:
+            return
+        self._stop.set()
+        self._t.join()
+        self._t = None
+        with self._lock:
+            if self._f is not None:
+                self._f.close()
+                self._f = None
+
+    def _read(self, name):
+        if name == "HV":
+            return self.c.get_hv()
+        m = self.c.get_monitor([name], max_age=0)[name]
+        return m[1], m[2]
+
+    def _run(self):
+        self.c.lock.set_priority(ccpdv2.PRIORITY_LOW)
+        due = {}
+        for name, rate in self.rates.iteritems():
+            if rate is not None:
+                due[name] = time.time()
+        t_flush = time.time() + self.flush_interval
+        while len(due) != 0 and not self._stop.is_set():
+            now = time.time()
+            rec = []
+            for name in sorted(due.iterkeys()):
+                if due[name] > now:
+                    continue
+                try:
+                    v, i = self._read(name)
+                except Exception as e:
+                    print "ccpdv2_monitor %s disabled: %s" % (name, str(e))
+                    self.errors[name] = str(e)
+                    del due[name]
+                    continue
+                rec.append((time.time(), CHANNELS.index(name), v, i))
+                due[name] = max(due[name] + self.rates[name], now)
+            if len(rec) != 0:
+                self._append(np.array(rec, MONITOR_DTYPE))
+            if self._f is not None and now > t_flush:
+                with self._lock:
+                    self._f.flush()
+                t_flush = now + self.flush_interval
+            if len(due) != 0:
+                self._stop.wait(max(min(due.itervalues()) - time.time(), 0))
+
+    def _append(self, rec):
+        with self._lock:
+            j = np.arange(self.n, self.n + len(rec)) % len(self.buf)
+            self.buf[j] = rec
+            self.n = self.n + len(rec)
+            if self._f is not None:
+                rec.tofile(self._f)
+
+    def get_buf(self):
+        ### content of the ring buffer in time order
+        with self._lock:
+            size = len(self.buf)
+            if self.n <= size:
+                return np.copy(self.buf[:self.n])
+            i = self.n % size
+            return np.concatenate([self.buf[i:], self.buf[:i]])
+
+    def query(self, t0=None, t1=None, channel=None):
+        ### readings with t0<=t<t1, from the file if the ring buffer does not go back to t0
+        d = self.get_buf()
+        if self.filename is not None and (len(d) == 0 or t0 is None or d["t"][0] > t0):
+            if self._f is not None:
+                with self._lock:
+                    self._f.flush()
+            return load(self.filename, t0, t1, channel)
+        i0 = 0 if t0 is None else np.searchsorted(d["t"], t0)
+        i1 = len(d) if t1 is None else np.searchsorted(d["t"], t1)
+        d = d[i0:i1]
+        if channel is not None:
+            d = d[d["channel"] == CHANNELS.index(channel)]
+        return d
+
+    def conditions(self, t0, t1):
+        ### name: (mean v, mean i, n readings) in [t0,t1], the last reading before t0 if there is none
+        d = self.get_buf()
+        ret = {}
+        for k, name in enumerate(CHANNELS):
+            dd = d[d["channel"] == k]
+            if len(dd) == 0:
+                continue
+            m = (dd["t"] >= t0) & (dd["t"] < t1)
+            if np.any(m):
+                ret[name] = (float(np.mean(dd["v"][m])), float(np.mean(dd["i"][m])),
+                             int(np.sum(m)))
+            else:
+                j = np.searchsorted(dd["t"], t0) - 1
+                if j >= 0:
+                    ret[name] = (float(dd["v"][j]), float(dd["i"][j]), 0)
+        return ret
+
+
+if __name__ == "__main__":
+    d = load(sys.argv[1] if len(sys.argv) > 1 else "monitor.dat")
+    print "%d readings" % len(d)
+    if len(d) != 0:
+        print "%s - %s" % (time.ctime(d["t"][0]), time.ctime(d["t"][-1]))
+    for k, name in enumerate(CHANNELS):
+        dd = d[d["channel"] == k]
+        if len(dd) == 0:
+            continue
+        print "%s n=%d v=%f+-%f [%f,%f] i=%f+-%f max %f" % (
+            name, len(dd), np.mean(dd["v"]), np.std(dd["v"]), np.min(dd["v"]),
+            np.max(dd["v"]), np.mean(dd["i"]), np.std(dd["i"]), np.max(dd["i"]))
@@ -0,0 +1,296 @@
+''' Index and query of scan.txt / scan_archive.txt written by ccpdv2_logging
+
+Each "#cmd" line starts a command block. The index keeps per command the
+time, the command, the byte range in the file, the number of data rows,
+the config at the start of the command (all "#key value" lines logged
+before it) and the values logged inside the block. Results of a command
+are named after their line: "#noise th 1.01" -> noise_th, "#snapshot t .."
+-> snapshot_t, they never change the config. Only the bytes appended since
+the last update are parsed, the index is saved as a pickle next to the logs.
+
+usage:
+   import ccpdv2_scanlog
+   log=ccpdv2_scanlog.ccpdv2_scanlog()
+   log.update()
+   sel=log.select(cmd="find_noise", VNDAC=10)
+   print log.get("t")[sel], log.get("noise_th", where="values")[sel]
+   d=log.rows(sel)
+'''
+import os
+import re
+import time
+import cPickle
+import hashlib
+import numpy as np
+
+INDEX_VERSION = 3
+HEAD_BYTES = 256  # start of a file kept in the index to detect a new file with the same name
+_PREFIX = re.compile(r"([A-Za-z_]\w*) +(?=[A-Za-z_])")
+_KEY_VALUE = re.compile(r"([A-Za-z_]\w*) +([-+]?[0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?|True|False)")
+_SKIP = ("#cmd", "#pixels", "#config", "#global")
+ROW_DTYPE = np.dtype([("i", np.int64), ("x", np.float64), ("tdc", np.float64),
+                      ("tdc_std", np.float64), ("cnt", np.float64),
+                      ("all_cnt", np.float64), ("raw_cmd", np.int64),
+                      ("raw_point", np.int64)])
+
+
+def parse_line(line):
+    ### "#BLRes 1,ThRes 20" -> (None, {"BLRes":1.0,"ThRes":20.0}), "#Vdd 1.8V(36mA)" -> (None, {"Vdd":1.8})
+    ### "#noise th 1.01" -> ("noise", {"th":1.01}), "#set th 0.9" is config -> (None, {"th":0.9})
+    ret = {}
+    if line.startswith(_SKIP):
+        return None, ret
+    body = line[1:]
+    prefix = None
+    m = _PREFIX.match(body)
+    if m is not None:
+        body = body[m.end():]
+        if m.group(1) != "set":
+            prefix = m.group(1)
+    for k, v in _KEY_VALUE.findall(body):
+        if v == "True":
+            ret[k] = 1.0
+        elif v == "False":
+            ret[k] = 0.0
+        else:
+            ret[k] = float(v)
+    return prefix, ret
+
+
+def parse_values(line):
+    ### values of a line with the result keys namespaced, "#noise th 1.01" -> {"noise_th":1.01}
+    prefix, ret = parse_line(line)
+    if prefix is None:
+        return ret
+    return dict([("%s_%s" % (prefix, k), v) for k, v in ret.iteritems()])
+
+
+def parse_row(line):
+    ### "x tdc tdc_std cnt all_cnt" or "x tdc tdc_std cnt raw<cmd>-<point>"
+    d = line.split(" ", 4)
+    if len(d) < 4:
+        return None
+    try:
+        row = [float(d[0]), float(d[1]), float(d[2]), float(d[3])]
+    except ValueError:
+        return None
+    raw_cmd, raw_point = -1, -1
+    if len(d) == 5:
+        try:
+            row.append(float(d[4]))
+        except ValueError:
+            row.append(np.nan)
+            if d[4].startswith("raw"):
+                raw_cmd, raw_point = [int(i) for i in d[4][3:].split("-")]
+    else:
+        row.append(np.nan)
+    return row + [raw_cmd, raw_point]
+
+
+class ccpdv2_scanlog():
+    def __init__(self, files=("scan_archive.txt", "scan.txt"),
+                 index="scan_index.pkl"):
+        self.files = [os.path.abspath(f) for f in files]
+        self.indexfile = index
+        self._clear()
+        if index is not None and os.path.exists(index):
+            self.load()
+
+    def _clear(self):
+        self.state = {}  # per file: offset, cumulative config, open command
+        self.cols = {"t": [], "cmd": [], "args": [], "file": [], "start": [],
+                     "end": [], "nrow": []}
+        self.config = {}  # key -> list of config values at the start of each command
+        self.values = {}  # key -> list of the last value logged inside each command
+        self._arrays = None
+
+    def load(self):
+        with open(self.indexfile, "rb") as f:
+            d = cPickle.load(f)
+        if d.get("version") != INDEX_VERSION:
+            return
+        self.state, self.cols = d["state"], d["cols"]
+        self.config, self.values = d["config"], d["values"]
+        self._arrays = None
+
+    def save(self):
+        if self.indexfile is None:
+            return
+        tmp = "%s.tmp" % self.indexfile
+        with open(tmp, "wb") as f:
+            cPickle.dump({"version": INDEX_VERSION, "state": self.state,
+                          "cols": self.cols, "config": self.config,
+                          "values": self.values}, f, 2)
+        if os.path.exists(self.indexfile):
+            os.remove(self.indexfile)
+        os.rename(tmp, self.indexfile)
+
+    def _drop_file(self, fname):
+        ### scan.txt was archived or rewritten, forget what came from it
+        keep = [i for i, f in enumerate(self.cols["file"]) if f != fname]
+        for d in [self.cols, self.config, self.values]:
+            for k in d.iterkeys():
+                d[k] = [d[k][i] for i in keep]
+        self.state.pop(fname, None)
+
+    def _new_command(self, fname, st, t, cmd, args, start):
+        n = len(self.cols["t"])
+        for k, v in [("t", t), ("cmd", cmd), ("args", args), ("file", fname),
+                     ("start", start), ("end", start), ("nrow", 0)]:
+            self.cols[k].append(v)
+        for k, v in st["config"].iteritems():
+            if k not in self.config:
+                self.config[k] = [np.nan] * n
+        for k in self.config.iterkeys():
+            self.config[k].append(st["config"].get(k, np.nan))
+        for k in self.values.iterkeys():
+            self.values[k].append(np.nan)
+        st["cmd"] = n
+
+    def _head(self, fname, n):
+        with open(fname, "rb") as f:
+            d = f.read(n)
+        return len(d), hashlib.md5(d).hexdigest()
+
+    def _same_file(self, fname, st, stat):
+        ### False if scan.txt was archived and written again, even if it is larger now
+        if stat.st_size < st["offset"] or stat.st_ino != st["inode"]:
+            return False
+        return self._head(fname, st["head"][0]) == st["head"]
+
+    def update(self):
+        ### parse the bytes appended since the last update, returns number of new commands
+        n0 = len(self.cols["t"])
+        for fname in self.files:
+            if not os.path.exists(fname):
+                if fname in self.state:
+                    self._drop_file(fname)
+                continue
+            stat = os.stat(fname)
+            size = stat.st_size
+            st = self.state.get(fname)
+            if st is not None and not self._same_file(fname, st, stat):
+                self._drop_file(fname)
+                st = None
+            if st is None:
+                st = {"offset": 0, "config": {}, "cmd": None, "inode": stat.st_ino,
+                      "head": (0, hashlib.md5("").hexdigest())}
+                self.state[fname] = st
+            if size == st["offset"]:
+                continue
+            with open(fname, "rb") as f:
+                f.seek(st["offset"])
+                buf = f.read(size - st["offset"])
+            buf = buf[:buf.rfind("\n") + 1]  # the last line may still be written
+            self._parse(fname, st, buf)
+            if st["head"][0] < HEAD_BYTES:
+                st["head"] = self._head(fname, min(st["offset"], HEAD_BYTES))
+        self._arrays = None
+        self.save()
+        return len(self.cols["t"]) - n0
+
+    def _parse(self, fname, st, buf):
+        offset = st["offset"]
+        for line in buf.splitlines(True):
+            start = offset
+            offset = offset + len(line)
+            line = line.rstrip("\r\n")
+            if line.startswith("#cmd "):
+                d = line.split(" ", 3)
+                try:
+                    t = time.mktime(time.strptime(d[1], "%y/%m/%d-%H:%M:%S"))
+                except ValueError:
+                    t = np.nan
+                args = d[3] if len(d) > 3 else ""
+                cmd = d[2] if len(d) > 2 else ""
+                self._new_command(fname, st, t, cmd, args, start)
+            elif line.startswith("#"):
+                prefix, v = parse_line(line)
+                if prefix is None:
+                    st["config"].update(v)
+                else:
+                    v = dict([("%s_%s" % (prefix, k), val) for k, val in v.iteritems()])
+                if st["cmd"] is not None:
+                    for k, val in v.iteritems():
+                        if k not in self.values:
+                            self.values[k] = [np.nan] * len(self.cols["t"])
+                        self.values[k][st["cmd"]] = val
+            elif st["cmd"] is not None and len(line) != 0 and (
+                    line[0].isdigit() or line[0] == "-"):
+                self.cols["nrow"][st["cmd"]] += 1
+            if st["cmd"] is not None:
+                self.cols["end"][st["cmd"]] = offset
+        st["offset"] = offset
+
+    def _get_arrays(self):
+        if self._arrays is None:
+            a = {}
+            for k, v in self.cols.iteritems():
+                if k in ["cmd", "args", "file"]:
+                    a[k] = np.array(v, dtype=object)
+                else:
+                    a[k] = np.array(v)
+            self._arrays = a
+        return self._arrays
+
+    def __len__(self):
+        return len(self.cols["t"])
+
+    def keys(self, where="config"):
+        if where == "config":
+            return sorted(self.config.keys())
+        return sorted(self.values.keys())
+
+    def get(self, key, where="config"):
+        ### column of all commands as numpy array, key = t,cmd,args,... or a config key
+        a = self._get_arrays()
+        if key in a:
+            return a[key]
+        d = self.config if where == "config" else self.values
+        if key not in d:
+            return np.zeros(len(self)) * np.nan
+        return np.array(d[key], dtype=float)
+
+    def select(self, cmd=None, since=None, until=None, **config):
+        ### indices of the commands matching cmd, time range and config values
+        m = np.ones(len(self), bool)
+        if cmd is not None:
+            m &= self.get("cmd") == cmd
+        if since is not None:
+            m &= self.get("t") >= since
+        if until is not None:
+            m &= self.get("t") < until
+        for k, v in config.iteritems():
+            m &= np.isclose(self.get(k), v)
+        return np.argwhere(m)[:, 0]
+
+    def rows(self, sel):
+        ### data rows of the selected commands, column "i" = command index
+        if np.isscalar(sel):
+            sel = [sel]
+        ret = []
+        for i in sel:
+            if self.cols["nrow"][i] == 0:
+                continue
+            with open(self.cols["file"][i], "rb") as f:
+                f.seek(self.cols["start"][i])
+                buf = f.read(self.cols["end"][i] - self.cols["start"][i])
+            for line in buf.splitlines():
+                if len(line) == 0 or not (line[0].isdigit() or line[0] == "-"):
+                    continue
+                r = parse_row(line)
+                if r is not None:
+                    ret.append(tuple([i] + r))
+        return np.array(ret, dtype=ROW_DTYPE)
+
+
+if __name__ == "__main__":
+    import sys
+    log = ccpdv2_scanlog(files=sys.argv[1:] if len(sys.argv) > 1 else
+                         ("scan_archive.txt", "scan.txt"))
+    t0 = time.time()
+    n = log.update()
+    print "%d new commands, %d in index, %.3fs" % (n, len(log), time.time() - t0)
+    cmds, cnt = np.unique(log.get("cmd").astype(str), return_counts=True)
+    for c, n in zip(cmds, cnt):
+        print "%s %d" % (c, n)
@@ -0,0 +1,306 @@
+''' Board-owning server for Ccpdv2Fei4 and its client
+
+The server keeps one initialized Ccpdv2Fei4 (and so the USB device and the
+shadow state) and runs the commands of all clients one after the other.
+Commands are methods of Ccpdv2Fei4 (set, measure, scan_th, find_noise, ...)
+and attribute access. Each message is a 4 byte length + a JSON header,
+numpy arrays follow the header as raw bytes. The raw words of every
+measure() are streamed to the client while a scan is running.
+
+A client has to send the token of the server first. The server writes a new
+token into TOKENFILE (readable only by the user who started it) unless one
+is given with --token, ccpdv2_client reads it from there. Clients which do not
+connect from LOCAL_HOSTS cannot run LOCAL_COMMANDS, put attributes or set hv.
+
+usage:
+   python ccpdv2_server.py --emu            # emulated board, see ccpdv2_emu.py
+   python ccpdv2_server.py --yaml ccpdv2.yaml --warm
+
+   import ccpdv2_server
+   cl=ccpdv2_server.ccpdv2_client()
+   cl.set(th=0.9, mode="ccpd")
+   data=cl.measure(0.1)
+   cl.scan_th(1.0, 0.9, -0.01)
+   print len(cl.points), cl.get("th")
+'''
+import os
+import sys
+import hmac
+import json
+import binascii
+import struct
+import socket
+import threading
+import SocketServer
+import numpy as np
+
+import ccpdv2
+
+PORT = 5052
+COMMANDS = ["set", "measure", "analyze", "scan_th", "spectrum", "find_th",
+            "find_noise", "find_tdac", "tune_tdac", "set_tdac_again", "show",
+            "show2", "clear", "snapshot", "get_allconfig", "get_power",
+            "get_monitor", "get_th", "get_bl", "get_pcbth", "get_inj", "get_hv",
+            "get_latency", "put_th", "put_bl", "put_pcbth", "put_inj",
+            "put_tdac", "plan_tdac", "save_tdac", "put_power_off", "init",
+            "tune_with_fei4", "get_fei4_occupancy", "start_fei4_session",
+            "stop_fei4_session"]
+### HV, power and re-init of the board, not for clients from other hosts
+LOCAL_COMMANDS = ["init", "put_power_off", "shutdown", "put"]
+LOCAL_HOSTS = ["127.0.0.1", "::1"]
+TOKENFILE = os.path.join(os.path.expanduser("~"), ".ccpdv2_token")
+_HEADER = struct.Struct("!I")
+
+
+def _encode(obj, arrays):
+    ### JSON-able copy of obj, numpy arrays are replaced by {"__array__": index}
+    if isinstance(obj, np.ndarray):
+        arrays.append(np.ascontiguousarray(obj))
+        return {"__array__": len(arrays) - 1}
+    elif isinstance(obj, np.generic):
+        return obj.item()
+    elif hasattr(obj, "_asdict"):
+        return _encode(obj._asdict(), arrays)
+    elif isinstance(obj, dict):
+        return dict([(str(k), _encode(v, arrays)) for k, v in obj.iteritems()])
+    elif isinstance(obj, (list, tuple)):
+        return [_encode(v, arrays) for v in obj]
+    return obj
+
+
+def _decode(obj, arrays):
+    ### json gives unicode, Ccpdv2Fei4 expects str (set(pix="all"), mode=...)
+    if isinstance(obj, dict):
+        if "__array__" in obj and len(obj) == 1:
+            return arrays[obj["__array__"]]
+        return dict([(str(k), _decode(v, arrays)) for k, v in obj.iteritems()])
+    elif isinstance(obj, list):
+        return [_decode(v, arrays) for v in obj]
+    elif isinstance(obj, unicode):
+        return obj.encode("utf-8")
+    return obj
+
+
+def _recv(sock, n):
+    buf = []
+    while n > 0:
+        d = sock.recv(min(n, 1 << 20))
+        if len(d) == 0:
+            raise EOFError("connection closed")
+        buf.append(d)
+        n = n - len(d)
+    return "".join(buf)
+
+
+def send_msg(sock, msg):
+    ### header: JSON with "arrays" = [[dtype, shape], ...] of the payload
+    arrays = []
+    msg = _encode(msg, arrays)
+    msg["arrays"] = [[a.dtype.str, list(a.shape)] for a in arrays]
+    head = json.dumps(msg)
+    sock.sendall(_HEADER.pack(len(head)) + head)
+    for a in arrays:
+        sock.sendall(a.tostring())
+
+
+def recv_msg(sock):
+    n, = _HEADER.unpack(_recv(sock, _HEADER.size))
+    msg = json.loads(_recv(sock, n))
+    arrays = []
+    for dtype, shape in msg.pop("arrays", []):
+        dtype = np.dtype(str(dtype))
+        size = int(np.prod(shape)) * dtype.itemsize
+        arrays.append(np.fromstring(_recv(sock, size), dtype).reshape(shape))
+    return _decode(msg, arrays)
+
+
+def read_token(tokenfile=TOKENFILE):
+    with open(tokenfile) as f:
+        return f.read().strip()
+
+
+def write_token(tokenfile=TOKENFILE):
+    ### new random token, the file is created readable only by the user
+    token = binascii.hexlify(os.urandom(16))
+    if os.path.exists(tokenfile):
+        os.remove(tokenfile)
+    fd = os.open(tokenfile, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+    with os.fdopen(fd, "w") as f:
+        f.write(token)
+    return token
+
+
+class ccpdv2_handler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        ### the first message is {"cmd": "auth", "token": ...}, nothing else is run before
+        try:
+            msg = recv_msg(self.request)
+        except EOFError:
+            return
+        if msg.get("cmd") != "auth" or not hmac.compare_digest(
+                str(msg.get("token", "")), self.server.token):
+            send_msg(self.request, {"type": "error", "error": "Ccpdv2Error: invalid token"})
+            return
+        send_msg(self.request, {"type": "result", "result": None})
+        local = self.client_address[0] in self.server.local_hosts
+        while True:
+            try:
+                msg = recv_msg(self.request)
+            except EOFError:
+                return
+            self.server.run(self.request, msg, local)
+
+
+class ccpdv2_server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    ### one Ccpdv2Fei4, commands of all connections are serialized by self.lock
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, c, host="127.0.0.1", port=PORT, token=None,
+                 tokenfile=TOKENFILE):
+        ### token=None: a new token is written into tokenfile
+        SocketServer.TCPServer.__init__(self, (host, port), ccpdv2_handler)
+        self.c = c
+        self.lock = threading.Lock()
+        self.n_cmd = 0
+        self.local_hosts = list(LOCAL_HOSTS)
+        if token is None:
+            token = write_token(tokenfile)
+        self.token = str(token)
+
+    def _call(self, sock, msg, local):
+        cmd = msg.get("cmd")
+        if not local and (cmd in LOCAL_COMMANDS or "hv" in msg.get("kwargs", {})):
+            raise ValueError("%s is allowed only from %s" % (cmd, ", ".join(self.local_hosts)))
+        if cmd == "ping":
+            return self.n_cmd
+        elif cmd in ["get", "put"] and msg["name"].startswith("_"):
+            raise ValueError("invalid attribute %s" % msg["name"])
+        elif cmd == "get":
+            return getattr(self.c, msg["name"])
+        elif cmd == "put":
+            setattr(self.c, msg["name"], msg["value"])
+            return None
+        elif cmd == "shutdown":
+            threading.Thread(target=self.shutdown).start()
+            return None
+        elif cmd not in COMMANDS:
+            raise ValueError("invalid command %s" % cmd)
+        ### raw words of each measure() go to the client as they come
+        n = [0]
+
+        def on_data(data):
+            send_msg(sock, {"type": "data", "n": n[0], "th": self.c.th,
+                            "data": np.asarray(data)})
+            n[0] = n[0] + 1
+
+        self.c.on_data = on_data if msg.get("stream", True) else None
+        try:
+            return getattr(self.c, cmd)(*msg.get("args", []),
+                                        **msg.get("kwargs", {}))
+        finally:
+            self.c.on_data = None
+
+    def run(self, sock, msg, local=True):
+        with self.lock:
+            self.n_cmd = self.n_cmd + 1
+            try:
+                ret = self._call(sock, msg, local)
+                ### the whole header is encoded before anything is sent
+                send_msg(sock, {"type": "result", "result": ret})
+            except Exception as e:
+                send_msg(sock, {"type": "error",
+                                "error": "%s: %s" % (e.__class__.__name__, str(e))})
+
+
+class ccpdv2_client():
+    ### c=ccpdv2_client(); c.set(th=0.9); c.measure(0.1); points of the last call in c.points
+    ### token=None: read from tokenfile
+    def __init__(self, host="127.0.0.1", port=PORT, timeout=None, token=None,
+                 tokenfile=TOKENFILE):
+        if token is None:
+            token = read_token(tokenfile)
+        self.sock = socket.create_connection((host, port), timeout)
+        self.points = []
+        self.on_data = None  # function(msg) called for each streamed measure()
+        send_msg(self.sock, {"cmd": "auth", "token": token})
+        try:
+            self._result()
+        except Exception:
+            self.sock.close()
+            raise
+
+    def call(self, cmd, *args, **kwargs):
+        stream = kwargs.pop("stream", True)
+        send_msg(self.sock, {"cmd": cmd, "args": args, "kwargs": kwargs,
+                             "stream": stream})
+        self.points = []
+        while True:
+            msg = recv_msg(self.sock)
+            if msg["type"] == "data":
+                self.points.append(msg)
+                if self.on_data is not None:
+                    self.on_data(msg)
+            elif msg["type"] == "error":
+                raise ccpdv2.Ccpdv2Error(msg["error"])
+            else:
+                return msg["result"]
+
+    def get(self, name):
+        send_msg(self.sock, {"cmd": "get", "name": name})
+        return self._result()
+
+    def put(self, name, value):
+        send_msg(self.sock, {"cmd": "put", "name": name, "value": value})
+        return self._result()
+
+    def _result(self):
+        msg = recv_msg(self.sock)
+        if msg["type"] == "error":
+            raise ccpdv2.Ccpdv2Error(msg["error"])
+        return msg["result"]
+
+    def ping(self):
+        return self.call("ping")
+
+    def shutdown(self):
+        return self.call("shutdown")
+
+    def close(self):
+        self.sock.close()
+
+    def __getattr__(self, name):
+        if name in COMMANDS:
+            return lambda *args, **kwargs: self.call(name, *args, **kwargs)
+        raise AttributeError(name)
+
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description="ccpdv2 board server")
+    parser.add_argument("--emu", action="store_true", help="emulated board")
+    parser.add_argument("--yaml", default="ccpdv2.yaml")
+    parser.add_argument("--fei4", default=None, help="pybar configuration.yaml")
+    parser.add_argument("--warm", action="store_true", help="init(warm=True)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--token", default=None,
+                        help="token of the clients, default: new one in %s" % TOKENFILE)
+    args = parser.parse_args(argv)
+    c = ccpdv2.Ccpdv2Fei4()
+    if args.emu:
+        c.init_with_emu(args.yaml, warm=args.warm)
+    elif args.fei4 is not None:
+        c.init_with_fei4(args.fei4, warm=args.warm)
+    else:
+        c.init(args.yaml, warm=args.warm)
+    server = ccpdv2_server(c, args.host, args.port, token=args.token)
+    print "ccpdv2_server on %s:%d" % (args.host, args.port)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
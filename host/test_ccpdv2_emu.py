@@ -0,0 +1,180 @@
+''' tests of Ccpdv2Fei4 against the board emulator (ccpdv2_emu), no hardware needed
+
+usage:
+   python -m unittest test_ccpdv2_emu
+'''
+import os
+import sys
+import shutil
+import tempfile
+import time
+import unittest
+import StringIO
+
+import numpy as np
+
+import ccpdv2
+import ccpdv2_emu  # imported before setUp() changes the directory
+
+YAML = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ccpdv2.yaml")
+
+
+class EmuTestCase(unittest.TestCase):
+    ### runs in a temporary directory, scan.txt and the statefile are written there
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        self.c = self._new()
+        self.c.init_with_emu(YAML, latency=0)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def _new(self):
+        c = ccpdv2.Ccpdv2Fei4()
+        c.l.set_stdout(False)
+        return c
+
+    @property
+    def chip(self):
+        return self.c.dut.dut.chip
+
+
+class _Errors(object):
+    ### spi_error_rate of the emulator which flips a bit in the shifts given as True
+    def __init__(self, shifts):
+        self.shifts = list(shifts)
+
+    def __gt__(self, x):
+        return len(self.shifts) != 0 and self.shifts.pop(0)
+
+
+class TestConfig(EmuTestCase):
+    def test_tdac_and_pixels(self):
+        t = np.random.RandomState(1).randint(0, 16, [24, 60]).astype(float)
+        ### monitoring is row enable x column select, a product set comes back as it is
+        pixels = [[3, 4], [3, 30], [10, 4], [10, 30]]
+        self.c.set(tdac=t, pix=pixels)
+        self.assertTrue((self.chip.tdacs == t).all())
+        self.assertTrue((self.chip.mon == ccpdv2.pixels2mask(pixels)).all())
+        self.c.set(tdacall=7)
+        self.c.set(tdac0_0=2, pix=[[0, 0]])
+        self.assertEqual(self.chip.tdacs[0, 0], 2)
+        self.assertTrue((self.chip.tdacs[1:] == 7).all())
+        self.assertEqual(zip(*np.nonzero(self.chip.mon)), [(0, 0)])
+
+    def test_global(self):
+        self.c.set(VNDAC=7, ThRes=12)
+        self.assertEqual(self.chip.dacs["VNDAC"], 7)
+        self.assertEqual(self.chip.dacs["ThRes"], 12)
+
+
+class TestWriteVerify(EmuTestCase):
+    def _set(self, **kwargs):
+        out = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            self.c.set(**kwargs)
+        finally:
+            out, sys.stdout = sys.stdout.getvalue(), out
+        return out
+
+    def test_retry(self):
+        ### the first shift goes wrong, the readback of the second one sees it
+        self.c.write_verify = 1
+        self.chip.conf["spi_error_rate"] = _Errors([True])
+        out = self._set(VNDAC=7)
+        self.assertEqual(out.count("readback mismatch"), 1)
+        self.assertEqual(self.chip.dacs["VNDAC"], 7)
+
+    def test_give_up(self):
+        self.c.write_verify = 1
+        self.c.write_retry = 2
+        self.chip.conf["spi_error_rate"] = 1.0
+        self.assertRaises(ccpdv2.Ccpdv2VerifyError, self._set, VNDAC=7)
+
+    def test_off(self):
+        self.chip.conf["spi_error_rate"] = 1.0
+        self.assertEqual(self._set(VNDAC=7).count("readback mismatch"), 0)
+
+
+class TestSettle(EmuTestCase):
+    def test_timeout(self):
+        ### the readback never comes close enough to the target
+        self.c.settle.profiles["CCPD_Th"] = dict(ccpdv2.SETTLE_PROFILES["default"], timeout=0.05)
+        self.c.settle.reset_hist()
+        self.chip.conf["adc_offset"] = 0.2
+        self.c.set(th=0.8)
+        self.assertEqual(self.c.settle.timeouts.get("CCPD_Th"), 1)
+        self.assertNotIn("CCPD_Th", self.c.settle.times)
+        self.assertNotIn("CCPD_Th", self.c._settling)
+
+    def test_settled(self):
+        self.c.settle.reset_hist()
+        self.c.set(th=0.8)
+        self.assertEqual(len(self.c.settle.times["CCPD_Th"]), 1)
+        self.assertEqual(self.c.settle.timeouts, {})
+
+
+class TestBatch(EmuTestCase):
+    def test_rollback(self):
+        th, VNDAC, pixels = self.c.th, self.c.VNDAC, list(self.c.pixels)
+        dacs = dict(self.chip.dacs)
+        self.c.dut.reset_stats()
+        with self.assertRaises(ValueError):
+            with self.c.batch():
+                self.c.set(th=0.8, VNDAC=3, pix=[[1, 1]])
+                self.c.set(no_such_param=1)
+        self.assertEqual((self.c.th, self.c.VNDAC, self.c.pixels), (th, VNDAC, pixels))
+        self.assertEqual(self.chip.dacs, dacs)
+        self.assertEqual(self.c.dut.dut.get_stats()["transfer"], 0)
+
+    def test_commit(self):
+        with self.c.batch():
+            self.c.set(th=0.8)
+            self.c.set(VNDAC=3)
+            self.assertNotEqual(self.chip.dacs["VNDAC"], 3)
+        self.assertEqual(self.chip.dacs["VNDAC"], 3)
+        self.assertAlmostEqual(self.chip.gpac.ch["VSRC3"]["set"], 0.8)
+
+
+class TestWarmStart(EmuTestCase):
+    def _warm(self):
+        ### new session on the same board
+        c = self._new()
+        c.dut = self.c.dut.dut
+        c.dut.reset_stats()
+        t0 = time.time()
+        c.init(YAML, warm=True)
+        return c, c.dut.dut.get_stats(), time.time() - t0
+
+    def test_warm_is_taken_and_faster(self):
+        c = self._new()
+        c.dut = self.c.dut.dut
+        c.dut.reset_stats()
+        t0 = time.time()
+        c.init(YAML)
+        t_cold = time.time() - t0
+        cold = c.dut.dut.get_stats()
+        c._flush_state()
+
+        c, warm, t_warm = self._warm()
+        self.assertEqual(c._hw["CCPD_Vdd"], self.c._hw["CCPD_Vdd"])
+        ### no module reset, no TDAC reload and no GPAC output written again
+        self.assertEqual(warm["per_driver"].get("CCPD_CONFIG_SPI", 0), 1)
+        self.assertEqual(warm["per_driver"].get("CCPD_GLOBAL_SPI", 0), 1)
+        self.assertLess(warm["transfer"] * 3, cold["transfer"])
+        ### cold start waits for the power rails to settle
+        self.assertLess(t_warm * 3, t_cold)
+
+    def test_cold_after_reset(self):
+        self.c._flush_state()
+        self.c.dut["CCPD_GLOBAL"].set_size(8)
+        c, warm, t_warm = self._warm()
+        self.assertGreater(warm["per_driver"].get("CCPD_CONFIG_SPI", 0), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+''' tests of ccpdv2_scanlog, no hardware needed
+
+usage:
+   python -m unittest test_ccpdv2_scanlog
+'''
+import os
+import shutil
+import tempfile
+import unittest
+
+import ccpdv2_scanlog
+
+
+class TestScanlog(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.scan = os.path.join(self.dir, "scan.txt")
+        self.index = os.path.join(self.dir, "scan_index.pkl")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _write(self, text, mode="a"):
+        with open(self.scan, mode) as f:
+            f.write(text)
+
+    def _log(self):
+        return ccpdv2_scanlog.ccpdv2_scanlog(files=[self.scan], index=self.index)
+
+    def test_incremental(self):
+        self._write("#cmd 26/10/18-07:00:00 set\n#th 0.9\n")
+        log = self._log()
+        self.assertEqual(log.update(), 1)
+        self._write("#cmd 26/10/18-07:00:01 scan_th 1.0 0.9 -0.01\n0.95 100 1 5 5\n")
+        log = self._log()
+        self.assertEqual(log.update(), 1)
+        self.assertEqual(list(log.get("cmd")), ["set", "scan_th"])
+        self.assertEqual(list(log.get("nrow")), [0, 1])
+        self.assertAlmostEqual(log.get("th")[1], 0.9)
+
+    def test_results_are_not_config(self):
+        self._write("#cmd 26/10/18-07:00:00 set\n#th 0.9\n"
+                    "#cmd 26/10/18-07:00:01 find_noise -0.05\n#noise th 1.01\n"
+                    "#snapshot t 17.5, BLRes 1\n"
+                    "#cmd 26/10/18-07:00:02 spectrum 1\n")
+        log = self._log()
+        log.update()
+        self.assertAlmostEqual(log.get("th")[2], 0.9)
+        self.assertAlmostEqual(log.get("noise_th", where="values")[1], 1.01)
+        self.assertAlmostEqual(log.get("snapshot_t", where="values")[1], 17.5)
+        self.assertNotAlmostEqual(log.get("t")[1], 17.5)
+
+    def test_archived_file_larger_than_offset(self):
+        self._write("#cmd 26/10/18-07:00:00 set\n#th 0.9\n", "w")
+        log = self._log()
+        log.update()
+        ### archive() removes scan.txt, the new one grows past the old offset
+        os.remove(self.scan)
+        self._write("#cmd 26/10/18-08:00:00 set\n#th 0.8\n" +
+                    "#cmd 26/10/18-08:00:01 spectrum 3\n1 100 1 5 5\n" * 3, "w")
+        log = self._log()
+        log.update()
+        self.assertEqual(list(log.get("cmd")), ["set", "spectrum", "spectrum", "spectrum"])
+        self.assertAlmostEqual(log.get("th")[1], 0.8)
+        self._write("#cmd 26/10/18-08:00:09 show\n")
+        self.assertEqual(log.update(), 1)
+        self.assertEqual(len(log), 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
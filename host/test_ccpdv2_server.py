@@ -0,0 +1,84 @@
+''' tests of ccpdv2_server with a client on the emulated board, no hardware needed
+
+usage:
+   python -m unittest test_ccpdv2_server
+'''
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+
+import ccpdv2
+import ccpdv2_emu  # imported before setUp() changes the directory
+import ccpdv2_server
+
+YAML = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ccpdv2.yaml")
+
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        self.c = ccpdv2.Ccpdv2Fei4()
+        self.c.l.set_stdout(False)
+        self.c.init_with_emu(YAML, latency=0)
+        self.tokenfile = os.path.join(self.dir, "token")
+        self.server = ccpdv2_server.ccpdv2_server(self.c, port=0, tokenfile=self.tokenfile)
+        self.port = self.server.server_address[1]
+        self.t = threading.Thread(target=self.server.serve_forever)
+        self.t.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.t.join()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def _client(self, token=None):
+        return ccpdv2_server.ccpdv2_client(port=self.port, timeout=10, token=token,
+                                           tokenfile=self.tokenfile)
+
+    def test_token_file(self):
+        if os.name == "posix":
+            self.assertEqual(os.stat(self.tokenfile).st_mode & 0777, 0600)
+        self.assertRaises(ccpdv2.Ccpdv2Error, self._client, "0" * 32)
+        self.assertEqual(self.server.n_cmd, 0)
+
+    def test_commands(self):
+        cl = self._client()
+        cl.set(th=0.9, mode="ccpd", pix=[[5, 20]])
+        self.assertAlmostEqual(cl.get("th"), 0.9)
+        self.assertAlmostEqual(self.c.th, 0.9)
+        self.assertEqual(self.c.mode, "ccpd")
+        cl.put("repeat", 50)
+        self.assertEqual(self.c.repeat, 50)
+        self.assertRaises(ccpdv2.Ccpdv2Error, cl.get, "_hw")
+        self.assertRaises(ccpdv2.Ccpdv2Error, cl.call, "put_config_bits")
+        data = cl.measure(0.01)
+        self.assertIsInstance(data, np.ndarray)
+        self.assertEqual(len(cl.points), 1)
+        self.assertTrue((cl.points[0]["data"] == data).all())
+        cl.close()
+
+    def test_remote_client(self):
+        ### the client is not in local_hosts: no HV, no put, no init
+        self.server.local_hosts = []
+        cl = self._client()
+        cl.set(th=0.95)
+        self.assertAlmostEqual(self.c.th, 0.95)
+        hv = self.c.hv
+        self.assertRaises(ccpdv2.Ccpdv2Error, cl.set, hv=50)
+        self.assertRaises(ccpdv2.Ccpdv2Error, cl.put, "hv", 50)
+        self.assertRaises(ccpdv2.Ccpdv2Error, cl.call, "put_power_off")
+        self.assertRaises(ccpdv2.Ccpdv2Error, cl.shutdown)
+        self.assertEqual(self.c.hv, hv)
+        cl.close()
+
+
+if __name__ == "__main__":
+    unittest.main()